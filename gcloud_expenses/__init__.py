@@ -1,17 +1,150 @@
+import base64
 import datetime
+import decimal
+import functools
+import importlib
 import os
+import shutil
+import socket
+import tempfile
+import threading
 import urllib
+import zlib
 
-from gcloud import datastore
-from gcloud.datastore.key import Key
-from gcloud.datastore.entity import Entity
-from gcloud.datastore.query import Query
-from gcloud.datastore.transaction import Transaction
-from gcloud.exceptions import NotFound
-from gcloud import storage
+from .archive import ArchiveError
+from .archive import CHUNK_BYTES
+from .archive import ChunkWriter
+from .archive import MANIFEST
+from .archive import format_timestamp
+from .archive import read_chunk
+from .archive import read_manifest
+from .archive import verify_chunk
+from .archive import write_manifest
+from .batch import run_batch
+from .clients import Client
+from .clients import ConnectedNamespace
+from .clients import ThreadClients
+from .clients import accepts_connection
+from .clients import activate
+from .clients import connected_query_class
+from .clients import connected_transaction_class
+from .cache import DiskLRUCache
+from .cache import TTLCache
+from .duplicates import DuplicateScanner
+from .duplicates import build_fingerprints
+from .duplicates import normalize_vendor
+from .integrity import ChecksumMismatch
+from .integrity import Digests
+from .integrity import FAST_CRC32C
+from .integrity import HashingReader
+from .integrity import HashingWriter
+from .integrity import algorithms_for
+from .integrity import stored_hashes
+from .integrity import verify
+from .lazy import LazyAttribute
+from .lazy import LazyModule
+from .retry import ContentionStats
+from .retry import RetriesExhausted
+from .retry import RetryPolicy
+from .retry import call_with_retries
+from .schema import from_datastore
+from .schema import to_datastore
+from .search import Hits
+from .search import build_postings
+from .search import tokenize
+from .tracing import TracedNamespace
+from .tracing import traced_function
+from .tracing import traced_query_class
 
 
 BUCKET_NAME = 'gcloud-python-demo-expenses'
+REVIEW_QUEUE_KIND = 'Review Queue Entry'
+SEARCH_TERM_KIND = 'Search Term'
+FINGERPRINT_KIND = 'Expense Fingerprint'
+# Unprocessed copies of normalized receipts (see 'normalize').
+ORIGINALS = 'originals'
+
+TRANSACTION_RETRY_POLICY = RetryPolicy()
+transaction_stats = ContentionStats()
+# Receipt transfers are retried on checksum mismatches, too.
+TRANSFER_RETRY_POLICY = RetryPolicy(max_attempts=3, budget=60.0)
+transfer_stats = ContentionStats()
+
+# Downloaded receipts are cached on disk, keyed by the object's generation,
+# and shared by all processes of the user.  A budget of 0 disables caching.
+RECEIPT_CACHE_DIR = os.environ.get(
+    'GCLOUD_EXPENSES_RECEIPT_CACHE',
+    os.path.join('~', '.gcloud_expenses', 'receipts'))
+RECEIPT_CACHE_BYTES = int(os.environ.get(
+    'GCLOUD_EXPENSES_RECEIPT_CACHE_MB', 1024)) * 1024 * 1024
+_receipt_cache = []
+
+# Employee IDs known to have an 'Employee' entity.  Employees are never
+# deleted by the application:  the TTL bounds the damage if one is removed
+# behind our back.
+known_employees = TTLCache(maxsize=10000, ttl=3600)
+MAX_BATCH = 500
+
+_initialized = []
+_initialize_lock = threading.Lock()
+
+
+def initialize_gcloud():
+    """Set up the gcloud defaults (dataset, connections);  idempotent.
+
+    Called implicitly when the gcloud libraries are first used.
+    """
+    if _initialized:
+        return
+    with _initialize_lock:
+        if not _initialized:
+            importlib.import_module('gcloud.datastore').set_defaults()
+            importlib.import_module('gcloud.storage').set_defaults()
+            _initialized.append(True)
+
+
+def reinitialize_gcloud():
+    """Re-create the gcloud default connections, if already set up.
+
+    Called in forked processes, which must not share the parent's
+    connections.
+    """
+    with _initialize_lock:
+        if _initialized:
+            importlib.import_module(
+                'gcloud.datastore').set_default_connection()
+            importlib.import_module(
+                'gcloud.storage').set_default_connection()
+
+
+# The gcloud libraries are imported, and initialized, on first use;  see
+# 'lazy'.  Backend calls are recorded against the active trace, if any;  see
+# 'tracing'.  Datastore calls use the connection passed to the data function,
+# if any;  see 'clients'.
+exceptions = LazyModule('gcloud.exceptions')
+datastore = TracedNamespace(
+    ConnectedNamespace(
+        LazyModule('gcloud.datastore', initialize_gcloud),
+        ('get', 'put', 'delete')), {
+        'get': 'datastore.get',
+        'put': 'datastore.put',
+        'delete': 'datastore.delete',
+        })
+storage = TracedNamespace(
+    LazyModule('gcloud.storage', initialize_gcloud), {
+        'get_bucket': 'storage.get_bucket',
+        'create_bucket': 'storage.create_bucket',
+        })
+Key = LazyAttribute(
+    LazyModule('gcloud.datastore.key', initialize_gcloud), 'Key')
+Entity = LazyAttribute(
+    LazyModule('gcloud.datastore.entity', initialize_gcloud), 'Entity')
+Query = LazyAttribute(
+    LazyModule('gcloud.datastore.query', initialize_gcloud), 'Query',
+    lambda found: traced_query_class(connected_query_class(found)))
+Transaction = LazyAttribute(
+    LazyModule('gcloud.datastore.transaction', initialize_gcloud),
+    'Transaction', connected_transaction_class)
 
 
 class NoSuchEmployee(Exception):
@@ -38,11 +171,66 @@ class NoSuchReceipt(Exception):
     """Attempt to download a receipt which does not already exist."""
 
 
-def _get_bucket():
+def _retryable_errors():
+    """Return errors after which a transaction may safely be re-run.
+
+    Only 'Conflict' guarantees that nothing was committed;  see
+    'retry.Attempt'.
+    """
+    return ((exceptions.Conflict, exceptions.InternalServerError,
+             exceptions.ServiceUnavailable, socket.error),
+            (exceptions.Conflict,))
+
+
+def _retrying_transaction(func):
+    """Run ``func`` in a transaction, retried per the module policy.
+
+    The wrapped function is called with an extra, leading
+    :class:`gcloud_expenses.retry.Attempt` argument, which it uses to detect
+    that an earlier attempt already committed.  Callers replaying a queued
+    operation pass its idempotency key as ``token``, and ``maybe_committed``
+    if it was sent before.
+    """
+    @functools.wraps(func)
+    def wrapper(employee_id, report_id, *args, **kw):
+        token = kw.pop('token', None)
+        maybe_committed = kw.pop('maybe_committed', False)
+        def _attempt(attempt):
+            with Transaction():
+                attempt.result = func(attempt, employee_id, report_id, *args)
+                attempt.committing = True
+            return attempt.result
+        retry_on, conflicts = _retryable_errors()
+        return call_with_retries(func.__name__.lstrip('_'), _attempt,
+                                 TRANSACTION_RETRY_POLICY, transaction_stats,
+                                 retry_on, conflicts,
+                                 key=(employee_id, report_id), token=token,
+                                 maybe_committed=maybe_committed)
+    return accepts_connection(wrapper)
+
+
+def _get_bucket(connection=None):
     try:
-        return storage.get_bucket(BUCKET_NAME)
-    except NotFound:
-        return storage.create_bucket(BUCKET_NAME)
+        return storage.get_bucket(BUCKET_NAME, connection=connection)
+    except exceptions.NotFound:
+        return storage.create_bucket(BUCKET_NAME, connection=connection)
+
+
+def new_client():
+    """Return a new :class:`gcloud_expenses.clients.Client`.
+
+    Its datastore connection and storage bucket share one authorized,
+    keep-alive HTTP session.
+    """
+    initialize_gcloud()
+    credentials = importlib.import_module('gcloud.credentials')
+    scoped = credentials.get_credentials().create_scoped(
+        tuple(datastore.SCOPE) + tuple(storage.SCOPE))
+    http = scoped.authorize(importlib.import_module('httplib2').Http())
+    storage_connection = storage.Connection(storage.get_default_project(),
+                                            http=http)
+    return Client(http, datastore.Connection(http=http),
+                  lambda: _get_bucket(storage_connection))
 
 
 def _get_employee(employee_id, create=True):
@@ -72,6 +260,7 @@ def _employee_info(employee):
                     '%s %s' % (first_name, last_name) or employee_id),
         'created': created and created.strftime('%Y-%m-%d'),
         'updated': updated and updated.strftime('%Y-%m-%d'),
+        'last_modified': updated,
         }
 
 
@@ -121,20 +310,97 @@ def _report_info(report):
         'status': status,
         'description': report.get('description', ''),
         'memo': memo,
+        'last_modified': report['updated'],
+        }
+
+
+def _report_total(rows):
+    # Rows may be typed (see 'schema'), stored floats, or legacy strings.
+    total = decimal.Decimal(0)
+    for row in rows:
+        try:
+            quantity = decimal.Decimal(str(row.get('Quantity') or 1))
+            price = decimal.Decimal(str(row.get('Price') or 0))
+        except decimal.InvalidOperation:
+            continue
+        total += quantity * price
+    return float(total.quantize(decimal.Decimal('0.01')))
+
+
+def _review_queue_key(report):
+    # Each pending report owns a single queue entry, kept in the report's
+    # entity group so that it can be maintained in the same transaction.
+    path = list(report.key.flat_path) + [REVIEW_QUEUE_KIND, 'pending']
+    return Key(*path)
+
+
+def _enqueue_report(report, total):
+    path = report.key.path
+    entry = Entity(_review_queue_key(report))
+    entry['employee_id'] = path[0]['name']
+    entry['report_id'] = path[1]['name']
+    entry['description'] = report.get('description', '')
+    entry['submitted'] = report['created']
+    entry['total'] = total
+    datastore.put([entry])
+
+
+def _dequeue_report(report):
+    datastore.delete([_review_queue_key(report)])
+
+
+def _review_queue_info(entry):
+    return {
+        'employee_id': entry['employee_id'],
+        'report_id': entry['report_id'],
+        'description': entry.get('description', ''),
+        'submitted': entry['submitted'].strftime('%Y-%m-%d %H:%M'),
+        'total': '%.2f' % entry['total'],
         }
 
 
+def _index_report(report, rows):
+    # Write the report's search terms and charge fingerprints;  see 'search'
+    # and 'duplicates'.
+    report_path = list(report.key.flat_path)
+    entities = []
+    for term, postings in build_postings(rows).items():
+        entity = Entity(Key(*(report_path + [SEARCH_TERM_KIND, term])))
+        entity['term'] = term
+        for prop, numbers in postings.items():
+            entity[prop] = numbers
+        entities.append(entity)
+    for fingerprint, numbers in build_fingerprints(rows).items():
+        key = Key(*(report_path + [FINGERPRINT_KIND, fingerprint]))
+        entity = Entity(key)
+        entity['fingerprint'] = fingerprint
+        entity['items'] = numbers
+        entities.append(entity)
+    for start in range(0, len(entities), MAX_BATCH):
+        datastore.put(entities[start:start + MAX_BATCH])
+
+
+def _unindex_report(report):
+    keys = []
+    for kind in (SEARCH_TERM_KIND, FINGERPRINT_KIND):
+        query = Query(kind=kind)
+        query.ancestor = report.key
+        keys.extend([x.key for x in query.fetch()])
+    for start in range(0, len(keys), MAX_BATCH):
+        datastore.delete(keys[start:start + MAX_BATCH])
+
+
 def _purge_report_items(report):
     # Delete any existing items belonging to report
     count = 0
     for item in _fetch_report_items(report):
         datastore.delete([item.key])
         count += 1
+    _unindex_report(report)
     return count
 
 
 def _upsert_report(employee_id, report_id, rows):
-    _get_employee(employee_id)  # force existence
     report = _get_report(employee_id, report_id)
     _purge_report_items(report)
     # Add items based on rows.
@@ -144,22 +410,60 @@ def _upsert_report(employee_id, report_id, rows):
         key = Key(*path)
         item = Entity(key)
         for k, v in row.items():
-            item[k] = v
+            item[k] = to_datastore(v)
         datastore.put([item])
+    _index_report(report, rows)
     return report
 
 
-def initialize_gcloud():
-    datastore.set_defaults()
-    storage.set_defaults()
+@accepts_connection
+def ensure_employee(employee_id):
+    """Ensure that an employee entity exists, creating it if needed.
 
+    Skips the datastore entirely for recently-seen employees.
+    """
+    if employee_id not in known_employees:
+        _get_employee(employee_id)
+        known_employees.set(employee_id, True)
 
-def list_employees():
+
+@accepts_connection
+def ensure_employees(employee_ids):
+    """Ensure that employee entities exist for all of ``employee_ids``.
+
+    Intended for imports:  looks up and creates missing employees in batches,
+    rather than one at a time.  Returns the number of employees created.
+    """
+    unknown = sorted(set([employee_id for employee_id in employee_ids
+                          if employee_id not in known_employees]))
+    created = 0
+    for start in range(0, len(unknown), MAX_BATCH):
+        chunk = unknown[start:start + MAX_BATCH]
+        found = datastore.get([Key('Employee', x) for x in chunk])
+        existing = set([employee.key.path[0]['name'] for employee in found])
+        now = datetime.datetime.utcnow()
+        missing = []
+        for employee_id in chunk:
+            if employee_id not in existing:
+                employee = Entity(Key('Employee', employee_id))
+                employee['created'] = employee['updated'] = now
+                missing.append(employee)
+        if missing:
+            datastore.put(missing)
+            created += len(missing)
+        for employee_id in chunk:
+            known_employees.set(employee_id, True)
+    return created
+
+
+@accepts_connection
+def list_employees(limit=None, offset=0):
     query = Query(kind='Employee')
-    for employee in query.fetch():
+    for employee in query.fetch(limit=limit, offset=offset):
         yield _employee_info(employee)
 
 
+@accepts_connection
 def get_employee_info(employee_id):
     employee = _get_employee(employee_id, False)
     if employee is None:
@@ -169,100 +473,473 @@ def get_employee_info(employee_id):
                        for report in _fetch_reports(employee)]
     return info
 
-def list_reports(employee_id=None, status=None):
+@accepts_connection
+def list_reports(employee_id=None, status=None, limit=None, offset=0):
     query = Query(kind='Expense Report')
     if employee_id is not None:
         key = Key('Employee', employee_id)
         query.ancestor = key
     if status is not None:
         query.add_filter('status', '=', status)
-    for report in query.fetch():
+    for report in query.fetch(limit=limit, offset=offset):
         yield _report_info(report)
 
 
-def get_report_info(employee_id, report_id):
+@accepts_connection
+def next_reports_to_review(limit=10, offset=0):
+    """Yield the next ``limit`` pending reports, oldest submission first.
+
+    Ties are broken by report total, largest first.  Reads the review queue
+    maintained by the report functions, rather than scanning all reports.
+    """
+    query = Query(kind=REVIEW_QUEUE_KIND)
+    query.order = ['submitted', '-total']
+    for entry in query.fetch(limit=limit, offset=offset):
+        yield _review_queue_info(entry)
+
+
+@accepts_connection
+def rebuild_review_queue():
+    """Recreate review queue entries for all pending reports.
+
+    Needed only for reports submitted before the queue existed.  Returns
+    the number of entries written.
+    """
+    query = Query(kind='Expense Report')
+    query.add_filter('status', '=', 'pending')
+    count = 0
+    for report in query.fetch():
+        with Transaction():
+            rows = list(_fetch_report_items(report))
+            _enqueue_report(report, _report_total(rows))
+        count += 1
+    return count
+
+
+@accepts_connection
+def rebuild_search_index():
+    """Recreate the search terms and charge fingerprints of all reports.
+
+    Needed only for reports submitted before the index existed.  Returns
+    the number of reports indexed.
+    """
+    query = Query(kind='Expense Report')
+    count = 0
+    for report in query.fetch():
+        with Transaction():
+            _unindex_report(report)
+            _index_report(report, list(_fetch_report_items(report)))
+        count += 1
+    return count
+
+
+def _get_many(keys):
+    found = []
+    for start in range(0, len(keys), MAX_BATCH):
+        found.extend(datastore.get(keys[start:start + MAX_BATCH]))
+    return dict([(tuple(x.key.flat_path), x) for x in found])
+
+
+@accepts_connection
+def search_expenses(text, limit=20, offset=0):
+    """Find expense items whose vendor or memo contains the terms of ``text``.
+
+    Return a mapping of ranked ``items`` and ``reports`` hits, each page
+    selected by ``limit`` / ``offset``, plus the total number of each.
+    Items matching more of the terms rank first;  see 'search.Hits'.
+    """
+    hits = Hits()
+    for term in tokenize(text):
+        query = Query(kind=SEARCH_TERM_KIND)
+        query.add_filter('term', '=', term)
+        for entity in query.fetch():
+            path = entity.key.path
+            hits.add(path[0]['name'], path[1]['name'], entity)
+    end = None if limit is None else offset + limit
+    ranked_items = hits.items()
+    ranked_reports = hits.reports()
+
+    item_page = ranked_items[offset:end]
+    entities = _get_many([Key('Employee', e, 'Expense Report', r,
+                              'Expense Item', n)
+                          for e, r, n, _, _ in item_page])
+    items = []
+    for e, r, n, matched, score in item_page:
+        item = entities.get(('Employee', e, 'Expense Report', r,
+                             'Expense Item', n))
+        if item is None:  # deleted since indexed
+            continue
+        info = from_datastore(item)
+        info.update({'employee_id': e, 'report_id': r, 'item': n,
+                     'matched': matched, 'score': score})
+        items.append(info)
+
+    report_page = ranked_reports[offset:end]
+    entities = _get_many([Key('Employee', e, 'Expense Report', r)
+                          for e, r, _, _, _ in report_page])
+    reports = []
+    for e, r, matched, score, count in report_page:
+        report = entities.get(('Employee', e, 'Expense Report', r))
+        if report is None:
+            continue
+        info = _report_info(report)
+        info.update({'matched': matched, 'score': score, 'items': count})
+        reports.append(info)
+
+    return {
+        'query': text,
+        'terms': tokenize(text),
+        'limit': limit,
+        'offset': offset,
+        'total_items': len(ranked_items),
+        'total_reports': len(ranked_reports),
+        'items': items,
+        'reports': reports,
+        }
+
+
+@accepts_connection
+def find_duplicate_items(employee_id, report_id, rows):
+    """Find charges in ``rows`` with the same date, vendor and amount as
+    charges on other reports.
+
+    Return a list of mappings, one per item and other report, in item order.
+    Uses the fingerprint index, at one query per distinct charge.
+    """
+    found = []
+    fingerprints = sorted(build_fingerprints(rows).items(),
+                          key=lambda x: x[1][0])
+    for fingerprint, numbers in fingerprints:
+        query = Query(kind=FINGERPRINT_KIND)
+        query.add_filter('fingerprint', '=', fingerprint)
+        for entity in query.fetch():
+            path = entity.key.path
+            other = (path[0]['name'], path[1]['name'])
+            if other == (employee_id, report_id):
+                continue
+            date, vendor, cents = fingerprint.split('|')
+            for number in numbers:
+                found.append({
+                    'item': number,
+                    'Date': date,
+                    'Vendor': rows[number - 1].get('Vendor'),
+                    'amount': decimal.Decimal(cents) / 100,
+                    'other_employee_id': other[0],
+                    'other_report_id': other[1],
+                    'other_items': list(entity['items']),
+                    })
+    return found
+
+
+def _vendor_partition(row, partitions):
+    vendor = normalize_vendor(row.get('Vendor')).encode('utf-8')
+    return (zlib.crc32(vendor) & 0xffffffff) % partitions
+
+
+def _item_ref(item):
+    path = item.key.path
+    return (path[0]['name'], path[1]['name'], path[2]['id'])
+
+
+def _scan_partition(scanner, records):
+    # ``records`` yields ``(ref, row)``, ``ref`` being the item's
+    # (employee, report, item number).
+    for ref, row in records:
+        for other, _ in scanner.add(ref, ref[:2], row):
+            info = from_datastore(row)
+            info.update({
+                'employee_id': ref[0],
+                'report_id': ref[1],
+                'item': ref[2],
+                'other_employee_id': other[0],
+                'other_report_id': other[1],
+                'other_item': other[2],
+                })
+            yield info
+
+
+@accepts_connection
+def scan_duplicates(date_tolerance=0, cents_tolerance=0, partitions=1):
+    """Yield pairs of near-identical charges on different reports.
+
+    Charges match if their vendors are the same, and their dates and amounts
+    are within the given tolerances (days, cents);  see
+    'duplicates.DuplicateScanner'.  The items are read once.  With several
+    partitions, they are first spilled to temporary files, one per vendor
+    partition, which are then scanned one at a time:  only one partition's
+    scanner is held in memory.
+    """
+    records = ((_item_ref(item), dict(item))
+               for item in Query(kind='Expense Item').fetch())
+    if partitions <= 1:
+        scanner = DuplicateScanner(date_tolerance, cents_tolerance)
+        for info in _scan_partition(scanner, records):
+            yield info
+        return
+    spill_dir = tempfile.mkdtemp(prefix='scan-duplicates-')
+    try:
+        writers = [ChunkWriter(spill_dir, 'partition-%d' % partition)
+                   for partition in range(partitions)]
+        for ref, row in records:
+            writers[_vendor_partition(row, partitions)].write(
+                {'ref': ref, 'row': row})
+        spilled = [writer.close() for writer in writers]
+        for chunks in spilled:
+            scanner = DuplicateScanner(date_tolerance, cents_tolerance)
+            partition = ((tuple(record['ref']), record['row'])
+                         for chunk in chunks
+                         for record in read_chunk(spill_dir, chunk, False))
+            for info in _scan_partition(scanner, partition):
+                yield info
+            # Release this partition's grid before building the next.
+            del scanner, partition
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+@accepts_connection
+def get_report_info(employee_id, report_id, items=True):
     report = _get_report(employee_id, report_id, False)
     if report is None:
         raise NoSuchReport()
     info = _report_info(report)
-    info['items'] = [dict(x) for x in _fetch_report_items(report)]
+    if items:
+        info['items'] = list(map(from_datastore, _fetch_report_items(report)))
     return info
 
 
-def create_report(employee_id, report_id, rows, description):
-    with Transaction():
-        if _get_report(employee_id, report_id, False) is not None:
-            raise DuplicateReport()
-        report = _upsert_report(employee_id, report_id, rows)
-        report['status'] = 'pending'
-        if description is not None:
-            report['description'] = description
-        report['created'] = report['updated'] = datetime.datetime.utcnow()
-        datastore.put([report])
+@accepts_connection
+def list_report_items(employee_id, report_id, limit=None, offset=0):
+    query = Query(kind='Expense Item')
+    query.ancestor = Key('Employee', employee_id, 'Expense Report', report_id)
+    for item in query.fetch(limit=limit, offset=offset):
+        yield from_datastore(item)
 
 
-def update_report(employee_id, report_id, rows, description):
-    with Transaction():
-        report = _get_report(employee_id, report_id, False)
-        if report is None:
-            raise NoSuchReport()
-        if report['status'] != 'pending':
-            raise BadReportStatus(report['status'])
-        _upsert_report(employee_id, report_id, rows)
-        if description is not None:
-            report['description'] = description
-        report['updated'] = datetime.datetime.utcnow()
-        datastore.put([report])
+@accepts_connection
+def create_report(employee_id, report_id, rows, description, token=None,
+                  maybe_committed=False):
+    # Create the employee (if needed) outside the report's transaction.
+    ensure_employee(employee_id)
+    _create_report(employee_id, report_id, rows, description, token=token,
+                   maybe_committed=maybe_committed)
 
 
-def delete_report(employee_id, report_id, force):
-    with Transaction():
-        report = _get_report(employee_id, report_id, False)
-        if report is None:
-            raise NoSuchReport()
-        if report['status'] != 'pending' and not force:
-            raise BadReportStatus(report['status'])
-        count = _purge_report_items(report)
-        datastore.delete([report.key])
+@_retrying_transaction
+def _create_report(attempt, employee_id, report_id, rows, description):
+    existing = _get_report(employee_id, report_id, False)
+    if existing is not None:
+        if attempt.already_applied(existing):
+            return
+        raise DuplicateReport()
+    report = _upsert_report(employee_id, report_id, rows)
+    report['status'] = 'pending'
+    if description is not None:
+        report['description'] = description
+    report['created'] = report['updated'] = datetime.datetime.utcnow()
+    attempt.mark(report)
+    datastore.put([report])
+    _enqueue_report(report, _report_total(rows))
+
+
+@_retrying_transaction
+def update_report(attempt, employee_id, report_id, rows, description):
+    report = _get_report(employee_id, report_id, False)
+    if report is None:
+        raise NoSuchReport()
+    if attempt.already_applied(report):
+        return
+    if report['status'] != 'pending':
+        raise BadReportStatus(report['status'])
+    _upsert_report(employee_id, report_id, rows)
+    if description is not None:
+        report['description'] = description
+    report['updated'] = datetime.datetime.utcnow()
+    attempt.mark(report)
+    datastore.put([report])
+    _enqueue_report(report, _report_total(rows))
+
+
+@_retrying_transaction
+def delete_report(attempt, employee_id, report_id, force):
+    report = _get_report(employee_id, report_id, False)
+    if report is None:
+        if attempt.maybe_committed:
+            return attempt.committed_result
+        raise NoSuchReport()
+    if report['status'] != 'pending' and not force:
+        raise BadReportStatus(report['status'])
+    count = _purge_report_items(report)
+    _dequeue_report(report)
+    datastore.delete([report.key])
     return count
 
 
-def approve_report(employee_id, report_id, check_number):
-    with Transaction():
-        report = _get_report(employee_id, report_id, False)
-        if report is None:
-            raise NoSuchReport()
-        if report['status'] != 'pending':
-            raise BadReportStatus(report['status'])
-        report['updated'] = datetime.datetime.utcnow()
-        report['status'] = 'paid'
-        report['check_number'] = check_number
-        datastore.put([report])
+@_retrying_transaction
+def approve_report(attempt, employee_id, report_id, check_number):
+    report = _get_report(employee_id, report_id, False)
+    if report is None:
+        raise NoSuchReport()
+    if attempt.already_applied(report):
+        return
+    if report['status'] != 'pending':
+        raise BadReportStatus(report['status'])
+    report['updated'] = datetime.datetime.utcnow()
+    report['status'] = 'paid'
+    report['check_number'] = check_number
+    attempt.mark(report)
+    datastore.put([report])
+    _dequeue_report(report)
 
 
-def reject_report(employee_id, report_id, reason):
-    with Transaction():
-        report = _get_report(employee_id, report_id, False)
-        if report is None:
-            raise NoSuchReport()
-        if report['status'] != 'pending':
-            raise BadReportStatus(report['status'])
-        report['updated'] = datetime.datetime.utcnow()
-        report['status'] = 'rejected'
-        report['reason'] = reason
-        datastore.put([report])
+@_retrying_transaction
+def reject_report(attempt, employee_id, report_id, reason):
+    report = _get_report(employee_id, report_id, False)
+    if report is None:
+        raise NoSuchReport()
+    if attempt.already_applied(report):
+        return
+    if report['status'] != 'pending':
+        raise BadReportStatus(report['status'])
+    report['updated'] = datetime.datetime.utcnow()
+    report['status'] = 'rejected'
+    report['reason'] = reason
+    attempt.mark(report)
+    datastore.put([report])
+    _dequeue_report(report)
 
 
-def upload_receipt(employee_id, report_id, filename, bucket=None):
+def _with_transfer_retries(name, func, key):
+    # Retry transient errors and checksum mismatches;  once out of retries,
+    # raise the mismatch itself.
+    retry_on = _retryable_errors()[0] + (ChecksumMismatch,)
+    try:
+        return call_with_retries(name, func, TRANSFER_RETRY_POLICY,
+                                 transfer_stats, retry_on, key=key)
+    except RetriesExhausted as e:
+        if isinstance(e.last_error, ChecksumMismatch):
+            raise e.last_error
+        raise
+
+
+def _verified_upload(bucket, blob, filename):
+    # Hash the file as it is sent, then compare with what storage kept.
+    def _attempt(attempt):
+        algorithms = ['md5', 'crc32c'] if FAST_CRC32C else ['md5']
+        digests = Digests(algorithms)
+        with open(filename, 'rb') as f:
+            reader = HashingReader(f, digests)
+            blob.upload_from_file(reader)
+            if reader.hashed < os.fstat(f.fileno()).st_size:
+                # The upload skipped part of the file:  read it again.
+                digests = Digests(algorithms)
+                f.seek(0)
+                for block in iter(lambda: f.read(65536), b''):
+                    digests.update(block)
+        return verify(blob.name, digests,
+                      stored_hashes(bucket.get_blob(blob.name)))
+    try:
+        return _with_transfer_retries('upload_receipt', _attempt, blob.name)
+    except ChecksumMismatch:
+        # Don't leave a corrupt receipt behind.
+        blob.delete()
+        raise
+
+
+def _write_verified(name, stored, filename, fill):
+    # Hash the data as ``fill(f)`` writes it;  only verified data replaces
+    # ``filename``.  If ``filename`` is None, the data is discarded.
+    digests = Digests(algorithms_for(stored))
+    if filename is None:
+        fill(HashingWriter(None, digests))
+        return verify(name, digests, stored)
+    partial = filename + '.part'
+    try:
+        with open(partial, 'wb') as f:
+            fill(HashingWriter(f, digests))
+        compared = verify(name, digests, stored)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.rename(partial, filename)
+    return compared
+
+
+def _verified_download(blob, filename):
+    stored = stored_hashes(blob)
+
+    def _attempt(attempt):
+        return _write_verified(blob.name, stored, filename,
+                               blob.download_to_file)
+    return _with_transfer_retries('download_receipt', _attempt, blob.name)
+
+
+def _get_receipt_cache():
+    """Return the shared receipt cache, or None if disabled.
+    """
+    if not _receipt_cache:
+        cache = None
+        if RECEIPT_CACHE_BYTES > 0:
+            cache = DiskLRUCache(RECEIPT_CACHE_DIR, RECEIPT_CACHE_BYTES)
+        _receipt_cache.append(cache)
+    return _receipt_cache[0]
+
+
+def _receipt_cache_key(blob):
+    # The generation (or else the etag) changes whenever the object is
+    # rewritten, so that a stale copy is never hit, merely evicted.
+    properties = getattr(blob, 'properties', None) or {}
+    for attr in ('generation', 'etag'):
+        version = getattr(blob, attr, None) or properties.get(attr)
+        if version:
+            return '%s#%s' % (blob.name, version)
+    return None
+
+
+def _cached_download(blob, filename):
+    # Serve from the receipt cache if it holds this version of the object,
+    # checking the copy against the object's checksums like a download.
+    cache = _get_receipt_cache()
+    key = _receipt_cache_key(blob)
+    if cache is None or key is None:
+        return _verified_download(blob, filename)
+    cached = cache.open(key)
+    if cached is not None:
+        try:
+            with cached:
+                return _write_verified(
+                    blob.name, stored_hashes(blob), filename,
+                    lambda f: shutil.copyfileobj(cached, f))
+        except ChecksumMismatch:
+            cache.discard(key)
+    compared = _verified_download(blob, filename)
+    cache.put(key, filename)
+    return compared
+
+
+def _original_blob_name(employee_id, report_id, basename):
+    # Kept below the report's "directory", so that 'list_receipts' skips it.
+    return '%s/%s/%s/%s' % (employee_id, report_id, ORIGINALS, basename)
+
+
+@traced_function('storage.upload')
+def upload_receipt(employee_id, report_id, filename, bucket=None,
+                   name=None, original=None):
     if bucket is None:
         bucket = _get_bucket()
-    basename = os.path.split(filename)[1]
+    basename = name or os.path.split(filename)[1]
     blob = bucket.new_blob('%s/%s/%s' % (employee_id, report_id, basename))
     if blob in bucket:
         raise DuplicateReceipt(blob.name)
-    blob.upload_from_filename(filename)
+    _verified_upload(bucket, blob, filename)
+    if original is not None:
+        blob = bucket.new_blob(
+            _original_blob_name(employee_id, report_id, basename))
+        _verified_upload(bucket, blob, original)
 
 
+@traced_function('storage.delete')
 def delete_receipt(employee_id, report_id, filename, bucket=None):
     if bucket is None:
         bucket = _get_bucket()
@@ -271,8 +948,13 @@ def delete_receipt(employee_id, report_id, filename, bucket=None):
     if blob not in bucket:
         raise NoSuchReceipt(blob.name)
     blob.delete()
+    original = bucket.new_blob(
+        _original_blob_name(employee_id, report_id, basename))
+    if original in bucket:
+        original.delete()
 
 
+@traced_function('storage.list')
 def list_receipts(employee_id, report_id, bucket=None):
     if bucket is None:
         bucket = _get_bucket()
@@ -282,11 +964,283 @@ def list_receipts(employee_id, report_id, bucket=None):
         yield name.rsplit('/', 1)[-1]
 
 
-def download_receipt(employee_id, report_id, filename, bucket=None):
+@traced_function('storage.download')
+def download_receipt(employee_id, report_id, filename, bucket=None,
+                     original=False):
     if bucket is None:
         bucket = _get_bucket()
     basename = os.path.split(filename)[1]
-    blob = bucket.new_blob('%s/%s/%s' % (employee_id, report_id, basename))
-    if blob not in bucket:
-        raise NoSuchReceipt(blob.name)
-    blob.download_to_filename(filename)
+    if original:
+        name = _original_blob_name(employee_id, report_id, basename)
+    else:
+        name = '%s/%s/%s' % (employee_id, report_id, basename)
+    blob = bucket.get_blob(name)
+    if blob is None:
+        raise NoSuchReceipt(name)
+    _cached_download(blob, filename)
+
+
+def verify_receipts(employee_id, report_id, bucket=None, workers=8):
+    """Check a report's receipts (and originals) against their checksums.
+
+    Receipts are downloaded concurrently, each worker over a client of its
+    own, and hashed as they stream in, without being stored.  Return a list
+    of ``(name, compared, error)``:  ``compared`` is the number of checksums
+    which matched, and ``error`` the exception raised, if any (e.g.
+    :exc:`ChecksumMismatch`).
+    """
+    if bucket is None:
+        bucket = _get_bucket()
+    prefix = '%s/%s/' % (employee_id, report_id)
+    blobs = list(bucket.iterator(prefix=prefix))
+    clients = ThreadClients(new_client)
+
+    def _verify(blob):
+        # The same object, with its stored hashes, over the thread's client.
+        blob = type(blob)(blob.name, bucket=clients().bucket,
+                          properties=blob.properties)
+        return _verified_download(blob, None)
+
+    results = run_batch(_verify, blobs, workers=workers)
+    return [(urllib.unquote(x.item.name)[len(prefix):], x.value or 0,
+             x.error) for x in results]
+
+
+def _utc_naive(when):
+    # The datastore returns timezone-aware datetimes;  backups compare them
+    # with naive UTC ones.
+    if when is None or when.utcoffset() is None:
+        return when
+    return (when - when.utcoffset()).replace(tzinfo=None)
+
+
+def _blob_updated(blob):
+    # Depending on the library version, a string (RFC 3339) or a datetime.
+    updated = getattr(blob, 'updated', None)
+    if isinstance(updated, datetime.datetime):
+        return _utc_naive(updated)
+    try:
+        return datetime.datetime.strptime(updated[:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+
+def _backup_employee(writer, counts, employee, since, bucket):
+    employee_id = employee.key.path[0]['name']
+    reports = list(_fetch_reports(employee))
+    writer.write({
+        'type': 'employee',
+        'employee_id': employee_id,
+        'properties': dict(employee),
+        'report_ids': [x.key.path[1]['name'] for x in reports],
+        })
+    counts['employee'] = counts.get('employee', 0) + 1
+    changed = [x for x in reports
+               if since is None or _utc_naive(x['updated']) > since]
+    if since is None:
+        # One query for all of the employee's items, rather than per report.
+        query = Query(kind='Expense Item')
+        query.ancestor = employee.key
+        by_report = {}
+        for item in query.fetch():
+            by_report.setdefault(item.key.path[1]['name'], []).append(item)
+    for report in changed:
+        report_id = report.key.path[1]['name']
+        if since is None:
+            items = by_report.get(report_id, [])
+        else:
+            items = list(_fetch_report_items(report))
+        items = sorted([(x.key.path[2]['id'], dict(x)) for x in items])
+        writer.write({
+            'type': 'report',
+            'employee_id': employee_id,
+            'report_id': report_id,
+            'properties': dict(report),
+            'items': [{'id': x, 'properties': y} for x, y in items],
+            })
+        counts['report'] = counts.get('report', 0) + 1
+        counts['item'] = counts.get('item', 0) + len(items)
+    if bucket is None:
+        return
+    changed_ids = set([x.key.path[1]['name'] for x in changed])
+    # One listing per employee, rather than per report.
+    for blob in bucket.iterator(prefix='%s/' % employee_id):
+        name = urllib.unquote(blob.name)
+        parts = name.split('/', 2)
+        if len(parts) != 3:
+            continue
+        _, report_id, filename = parts
+        updated = _blob_updated(blob)
+        if (since is not None and report_id not in changed_ids
+                and updated is not None and updated <= since):
+            continue
+        data = blob.download_as_string()
+        writer.write({
+            'type': 'receipt',
+            'employee_id': employee_id,
+            'report_id': report_id,
+            'filename': filename,
+            'data': base64.b64encode(data).decode('ascii'),
+            })
+        counts['receipt'] = counts.get('receipt', 0) + 1
+        counts['receipt_bytes'] = counts.get('receipt_bytes', 0) + len(data)
+
+
+def _merge_results(results):
+    # Sum the per-worker counts;  raise the first error, once all are done.
+    counts = {}
+    for result in results:
+        if not result.ok:
+            raise result.error
+        for name, value in result.value.items():
+            counts[name] = counts.get(name, 0) + value
+    return counts
+
+
+def backup_expenses(directory, since=None, shards=8, receipts=True,
+                    chunk_bytes=CHUNK_BYTES):
+    """Write a snapshot of employees, reports, items and receipts.
+
+    Employees are split across ``shards`` workers, each streaming its
+    records into chunks of its own (see 'archive'), over a client of its
+    own.  If ``since`` (a UTC datetime) is passed, the backup is
+    incremental:  it holds only the reports updated after that time, and
+    the receipts uploaded after it or belonging to those reports.  Every
+    employee's current report IDs are written regardless, so that a restore
+    can drop deleted reports.
+
+    Return the manifest, written once all shards are complete.
+    """
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        raise ArchiveError('Backup already exists: %s' % directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    started = datetime.datetime.utcnow()
+    since = _utc_naive(since)
+    employees = list(Query(kind='Employee').fetch())
+    clients = ThreadClients(new_client)
+    chunks = [None] * shards
+
+    def _backup_shard(number):
+        client = clients()
+        bucket = client.bucket if receipts else None
+        writer = ChunkWriter(directory, 'shard%03d' % number, chunk_bytes)
+        counts = {}
+        previous = activate(client.connection)
+        try:
+            for employee in employees[number::shards]:
+                _backup_employee(writer, counts, employee, since, bucket)
+        finally:
+            activate(previous)
+            chunks[number] = writer.close()
+        return counts
+
+    results = run_batch(_backup_shard, list(range(shards)), workers=shards)
+    counts = _merge_results(results)
+    manifest = {
+        'started': format_timestamp(started),
+        'since': since and format_timestamp(since),
+        'receipts': receipts,
+        'counts': counts,
+        'chunks': [chunk for shard in chunks for chunk in shard],
+        }
+    write_manifest(directory, manifest)
+    return manifest
+
+
+@_retrying_transaction
+def _restore_report(attempt, employee_id, report_id, properties, items):
+    report = _get_report(employee_id, report_id)
+    _purge_report_items(report)
+    for name in list(report.keys()):
+        del report[name]
+    for name, value in properties.items():
+        report[name] = value
+    report_path = list(report.key.flat_path)
+    entities = []
+    for item in items:
+        entity = Entity(Key(*(report_path + ['Expense Item', item['id']])))
+        for name, value in item['properties'].items():
+            entity[name] = value
+        entities.append(entity)
+    for start in range(0, len(entities), MAX_BATCH):
+        datastore.put(entities[start:start + MAX_BATCH])
+    rows = [x['properties'] for x in items]
+    _index_report(report, rows)
+    datastore.put([report])
+    if report.get('status') == 'pending':
+        _enqueue_report(report, _report_total(rows))
+    else:
+        _dequeue_report(report)
+
+
+def _restore_employee(record, prune):
+    employee_id = record['employee_id']
+    employee = Entity(Key('Employee', employee_id))
+    for name, value in record['properties'].items():
+        employee[name] = value
+    datastore.put([employee])
+    known_employees.set(employee_id, True)
+    if not prune:
+        return 0
+    keep = set(record['report_ids'])
+    pruned = 0
+    for report in list(_fetch_reports(employee)):
+        report_id = report.key.path[1]['name']
+        if report_id not in keep:
+            delete_report(employee_id, report_id, True)
+            pruned += 1
+    return pruned
+
+
+def _restore_records(records, prune, bucket):
+    counts = {}
+    for record in records:
+        kind = record['type']
+        if kind == 'employee':
+            pruned = _restore_employee(record, prune)
+            counts['pruned'] = counts.get('pruned', 0) + pruned
+        elif kind == 'report':
+            _restore_report(record['employee_id'], record['report_id'],
+                            record['properties'], record['items'])
+            counts['item'] = counts.get('item', 0) + len(record['items'])
+        elif kind == 'receipt':
+            if bucket is None:
+                continue
+            blob = bucket.new_blob('%s/%s/%s' % (
+                record['employee_id'], record['report_id'],
+                record['filename']))
+            blob.upload_from_string(base64.b64decode(record['data']))
+        counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+
+def restore_expenses(directory, workers=8, prune=False, receipts=True):
+    """Restore a backup written by :func:`backup_expenses`.
+
+    Every chunk's checksum is verified before anything is written;  chunks
+    are then restored by up to ``workers`` threads, each over a client of
+    its own.  Restored reports replace any existing ones, with their items,
+    search terms and review queue entries.  If ``prune`` is true, reports
+    absent from the backup are deleted.  Restore a chain of incremental
+    backups oldest first.
+
+    Return counts of the records restored, by type.
+    """
+    manifest = read_manifest(directory)
+    for chunk in manifest['chunks']:
+        verify_chunk(directory, chunk)
+    clients = ThreadClients(new_client)
+
+    def _restore_chunk(chunk):
+        client = clients()
+        previous = activate(client.connection)
+        try:
+            return _restore_records(
+                read_chunk(directory, chunk, verify=False), prune,
+                client.bucket if receipts else None)
+        finally:
+            activate(previous)
+
+    results = run_batch(_restore_chunk, manifest['chunks'], workers=workers)
+    return _merge_results(results)
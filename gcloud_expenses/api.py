@@ -0,0 +1,225 @@
+import datetime
+import decimal
+import json
+
+try:
+    from urllib.parse import urlencode
+except ImportError:  # pragma: no cover
+    from urllib import urlencode
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from . import NoSuchEmployee
+from . import NoSuchReport
+from . import get_employee_info
+from . import get_report_info
+from . import list_employees
+from . import list_report_items
+from . import list_reports
+from . import search_expenses
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+BUFFER_SIZE = 8192
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError('Not JSON serializable: %r' % (value,))
+
+
+# The stdlib encoder uses its C accelerator when ``indent`` is not set;
+# reuse one instance rather than building one per record.
+_encoder = json.JSONEncoder(separators=(',', ':'), default=_default)
+encode = _encoder.encode
+
+
+def _int_param(request, name, default, maximum=None):
+    value = request.params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise HTTPBadRequest('Invalid %s: %s' % (name, value))
+    if value < 0:
+        raise HTTPBadRequest('Invalid %s: %s' % (name, value))
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def get_page(request, default_limit=DEFAULT_LIMIT, max_limit=MAX_LIMIT):
+    """Return ``(limit, offset)`` from the request's query string.
+    """
+    return (_int_param(request, 'limit', default_limit, max_limit),
+            _int_param(request, 'offset', 0))
+
+
+def next_page_url(request, limit, offset, more):
+    """Return the URL of the page after ``offset``, or None if it is last.
+    """
+    if not more or not limit:
+        return None
+    params = dict(request.params, limit=limit, offset=offset + limit)
+    return '%s?%s' % (request.path_url, urlencode(sorted(params.items())))
+
+
+def get_fields(request):
+    """Return the set of fields named by the ``fields`` parameter, or None.
+    """
+    fields = request.params.get('fields')
+    if not fields:
+        return None
+    return set([x.strip() for x in fields.split(',') if x.strip()])
+
+
+def select(record, fields):
+    if fields is None:
+        return record
+    return dict([(k, v) for k, v in record.items() if k in fields])
+
+
+def buffered(chunks, size=BUFFER_SIZE):
+    """Join small text chunks into UTF-8 byte strings of about ``size``.
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield ''.join(pending).encode('utf-8')
+            pending = []
+            pending_size = 0
+    if pending:
+        yield ''.join(pending).encode('utf-8')
+
+
+def iter_json_object(head, key, records):
+    """Encode ``head``, plus a ``key`` array of ``records``, incrementally.
+    """
+    prefix = encode(head)[:-1]
+    if head:
+        prefix += ','
+    yield prefix + encode(key) + ':['
+    separator = ''
+    for record in records:
+        yield separator + encode(record)
+        separator = ','
+    yield ']}'
+
+
+def iter_json_lines(records):
+    for record in records:
+        yield encode(record) + '\n'
+
+
+def json_response(head, key, records):
+    return Response(app_iter=buffered(iter_json_object(head, key, records)),
+                    content_type=JSON_CONTENT_TYPE, charset='utf-8')
+
+
+def ndjson_response(records):
+    return Response(app_iter=buffered(iter_json_lines(records)),
+                    content_type=NDJSON_CONTENT_TYPE, charset='utf-8')
+
+
+@view_config(route_name='api_employees', request_method='GET')
+def api_employees(request):
+    limit, offset = get_page(request)
+    fields = get_fields(request)
+    employees = (select(x, fields) for x in list_employees(
+        limit, offset, connection=request.datastore_connection))
+    return json_response({'limit': limit, 'offset': offset},
+                         'employees', employees)
+
+
+@view_config(route_name='api_employees_ndjson', request_method='GET')
+def api_employees_ndjson(request):
+    limit, offset = get_page(request, None, None)
+    fields = get_fields(request)
+    return ndjson_response(
+        select(x, fields) for x in list_employees(
+            limit, offset, connection=request.datastore_connection))
+
+
+@view_config(route_name='api_employee', request_method='GET')
+def api_employee(request):
+    employee_id = request.matchdict['employee_id']
+    fields = get_fields(request)
+    try:
+        info = get_employee_info(employee_id,
+                                 connection=request.datastore_connection)
+    except NoSuchEmployee:
+        raise HTTPNotFound('No such employee: %s' % employee_id)
+    reports = [select(x, fields) for x in info.pop('reports')]
+    return json_response(info, 'reports', reports)
+
+
+@view_config(route_name='api_reports_ndjson', request_method='GET')
+def api_reports_ndjson(request):
+    limit, offset = get_page(request, None, None)
+    fields = get_fields(request)
+    reports = list_reports(request.params.get('employee_id'),
+                           request.params.get('status'),
+                           limit, offset,
+                           connection=request.datastore_connection)
+    return ndjson_response(select(x, fields) for x in reports)
+
+
+def _report_items_page(request):
+    # Return ``(info, limit, offset, items, next)``:  one page of a report's
+    # items, reading one more than the page to learn if another follows.
+    employee_id = request.matchdict['employee_id']
+    report_id = request.matchdict['report_id']
+    limit, offset = get_page(request)
+    try:
+        info = get_report_info(employee_id, report_id, items=False,
+                               connection=request.datastore_connection)
+    except NoSuchReport:
+        raise HTTPNotFound('No such report: %s/%s' % (employee_id, report_id))
+    items = list(list_report_items(employee_id, report_id, limit + 1, offset,
+                                   connection=request.datastore_connection))
+    next_url = next_page_url(request, limit, offset, len(items) > limit)
+    return info, limit, offset, items[:limit], next_url
+
+
+@view_config(route_name='api_report', request_method='GET')
+def api_report(request):
+    fields = get_fields(request)
+    info, limit, offset, items, next_url = _report_items_page(request)
+    info.update({'limit': limit, 'offset': offset, 'next': next_url})
+    return json_response(info, 'items', (select(x, fields) for x in items))
+
+
+@view_config(route_name='api_report_items_ndjson', request_method='GET')
+def api_report_items_ndjson(request):
+    fields = get_fields(request)
+    info, limit, offset, items, next_url = _report_items_page(request)
+    response = ndjson_response(select(x, fields) for x in items)
+    if next_url is not None:
+        response.headers['Link'] = '<%s>; rel="next"' % next_url
+    return response
+
+
+@view_config(route_name='api_search', request_method='GET')
+def api_search(request):
+    q = request.params.get('q', '').strip()
+    if not q:
+        raise HTTPBadRequest('Specify search text: q')
+    limit, offset = get_page(request)
+    fields = get_fields(request)
+    found = search_expenses(q, limit, offset,
+                            connection=request.datastore_connection)
+    found['reports'] = [select(x, fields) for x in found['reports']]
+    items = [select(x, fields) for x in found.pop('items')]
+    return json_response(found, 'items', items)
@@ -0,0 +1,177 @@
+""" Chunked, compressed, checksummed archives of expense data.
+
+An archive is a directory of gzipped JSON-lines chunks, plus a
+``manifest.json`` listing each chunk with its SHA-256 checksum.  The
+manifest is written last, so that a directory without one is an incomplete
+backup.  Each shard of a backup streams its records into chunks of its
+own, starting a new chunk once ``chunk_bytes`` of records have been
+written, so that shards are written, and later restored, in parallel.
+"""
+import datetime
+import decimal
+import gzip
+import hashlib
+import json
+import os
+
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+CHUNK_BYTES = 64 * 1024 * 1024
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class ArchiveError(ValueError):
+    """An archive is incomplete, or a chunk fails its checksum.
+    """
+
+
+def format_timestamp(value):
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def parse_timestamp(text):
+    """Parse a timestamp, with or without time of day or microseconds.
+    """
+    for fmt in (TIMESTAMP_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Not a YYYY-MM-DD[THH:MM:SS] timestamp: %s' % text)
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': format_timestamp(value)}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.strftime('%Y-%m-%d')}
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    raise TypeError(repr(value))
+
+
+def _decode(mapping):
+    if '__datetime__' in mapping:
+        return parse_timestamp(mapping['__datetime__'])
+    if '__date__' in mapping:
+        return parse_timestamp(mapping['__date__']).date()
+    if '__decimal__' in mapping:
+        return decimal.Decimal(mapping['__decimal__'])
+    return mapping
+
+
+class _HashingFile(object):
+    """Write-through file wrapper, checksumming what is written.
+    """
+    def __init__(self, f):
+        self._f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+
+class ChunkWriter(object):
+    """Stream the records of one shard into a sequence of chunks.
+
+    Chunks are named ``<shard>-<number>.jsonl.gz``;  :meth:`close` returns
+    the manifest entries of the chunks written.
+    """
+    def __init__(self, directory, shard, chunk_bytes=CHUNK_BYTES):
+        self.directory = directory
+        self.shard = shard
+        self.chunk_bytes = chunk_bytes
+        self.chunks = []
+        self._file = self._hashing = self._gzip = None
+        self._records = self._written = 0
+
+    def _open(self):
+        name = '%s-%04d.jsonl.gz' % (self.shard, len(self.chunks))
+        self._file = open(os.path.join(self.directory, name), 'wb')
+        self._hashing = _HashingFile(self._file)
+        self._gzip = gzip.GzipFile(name, 'wb', fileobj=self._hashing)
+        self._records = self._written = 0
+        self.chunks.append({'name': name})
+
+    def _finish(self):
+        self._gzip.close()
+        self._file.close()
+        self.chunks[-1].update({
+            'sha256': self._hashing.sha256.hexdigest(),
+            'bytes': self._hashing.size,
+            'records': self._records,
+            })
+        self._file = self._hashing = self._gzip = None
+
+    def write(self, record):
+        if self._gzip is None:
+            self._open()
+        line = json.dumps(record, default=_encode, sort_keys=True)
+        data = (line + '\n').encode('utf-8')
+        self._gzip.write(data)
+        self._records += 1
+        self._written += len(data)
+        if self._written >= self.chunk_bytes:
+            self._finish()
+
+    def close(self):
+        if self._gzip is not None:
+            self._finish()
+        return self.chunks
+
+
+def _checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def verify_chunk(directory, chunk):
+    """Raise :exc:`ArchiveError` if a chunk is missing or corrupt.
+    """
+    path = os.path.join(directory, chunk['name'])
+    if not os.path.exists(path):
+        raise ArchiveError('Missing chunk: %s' % chunk['name'])
+    if _checksum(path) != chunk['sha256']:
+        raise ArchiveError('Checksum mismatch: %s' % chunk['name'])
+
+
+def read_chunk(directory, chunk, verify=True):
+    """Yield the records of a chunk, verifying its checksum first.
+    """
+    if verify:
+        verify_chunk(directory, chunk)
+    with gzip.open(os.path.join(directory, chunk['name']), 'rb') as f:
+        for line in f:
+            yield json.loads(line.decode('utf-8'), object_hook=_decode)
+
+
+def write_manifest(directory, manifest):
+    """Write the manifest atomically, marking the archive complete.
+    """
+    manifest = dict(manifest, version=FORMAT_VERSION)
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        raise ArchiveError('Not a complete backup: %s' % directory)
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != FORMAT_VERSION:
+        raise ArchiveError('Unknown backup format: %s'
+                           % manifest.get('version'))
+    return manifest
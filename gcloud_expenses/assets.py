@@ -0,0 +1,220 @@
+""" Fingerprinted, precompressed static assets.
+
+Each file under ``gcloud_expenses/static`` is served at a URL containing a
+hash of its contents (e.g. ``/assets/theme.1a2b3c4d5e6f.css``), so that
+browsers and proxies may cache it "forever":  a changed file gets a new URL.
+
+Run the :command:`build_static_assets` script at deployment time to write
+gzip (and, if the ``brotli`` package is installed, brotli) variants of the
+compressible files;  the variant matching the client's ``Accept-Encoding``
+is then served without compressing anything per request.
+"""
+import gzip
+import hashlib
+import mimetypes
+import optparse
+import os
+import sys
+from io import BytesIO
+
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import FileResponse
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+COMPRESSED_DIR = 'compressed'
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+    )
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _content_type(path):
+    content_type, _ = mimetypes.guess_type(path)
+    return content_type or 'application/octet-stream'
+
+
+def _compressible(path):
+    return _content_type(path).startswith(COMPRESSIBLE_TYPES)
+
+
+def fingerprint(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def fingerprinted_name(name, digest):
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, digest, ext)
+
+
+def _compress_gzip(data):
+    # Fix 'mtime', so that rebuilding unchanged files is reproducible.
+    buf = BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+def _compressors():
+    found = []
+    if brotli is not None:
+        found.append(('br', '.br', brotli.compress))
+    found.append(('gzip', '.gz', _compress_gzip))
+    return found
+
+
+class AssetManifest(object):
+    """Map static files to / from their fingerprinted names.
+    """
+    def __init__(self, static_dir=STATIC_DIR):
+        self.static_dir = static_dir
+        self.compressed_dir = os.path.join(static_dir, COMPRESSED_DIR)
+        self.urls = {}   # relative path -> fingerprinted name
+        self.files = {}  # fingerprinted name -> relative path
+        for dirpath, dirnames, filenames in os.walk(static_dir):
+            if dirpath == static_dir and COMPRESSED_DIR in dirnames:
+                dirnames.remove(COMPRESSED_DIR)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+                hashed = fingerprinted_name(name, fingerprint(path))
+                self.urls[name] = hashed
+                self.files[hashed] = name
+
+    def path(self, hashed):
+        return os.path.join(self.static_dir, *self.files[hashed].split('/'))
+
+    def variants(self, hashed):
+        """Return a mapping encoding -> path of precompressed variants.
+        """
+        found = {}
+        for encoding, suffix, _ in _compressors():
+            path = os.path.join(self.compressed_dir,
+                                *(hashed + suffix).split('/'))
+            if os.path.exists(path):
+                found[encoding] = path
+        return found
+
+    def build(self):
+        """Write compressed variants of compressible files.
+
+        Variants are named for the fingerprinted file, so that stale ones
+        are never served.  Return the list of paths written.
+        """
+        written = []
+        for hashed, name in sorted(self.files.items()):
+            if not _compressible(name):
+                continue
+            with open(self.path(hashed), 'rb') as f:
+                data = f.read()
+            for _, suffix, compress in _compressors():
+                target = os.path.join(self.compressed_dir,
+                                      *(hashed + suffix).split('/'))
+                if os.path.exists(target):
+                    continue
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                with open(target + '.tmp', 'wb') as f:
+                    f.write(compressed)
+                os.rename(target + '.tmp', target)
+                written.append(target)
+        return written
+
+
+def choose_encoding(accept_encoding, available):
+    """Pick the best of ``available`` encodings for an Accept-Encoding value.
+
+    Return None for the identity encoding.  Preference among acceptable
+    encodings follows the order of ``available``.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(','):
+        pieces = [x.strip() for x in part.split(';')]
+        coding = pieces[0].lower()
+        q = 1.0
+        for param in pieces[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    for encoding in available:
+        q = qualities.get(encoding, qualities.get('*', 0.0))
+        if q > 0:
+            return encoding
+    return None
+
+
+def asset_url(request, name):
+    """Return the fingerprinted URL for static file ``name``.
+    """
+    manifest = request.registry.asset_manifest
+    hashed = manifest.urls.get(name)
+    if hashed is None:
+        return request.static_url('gcloud_expenses:static/%s' % name)
+    return request.route_url('asset', filename=hashed)
+
+
+def serve_asset(request):
+    manifest = request.registry.asset_manifest
+    hashed = request.matchdict['filename']
+    if hashed not in manifest.files:
+        raise HTTPNotFound()
+    content_type = _content_type(hashed)
+    variants = manifest.variants(hashed)
+    encoding = choose_encoding(
+        request.headers.get('Accept-Encoding'),
+        [x for x, _, _ in _compressors() if x in variants])
+    path = variants[encoding] if encoding else manifest.path(hashed)
+    response = FileResponse(path, request=request, content_type=content_type)
+    if encoding:
+        response.content_encoding = encoding
+    if _compressible(hashed):
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def includeme(config):
+    config.registry.asset_manifest = AssetManifest()
+    config.add_route('asset', '/assets/{filename:.+}')
+    config.add_view(serve_asset, route_name='asset', request_method='GET')
+    config.add_request_method(asset_url, 'asset_url')
+
+
+def main(argv=sys.argv[1:]):
+    parser = optparse.OptionParser(
+        usage="%prog [OPTIONS]",
+        description="Write compressed variants of the static assets.")
+    parser.add_option(
+        '-d', '--static-dir',
+        action='store',
+        dest='static_dir',
+        default=STATIC_DIR,
+        help="Directory containing the static assets")
+    options, _ = parser.parse_args(argv)
+    if brotli is None:
+        sys.stdout.write("Note: 'brotli' not installed, writing gzip only\n")
+    for path in AssetManifest(options.static_dir).build():
+        sys.stdout.write('Wrote: %s\n' % path)
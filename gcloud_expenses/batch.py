@@ -0,0 +1,103 @@
+import collections
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class BatchResult(object):
+    """Outcome of applying a batch function to a single item.
+
+    ``error`` is None if the call succeeded;  otherwise, it is the exception
+    raised.  ``elapsed`` is the wall-clock time of the call, in seconds.
+    """
+    def __init__(self, item, value=None, error=None, elapsed=0.0):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _run_group(func, group):
+    results = []
+    for index, item in group:
+        started = time.time()
+        try:
+            value = func(item)
+        except Exception as e:
+            result = BatchResult(item, error=e)
+        else:
+            result = BatchResult(item, value)
+        result.elapsed = time.time() - started
+        results.append((index, result))
+    return results
+
+
+def run_batch(func, items, key=None, workers=8):
+    """Apply ``func`` to each of ``items``, concurrently.
+
+    Items for which ``key(item)`` returns the same value are run in order, on
+    the same worker, so that operations on the same entity never race.
+    Items with distinct keys are spread across ``workers`` threads.
+
+    Return a list of :class:`BatchResult`, in the same order as ``items``.
+    Exceptions raised by ``func`` are captured, rather than propagated.
+    """
+    groups = collections.OrderedDict()
+    for index, item in enumerate(items):
+        group_key = index if key is None else key(item)
+        groups.setdefault(group_key, []).append((index, item))
+
+    if workers <= 1 or len(groups) <= 1:
+        batches = [_run_group(func, group) for group in groups.values()]
+    else:
+        pool = ThreadPool(min(workers, len(groups)))
+        try:
+            batches = pool.map(lambda group: _run_group(func, group),
+                               list(groups.values()))
+        finally:
+            pool.close()
+            pool.join()
+
+    results = [None] * sum(len(batch) for batch in batches)
+    for batch in batches:
+        for index, result in batch:
+            results[index] = result
+    return results
+
+
+def percentile(ordered, fraction):
+    """Return the value at ``fraction`` (0 to 1) of the sorted ``ordered``.
+
+    The nearest rank is taken;  there is no interpolation.
+    """
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(results, elapsed):
+    """Compute timing statistics for a list of :class:`BatchResult`.
+
+    ``elapsed`` is the wall-clock time for the whole batch.
+    """
+    timings = sorted(result.elapsed for result in results)
+    succeeded = len([result for result in results if result.ok])
+    stats = {
+        'count': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0.0,
+        'mean': 0.0,
+        'p50': 0.0,
+        'p95': 0.0,
+        'max': 0.0,
+        }
+    if timings:
+        stats['mean'] = sum(timings) / len(timings)
+        stats['p50'] = percentile(timings, 0.50)
+        stats['p95'] = percentile(timings, 0.95)
+        stats['max'] = timings[-1]
+    return stats
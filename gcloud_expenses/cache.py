@@ -0,0 +1,276 @@
+import collections
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    """A bounded, thread-safe mapping whose entries expire.
+
+    Entries expire ``ttl`` seconds after being set.  Once more than
+    ``maxsize`` entries are present, the least-recently used are discarded.
+    """
+    def __init__(self, maxsize=1024, ttl=3600, clock=time.time):
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        # key -> (expires, value), least-recently used first.
+        self._data = collections.OrderedDict()
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        with self._lock:
+            found = self._data.pop(key, None)
+            if found is None:
+                return default
+            expires, value = found
+            if expires <= self._clock():
+                return default
+            self._data[key] = found
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self._clock() + self._ttl, value)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SizedLRUCache(object):
+    """A thread-safe mapping bounded by the total size of its values.
+
+    ``sizeof(value)`` gives the size charged for each value (``len`` by
+    default).  Once the total exceeds ``max_size``, the least-recently used
+    entries are discarded;  a single value larger than ``max_size`` is never
+    stored.
+    """
+    def __init__(self, max_size, sizeof=len):
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._sizeof = sizeof
+        self._size = 0
+        # key -> (size, value), least-recently used first.
+        self._data = collections.OrderedDict()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            self._shrink()
+
+    @property
+    def size(self):
+        """Total size of the values currently held.
+        """
+        return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            found = self._data.pop(key, None)
+            if found is None:
+                return default
+            self._data[key] = found
+            return found[1]
+
+    def set(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            self._discard(key)
+            if size > self._max_size:
+                return
+            self._data[key] = (size, value)
+            self._size += size
+            self._shrink()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        """Assumes ``self._lock`` is already acquired.
+        """
+        found = self._data.pop(key, None)
+        if found is not None:
+            self._size -= found[0]
+
+    def _shrink(self):
+        """Assumes ``self._lock`` is already acquired.
+        """
+        while self._size > self._max_size:
+            _, (size, _) = self._data.popitem(last=False)
+            self._size -= size
+
+
+class DiskLRUCache(object):
+    """Files cached in a directory, bounded by their total size.
+
+    Several processes may share the directory:  entries are written to a
+    temporary file and renamed into place, so that readers only ever see
+    complete files, and recency is the file's modification time, bumped on
+    each hit.  Once the total exceeds ``max_bytes``, the least-recently used
+    files are removed, under an exclusive lock on the directory.  A file
+    still open in a reader survives its removal (on POSIX).
+    """
+    LOCK = '.lock'
+    TEMP_PREFIX = '.tmp-'
+    # Temporary files left behind by crashed writers are removed after this.
+    STALE_TEMP_SECONDS = 3600
+
+    def __init__(self, directory, max_bytes, clock=time.time):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self._clock = clock
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:  # pragma: no cover
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def open(self, key):
+        """Return the cached file for ``key``, open for reading, or None.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        now = self._clock()
+        try:
+            os.utime(path, (now, now))
+        except OSError:  # pragma: no cover  (evicted meanwhile)
+            pass
+        return f
+
+    def put(self, key, filename):
+        """Cache a copy of ``filename`` for ``key``.
+        """
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return
+        fd, temp = tempfile.mkstemp(prefix=self.TEMP_PREFIX,
+                                    dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with open(filename, 'rb') as source:
+                    shutil.copyfileobj(source, f)
+            now = self._clock()
+            os.utime(temp, (now, now))
+            os.rename(temp, self._path(key))
+        except Exception:
+            os.remove(temp)
+            raise
+        self._shrink()
+
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _entries(self):
+        """Yield ``(mtime, size, path)`` for each entry.
+        """
+        now = self._clock()
+        for name in os.listdir(self.directory):
+            if name == self.LOCK:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # removed meanwhile
+                continue
+            if name.startswith(self.TEMP_PREFIX):
+                if now - stat.st_mtime > self.STALE_TEMP_SECONDS:
+                    self._remove(path)
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+    @property
+    def size(self):
+        """Total size of the files currently cached.
+        """
+        return sum([size for _, size, _ in self._entries()])
+
+    def __len__(self):
+        return len(list(self._entries()))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:  # pragma: no cover
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _shrink(self):
+        with open(os.path.join(self.directory, self.LOCK), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum([size for _, size, _ in entries])
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
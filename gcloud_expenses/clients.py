@@ -0,0 +1,163 @@
+""" Datastore connections and storage buckets for concurrent callers.
+
+By default, the gcloud libraries use one connection per process, whose
+``httplib2`` session is not safe to share between threads.  A
+:class:`Client` holds a datastore connection and the receipts bucket, both
+talking over one keep-alive, authorized HTTP session, for use by one thread
+at a time:  the web application checks one out of a pool for each request.
+
+The data functions accept a ``connection`` keyword argument (see
+:func:`accepts_connection`), used for the datastore calls they make.
+"""
+import functools
+import inspect
+import threading
+
+
+_local = threading.local()
+
+
+class Client(object):
+    """A datastore connection, and the receipts bucket, sharing ``http``.
+
+    The bucket is looked up, by calling ``get_bucket``, on first use.
+    """
+    def __init__(self, http, connection, get_bucket):
+        self.http = http
+        self.connection = connection
+        self._get_bucket = get_bucket
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self._get_bucket()
+        return self._bucket
+
+
+class ThreadClients(object):
+    """Hand each calling thread a client of its own, made by ``factory``.
+
+    For pools of worker threads (e.g. :func:`gcloud_expenses.batch.run_batch`),
+    which must not share a connection.  A thread's client is made on its
+    first call, then reused.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    def __call__(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._factory()
+        return client
+
+
+def current():
+    """Return the datastore connection active for this thread, if any.
+    """
+    return getattr(_local, 'connection', None)
+
+
+def activate(connection):
+    """Make ``connection`` active for the calling thread;  return the last.
+
+    Pass None to fall back to the gcloud default connection.
+    """
+    previous = current()
+    _local.connection = connection
+    return previous
+
+
+def _connected_iter(connection, iterator):
+    # Generators run piecemeal, maybe after the call returned:  activate
+    # the connection each time the iterator is resumed.
+    while True:
+        previous = activate(connection)
+        try:
+            x = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            activate(previous)
+        yield x
+
+
+def accepts_connection(func):
+    """Decorator:  accept a ``connection`` keyword argument.
+
+    The connection is active (see :func:`current`) while the decorated
+    function runs, or, for generator functions, while it is iterated.
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            connection = kw.pop('connection', None)
+            iterator = func(*args, **kw)
+            if connection is None:
+                return iterator
+            return _connected_iter(connection, iterator)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            connection = kw.pop('connection', None)
+            if connection is None:
+                return func(*args, **kw)
+            previous = activate(connection)
+            try:
+                return func(*args, **kw)
+            finally:
+                activate(previous)
+    return wrapper
+
+
+class ConnectedNamespace(object):
+    """Proxy a module, passing the active connection to selected functions.
+
+    Other attributes are passed through unchanged.
+    """
+    def __init__(self, module, functions):
+        self._module = module
+        for name in functions:
+            setattr(self, name, self._connected(name))
+
+    def _connected(self, name):
+        # Look the function up per call, so that patching the module works.
+        def wrapper(*args, **kw):
+            connection = current()
+            if connection is not None:
+                kw.setdefault('connection', connection)
+            return getattr(self._module, name)(*args, **kw)
+        wrapper.__name__ = name
+        return wrapper
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def connected_query_class(query_class):
+    """Return a subclass of ``query_class`` which fetches using the active
+    connection.
+    """
+    class ConnectedQuery(query_class):
+        def fetch(self, *args, **kw):
+            connection = current()
+            if connection is not None:
+                kw.setdefault('connection', connection)
+            return super(ConnectedQuery, self).fetch(*args, **kw)
+    ConnectedQuery.__name__ = query_class.__name__
+    return ConnectedQuery
+
+
+def connected_transaction_class(transaction_class):
+    """Return a subclass of ``transaction_class`` which commits over the
+    active connection.
+    """
+    class ConnectedTransaction(transaction_class):
+        def __init__(self, *args, **kw):
+            connection = current()
+            if connection is not None:
+                kw.setdefault('connection', connection)
+            super(ConnectedTransaction, self).__init__(*args, **kw)
+    ConnectedTransaction.__name__ = transaction_class.__name__
+    return ConnectedTransaction
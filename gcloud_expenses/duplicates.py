@@ -0,0 +1,134 @@
+""" Detection of the same charge submitted on more than one report.
+
+A charge is identified by its date, vendor and amount (quantity times
+price).  At submission, exact matches are found through a fingerprint
+index kept in the datastore;  :class:`DuplicateScanner` finds near matches
+(within a tolerance on date and amount) over existing items in a single
+pass, by hashing each charge into a grid cell and comparing it only with
+charges in neighboring cells.
+"""
+import datetime
+import decimal
+import re
+
+from .schema import DATE_FORMAT
+
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_EPOCH = datetime.date(1970, 1, 1)
+
+
+def normalize_vendor(vendor):
+    return u' '.join(_WORD.findall((vendor or u'').lower()))
+
+
+def charge_date(value):
+    """Return a :class:`datetime.date` for a typed, stored or legacy date.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(value.strip(), DATE_FORMAT).date()
+    except (AttributeError, ValueError):
+        return None
+
+
+def charge_cents(row):
+    """Return the row's amount, in cents, or None if it has none.
+    """
+    try:
+        quantity = decimal.Decimal(str(row.get('Quantity') or 1))
+        price = decimal.Decimal(str(row.get('Price') or 0))
+    except decimal.InvalidOperation:
+        return None
+    return int((quantity * price * 100).to_integral_value())
+
+
+def charge(row):
+    """Return ``(date, vendor, cents)`` for a row, or None if incomplete.
+    """
+    date = charge_date(row.get('Date'))
+    vendor = normalize_vendor(row.get('Vendor'))
+    cents = charge_cents(row)
+    if date is None or not vendor or cents is None:
+        return None
+    return date, vendor, cents
+
+
+def fingerprint(row):
+    """Return the exact-match fingerprint of a row, or None.
+    """
+    found = charge(row)
+    if found is None:
+        return None
+    date, vendor, cents = found
+    return u'%s|%s|%d' % (date.strftime(DATE_FORMAT), vendor, cents)
+
+
+def build_fingerprints(rows):
+    """Map each fingerprint in ``rows`` to the item numbers bearing it.
+
+    Item numbers start at 1, matching the item keys.
+    """
+    found = {}
+    for number, row in enumerate(rows, 1):
+        key = fingerprint(row)
+        if key is not None:
+            found.setdefault(key, []).append(number)
+    return found
+
+
+class DuplicateScanner(object):
+    """Find pairs of charges on different reports within a tolerance.
+
+    Charges match if their vendors are equal, their dates differ by at most
+    ``date_tolerance`` days and their amounts by at most ``cents_tolerance``
+    cents.  Each charge is compared only with those in its own and the
+    neighboring grid cells, so a scan is linear in the number of charges
+    (barring many charges in the same cell).
+    """
+    def __init__(self, date_tolerance=0, cents_tolerance=0):
+        self.date_tolerance = date_tolerance
+        self.cents_tolerance = cents_tolerance
+        self._day_width = date_tolerance + 1
+        self._cents_width = cents_tolerance + 1
+        self._cells = {}  # (vendor, day cell, cents cell) -> [charge, ...]
+
+    def __len__(self):
+        return sum(len(x) for x in self._cells.values())
+
+    def add(self, ref, report, row):
+        """Add a charge;  return a list of ``(other_ref, other_report)``.
+
+        ``ref`` identifies the charge, ``report`` its report.
+        """
+        found = charge(row)
+        if found is None:
+            return []
+        date, vendor, cents = found
+        day = (date - _EPOCH).days
+        day_cell = day // self._day_width
+        cents_cell = cents // self._cents_width
+        matches = []
+        for d in (day_cell - 1, day_cell, day_cell + 1):
+            for c in (cents_cell - 1, cents_cell, cents_cell + 1):
+                for o_ref, o_report, o_day, o_cents in self._cells.get(
+                        (vendor, d, c), ()):
+                    if (o_report != report
+                            and abs(o_day - day) <= self.date_tolerance
+                            and abs(o_cents - cents) <= self.cents_tolerance):
+                        matches.append((o_ref, o_report))
+        self._cells.setdefault((vendor, day_cell, cents_cell), []).append(
+            (ref, report, day, cents))
+        return matches
+
+    def scan(self, records):
+        """Yield ``(ref, report, other_ref, other_report)`` for each match.
+
+        ``records`` yields ``(ref, report, row)``.
+        """
+        for ref, report, row in records:
+            for other_ref, other_report in self.add(ref, report, row):
+                yield ref, report, other_ref, other_report
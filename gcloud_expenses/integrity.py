@@ -0,0 +1,205 @@
+""" Checksums of receipt transfers, computed while streaming.
+
+Cloud Storage keeps an MD5 hash of each object's contents (except for
+composite objects) and a CRC32C checksum, both base64-encoded.  The file
+wrappers below feed each block to the digests as it is written (downloads)
+or read (uploads), so that verifying a transfer needs no second pass over
+the data.
+
+CRC32C uses the ``crc32c`` or ``google-crc32c`` package, if installed;  the
+pure-Python fallback is slow, and only used for objects without an MD5.
+"""
+import base64
+import hashlib
+import struct
+
+try:
+    import google_crc32c
+except ImportError:  # pragma: no cover
+    google_crc32c = None
+
+try:
+    import crc32c as _crc32c
+except ImportError:  # pragma: no cover
+    _crc32c = None
+
+
+class ChecksumMismatch(Exception):
+    """The data transferred does not match the stored object's checksum.
+    """
+    def __init__(self, name, algorithm, expected, actual):
+        super(ChecksumMismatch, self).__init__(
+            '%s: %s mismatch (stored %s, transferred %s)'
+            % (name, algorithm, expected, actual))
+        self.name = name
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+
+
+def _crc32c_table():
+    table = []
+    for n in range(256):
+        crc = n
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+_TABLE = _crc32c_table()
+
+
+def _crc32c_python(data, crc=0):
+    crc ^= 0xffffffff
+    for byte in bytearray(data):
+        crc = _TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+if google_crc32c is not None:  # pragma: no cover
+    def crc32c_update(data, crc=0):
+        return google_crc32c.extend(crc, bytes(data))
+    FAST_CRC32C = True
+elif _crc32c is not None:  # pragma: no cover
+    def crc32c_update(data, crc=0):
+        return _crc32c.crc32c(bytes(data), crc)
+    FAST_CRC32C = True
+else:
+    crc32c_update = _crc32c_python
+    FAST_CRC32C = False
+
+
+class _CRC32C(object):
+    """``hashlib``-style wrapper around :func:`crc32c_update`.
+    """
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = crc32c_update(data, self._crc)
+
+    def digest(self):
+        return struct.pack('>I', self._crc)
+
+
+class Digests(object):
+    """Digests of the same data, by algorithm ('md5', 'crc32c').
+    """
+    def __init__(self, algorithms):
+        self._digests = {}
+        for algorithm in algorithms:
+            if algorithm == 'md5':
+                self._digests[algorithm] = hashlib.md5()
+            elif algorithm == 'crc32c':
+                self._digests[algorithm] = _CRC32C()
+            else:
+                raise ValueError('Unknown algorithm: %s' % algorithm)
+
+    def update(self, data):
+        for digest in self._digests.values():
+            digest.update(data)
+
+    def b64(self):
+        """Return the digests, base64-encoded like the stored ones.
+        """
+        return dict([
+            (algorithm, base64.b64encode(digest.digest()).decode('ascii'))
+            for algorithm, digest in self._digests.items()])
+
+
+def stored_hashes(blob):
+    """Return ``{algorithm: base64 digest}`` as stored for a blob.
+    """
+    properties = getattr(blob, 'properties', None) or {}
+    found = {}
+    for algorithm, attr, key in (('md5', 'md5_hash', 'md5Hash'),
+                                 ('crc32c', 'crc32c', 'crc32c')):
+        value = getattr(blob, attr, None) or properties.get(key)
+        if value:
+            found[algorithm] = value
+    return found
+
+
+def algorithms_for(stored):
+    """Pick the algorithms worth computing to check against ``stored``.
+
+    MD5 is cheap;  CRC32C is computed too only if it can be done fast, or if
+    there is no MD5 (composite objects).
+    """
+    chosen = []
+    if 'md5' in stored:
+        chosen.append('md5')
+    if 'crc32c' in stored and (FAST_CRC32C or not chosen):
+        chosen.append('crc32c')
+    return chosen
+
+
+def verify(name, digests, stored):
+    """Raise :exc:`ChecksumMismatch` if ``digests`` disagree with ``stored``.
+
+    Return the number of checksums compared.
+    """
+    compared = 0
+    for algorithm, actual in sorted(digests.b64().items()):
+        expected = stored.get(algorithm)
+        if expected is None:
+            continue
+        if expected != actual:
+            raise ChecksumMismatch(name, algorithm, expected, actual)
+        compared += 1
+    return compared
+
+
+class HashingWriter(object):
+    """File wrapper feeding the digests with each block written.
+
+    ``f`` may be None, to checksum a download without keeping it.
+    """
+    def __init__(self, f, digests):
+        self._f = f
+        self.digests = digests
+        self.size = 0
+
+    def write(self, data):
+        self.digests.update(data)
+        self.size += len(data)
+        if self._f is not None:
+            self._f.write(data)
+
+    def flush(self):
+        if self._f is not None:
+            self._f.flush()
+
+
+class HashingReader(object):
+    """File wrapper feeding the digests with each block read.
+
+    Uploads may rewind and re-send part of the file:  bytes are hashed only
+    the first time they are read.
+    """
+    def __init__(self, f, digests):
+        self._f = f
+        self.digests = digests
+        self.hashed = 0  # bytes hashed, from the start
+
+    def read(self, size=-1):
+        start = self._f.tell()
+        data = self._f.read(size)
+        end = start + len(data)
+        if end > self.hashed and start <= self.hashed:
+            self.digests.update(data[self.hashed - start:])
+            self.hashed = end
+        return data
+
+    def seek(self, offset, whence=0):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    @property
+    def name(self):
+        return self._f.name
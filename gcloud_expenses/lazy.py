@@ -0,0 +1,50 @@
+""" Deferred imports of the gcloud client libraries.
+
+Importing :mod:`gcloud.datastore` and :mod:`gcloud.storage` (and their
+protobuf / HTTP dependencies) dominates the start-up time of the scripts;
+these stand-ins put that off until data is actually touched.
+"""
+import importlib
+
+
+class LazyModule(object):
+    """Stand-in for module ``name``, imported on first attribute access.
+
+    ``setup``, if passed, is called before the first import.
+    """
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            if self._setup is not None:
+                self._setup()
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+class LazyAttribute(object):
+    """Callable stand-in for attribute ``attr`` of a (lazy) module.
+
+    ``wrap``, if passed, is applied once to the attribute when resolved.
+    """
+    def __init__(self, module, attr, wrap=None):
+        self._module = module
+        self._attr = attr
+        self._wrap = wrap
+        self._found = None
+
+    def resolve(self):
+        found = self._found
+        if found is None:
+            found = getattr(self._module, self._attr)
+            if self._wrap is not None:
+                found = self._wrap(found)
+            self._found = found
+        return found
+
+    def __call__(self, *args, **kw):
+        return self.resolve()(*args, **kw)
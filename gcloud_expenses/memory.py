@@ -0,0 +1,232 @@
+""" An in-memory stand-in for the gcloud datastore.
+
+For load tests and local runs without a backend:  :func:`install` points the
+data functions at a :class:`MemoryDatastore`, in this process only.  It
+implements the part of the datastore API which the data functions use
+(keys, entities, get / put / delete, ancestor queries with equality
+filters and ordering, and transactions), without any network latency, so
+that a load test against it measures the application itself.  Nothing is
+kept once the process exits, and there is no receipts bucket.
+"""
+import threading
+
+from .clients import Client
+from .clients import ConnectedNamespace
+from .clients import connected_query_class
+from .clients import connected_transaction_class
+from .tracing import TracedNamespace
+from .tracing import traced_query_class
+
+
+class Key(object):
+
+    def __init__(self, *path_args):
+        self.flat_path = tuple(path_args)
+        self.path = []
+        for kind, id_or_name in zip(path_args[::2], path_args[1::2]):
+            if isinstance(id_or_name, int):
+                self.path.append({'kind': kind, 'id': id_or_name})
+            else:
+                self.path.append({'kind': kind, 'name': id_or_name})
+
+    def __eq__(self, other):
+        return self.flat_path == getattr(other, 'flat_path', None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.flat_path)
+
+    def __repr__(self):
+        return '<Key %r>' % (self.flat_path,)
+
+
+class Entity(dict):
+
+    def __init__(self, key=None):
+        super(Entity, self).__init__()
+        self.key = key
+
+
+class Conflict(Exception):
+    pass
+
+
+class InternalServerError(Exception):
+    pass
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class _Exceptions(object):
+    # Stands in for 'gcloud.exceptions'.
+    Conflict = Conflict
+    InternalServerError = InternalServerError
+    ServiceUnavailable = ServiceUnavailable
+    NotFound = NotFound
+
+
+def _sort_key(key):
+    # Numeric IDs sort before names, as in the datastore.
+    return tuple((0, x, '') if isinstance(x, int) else (1, 0, x)
+                 for x in key.flat_path)
+
+
+class MemoryDatastore(object):
+    """Entities in a dict, safe to use from many threads.
+
+    Writes made in a transaction are applied together when it commits;
+    transactions never conflict.
+    """
+    def __init__(self):
+        self._entities = {}  # key -> properties
+        self._lock = threading.Lock()
+        self._local = threading.local()  # the thread's transaction writes
+
+    def _load(self, key, properties):
+        entity = Entity(key)
+        entity.update(properties)
+        return entity
+
+    def _write(self, key, properties):
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.append((key, properties))
+            return
+        with self._lock:
+            self._apply([(key, properties)])
+
+    def _apply(self, writes):
+        for key, properties in writes:
+            if properties is None:
+                self._entities.pop(key, None)
+            else:
+                self._entities[key] = properties
+
+    def get(self, keys, connection=None):
+        with self._lock:
+            return [self._load(key, self._entities[key]) for key in keys
+                    if key in self._entities]
+
+    def put(self, entities, connection=None):
+        for entity in entities:
+            self._write(entity.key, dict(entity))
+
+    def delete(self, keys, connection=None):
+        for key in keys:
+            self._write(key, None)
+
+    def query(self, kind, ancestor=None, filters=(), order=(), limit=None,
+              offset=0):
+        """Return a list of the matching entities.
+        """
+        prefix = None if ancestor is None else ancestor.flat_path
+        with self._lock:
+            found = [self._load(key, properties)
+                     for key, properties in self._entities.items()
+                     if key.flat_path[-2] == kind
+                     and (prefix is None
+                          or key.flat_path[:len(prefix)] == prefix)
+                     and all(properties.get(name) == value
+                             for name, value in filters)]
+        found.sort(key=lambda x: _sort_key(x.key))
+        for name in reversed(order):
+            found.sort(key=lambda x: x.get(name.lstrip('-')),
+                       reverse=name.startswith('-'))
+        end = None if limit is None else offset + limit
+        return found[offset:end]
+
+    def begin(self):
+        self._local.pending = []
+
+    def commit(self):
+        writes, self._local.pending = self._local.pending, None
+        with self._lock:
+            self._apply(writes)
+
+    def rollback(self):
+        self._local.pending = None
+
+    def query_class(self):
+        store = self
+
+        class Query(object):
+            def __init__(self, kind=None):
+                self.kind = kind
+                self.ancestor = None
+                self.filters = []
+                self.order = []
+
+            def add_filter(self, name, operator, value):
+                if operator != '=':
+                    raise ValueError('Unsupported operator: %s' % operator)
+                self.filters.append((name, value))
+
+            def fetch(self, limit=None, offset=0, connection=None):
+                return iter(store.query(self.kind, self.ancestor,
+                                        self.filters, self.order, limit,
+                                        offset))
+        return Query
+
+    def transaction_class(self):
+        store = self
+
+        class Transaction(object):
+            def __init__(self, connection=None):
+                self.connection = connection
+
+            def __enter__(self):
+                store.begin()
+                return self
+
+            def __exit__(self, exc_type, exc_value, tb):
+                if exc_type is None:
+                    store.commit()
+                else:
+                    store.rollback()
+                return False
+        return Transaction
+
+
+def new_client():
+    """Return a client of the in-memory datastore, without a bucket.
+    """
+    def _get_bucket():
+        raise NotImplementedError('No receipts bucket in memory')
+    return Client(None, object(), _get_bucket)
+
+
+def install(store=None):
+    """Point the data functions at ``store``;  return it.
+
+    ``store`` defaults to a new, empty :class:`MemoryDatastore`.  Call this
+    before importing :mod:`gcloud_expenses.webapp`, which then hands out
+    clients of the store, and never imports the gcloud libraries.
+    """
+    import gcloud_expenses
+    if store is None:
+        store = MemoryDatastore()
+    gcloud_expenses.exceptions = _Exceptions
+    gcloud_expenses.datastore = TracedNamespace(
+        ConnectedNamespace(store, ('get', 'put', 'delete')), {
+            'get': 'datastore.get',
+            'put': 'datastore.put',
+            'delete': 'datastore.delete',
+            })
+    gcloud_expenses.Key = Key
+    gcloud_expenses.Entity = Entity
+    gcloud_expenses.Query = traced_query_class(
+        connected_query_class(store.query_class()))
+    gcloud_expenses.Transaction = connected_transaction_class(
+        store.transaction_class())
+    gcloud_expenses.new_client = new_client
+    # Nothing to set up:  keep 'initialize_gcloud' from importing gcloud.
+    gcloud_expenses._initialized.append(True)
+    return store
@@ -0,0 +1,171 @@
+""" Shrinking receipt images and PDFs before upload.
+
+Photos and scans are downsampled to at most ``max_dimension`` pixels on a
+side, and recompressed in their own format (so that their name still
+matches their content) without their EXIF and other metadata (once the
+EXIF orientation is applied).  PDFs are rewritten by Ghostscript, if it
+is installed, downsampling their embedded images.  A result no smaller than
+its source is discarded, so that normalizing never costs bytes.
+
+Images need the ``Pillow`` package (the ``receipts`` extra):  without it,
+or without Ghostscript for PDFs, files are uploaded as they are.  The work
+is CPU-bound, so files are processed on a pool of processes.
+"""
+import multiprocessing
+import os
+import subprocess
+
+try:
+    from PIL import Image
+    from PIL import ImageOps
+except ImportError:  # pragma: no cover
+    Image = ImageOps = None
+
+
+MAX_DIMENSION = 2048
+QUALITY = 80
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif',
+                    '.tiff', '.webp')
+PDF_EXTENSIONS = ('.pdf',)
+GHOSTSCRIPT = 'gs'
+
+
+def _which(program):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _target(source, target_dir, ext):
+    base, _ = os.path.splitext(os.path.basename(source))
+    return os.path.join(target_dir, base + ext)
+
+
+def _save_options(image_format, quality):
+    if image_format == 'JPEG':
+        return {'quality': quality, 'optimize': True, 'progressive': True}
+    if image_format == 'WEBP':
+        return {'quality': quality}
+    if image_format == 'PNG':
+        return {'optimize': True}
+    return {}
+
+
+def normalize_image(source, target_dir, max_dimension=MAX_DIMENSION,
+                    quality=QUALITY):
+    """Write a downsampled copy of an image, in its format;  return its path.
+
+    ``quality`` applies to JPEG and WebP images.  Return None if ``Pillow``
+    is not installed.
+    """
+    if Image is None:
+        return None
+    image = Image.open(source)
+    image_format = image.format
+    transpose = getattr(ImageOps, 'exif_transpose', None)
+    if transpose is not None:
+        image = transpose(image)
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    target = _target(source, target_dir, os.path.splitext(source)[1])
+    # Saving without 'exif' / 'icc_profile' drops the metadata.
+    image.save(target, image_format, **_save_options(image_format, quality))
+    return target
+
+
+def normalize_pdf(source, target_dir):
+    """Write a copy of a PDF rewritten by Ghostscript;  return its path.
+
+    Return None if Ghostscript is not installed.
+    """
+    gs = _which(GHOSTSCRIPT)
+    if gs is None:
+        return None
+    target = _target(source, target_dir, '.pdf')
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.check_call([
+            gs, '-q', '-dBATCH', '-dNOPAUSE', '-dSAFER',
+            '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+            '-dPDFSETTINGS=/ebook', '-sOutputFile=%s' % target, source,
+            ], stdout=devnull)
+    return target
+
+
+def normalize_file(source, target_dir, max_dimension=MAX_DIMENSION,
+                   quality=QUALITY):
+    """Normalize one receipt into ``target_dir``.
+
+    Return a dict:  ``source``;  ``path``, the file to upload (``source``
+    itself if it could not be shrunk);  ``name``, its name in storage;
+    ``original_bytes`` and ``bytes``, the sizes before and after;  and
+    ``error``, the message of any error which prevented normalizing.
+
+    ``name`` is always the basename of ``source``:  the receipt is listed,
+    downloaded and deleted under the name it was uploaded as, and as it
+    keeps its format, that name still matches its content type.
+    """
+    original_bytes = os.path.getsize(source)
+    result = {
+        'source': source,
+        'path': source,
+        'name': os.path.basename(source),
+        'original_bytes': original_bytes,
+        'bytes': original_bytes,
+        'error': None,
+        }
+    ext = os.path.splitext(source)[1].lower()
+    try:
+        if ext in IMAGE_EXTENSIONS:
+            target = normalize_image(source, target_dir, max_dimension,
+                                     quality)
+        elif ext in PDF_EXTENSIONS:
+            target = normalize_pdf(source, target_dir)
+        else:
+            target = None
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        return result
+    if target is not None:
+        size = os.path.getsize(target)
+        if size < original_bytes:
+            result.update({
+                'path': target,
+                'bytes': size,
+                })
+        else:
+            os.remove(target)
+    return result
+
+
+def _normalize_args(args):
+    # Module-level, so that the process pool can pickle it.
+    return normalize_file(*args)
+
+
+def normalize_files(sources, target_dir, max_dimension=MAX_DIMENSION,
+                    quality=QUALITY, workers=None):
+    """Normalize many receipts, on up to ``workers`` processes.
+
+    ``workers`` defaults to the number of CPUs.  Return a list of the
+    results of :func:`normalize_file`, in the order of ``sources``.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    args = []
+    for index, source in enumerate(sources):
+        # One directory per file, so that 'a.png' and 'a.tif' don't collide.
+        directory = os.path.join(target_dir, str(index))
+        os.mkdir(directory)
+        args.append((source, directory, max_dimension, quality))
+    workers = min(workers, len(args))
+    if workers <= 1:
+        return [_normalize_args(x) for x in args]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(_normalize_args, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
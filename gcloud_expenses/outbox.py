@@ -0,0 +1,384 @@
+""" Durable local queue of report submissions, for use while offline.
+
+:command:`submit_expenses --offline` appends ``create`` / ``update`` /
+``delete`` operations to an SQLite file instead of applying them, so that a
+submission costs one local disk write.  :func:`flush` later replays them
+against the datastore, in batches.  Each operation carries a token, passed
+as the idempotency key of its transaction, so that an operation replayed
+after an interrupted flush is applied at most once.
+"""
+import contextlib
+import datetime
+import decimal
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from . import BadReportStatus
+from . import DuplicateReport
+from . import NoSuchReport
+from . import create_report
+from . import delete_report
+from . import new_client
+from . import update_report
+from .batch import run_batch
+from .clients import ThreadClients
+from .clients import activate
+
+
+DEFAULT_PATH = os.environ.get(
+    'GCLOUD_EXPENSES_OUTBOX',
+    os.path.join('~', '.gcloud_expenses', 'outbox.sqlite'))
+
+PENDING = 'pending'
+FAILED = 'failed'
+
+# Errors which replaying the operation again can't fix.
+PERMANENT_ERRORS = (BadReportStatus, DuplicateReport, NoSuchReport)
+
+_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    token TEXT NOT NULL UNIQUE,
+    operation TEXT NOT NULL,
+    employee_id TEXT NOT NULL,
+    report_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    last_error TEXT
+)"""
+_COLUMNS = ('id, token, operation, employee_id, report_id, payload, '
+            'created, attempts, status, last_error')
+
+
+def _encode(value):
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.strftime('%Y-%m-%d')}
+    raise TypeError(repr(value))
+
+
+def _decode(mapping):
+    if '__decimal__' in mapping:
+        return decimal.Decimal(mapping['__decimal__'])
+    if '__date__' in mapping:
+        return datetime.datetime.strptime(mapping['__date__'],
+                                          '%Y-%m-%d').date()
+    return mapping
+
+
+def dumps(payload):
+    """Serialize a payload, keeping typed row values (see ``schema``).
+    """
+    return json.dumps(payload, default=_encode, sort_keys=True)
+
+
+def loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+class Operation(object):
+    """A queued operation on one expense report.
+
+    ``payload`` holds the keyword arguments of the operation:  ``rows`` and
+    ``description`` for 'create' / 'update', ``force`` for 'delete'.
+    ``attempts`` counts the flushes which sent it.
+    """
+    def __init__(self, id, token, operation, employee_id, report_id,
+                 payload, created=None, attempts=0, status=PENDING,
+                 last_error=None):
+        self.id = id
+        self.token = token
+        self.operation = operation
+        self.employee_id = employee_id
+        self.report_id = report_id
+        self.payload = payload
+        self.created = created
+        self.attempts = attempts
+        self.status = status
+        self.last_error = last_error
+
+    @property
+    def report(self):
+        return self.employee_id, self.report_id
+
+    def __repr__(self):
+        return '<Operation %s %s %s/%s>' % (
+            self.id, self.operation, self.employee_id, self.report_id)
+
+
+class Outbox(object):
+    """Queue of operations in an SQLite file.
+
+    Each method uses its own connection, so that an outbox may be shared
+    by threads and by processes (SQLite serializes the writers).
+    """
+    def __init__(self, path=DEFAULT_PATH, timeout=30.0):
+        self.path = os.path.expanduser(path)
+        self.timeout = timeout
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with conn:  # commit, or roll back on error
+                yield conn
+        finally:
+            conn.close()
+
+    def append(self, operation, employee_id, report_id, **payload):
+        """Queue an operation;  return it.
+        """
+        op = Operation(None, uuid.uuid4().hex, operation, employee_id,
+                       report_id, payload, time.time())
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO operations (token, operation, employee_id, '
+                'report_id, payload, created) VALUES (?, ?, ?, ?, ?, ?)',
+                (op.token, operation, employee_id, report_id,
+                 dumps(payload), op.created))
+            op.id = cursor.lastrowid
+        return op
+
+    def _select(self, status, limit):
+        sql = ('SELECT %s FROM operations WHERE status = ? ORDER BY id'
+               % _COLUMNS)
+        params = [status]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        found = []
+        for row in rows:
+            row = list(row)
+            row[5] = loads(row[5])
+            found.append(Operation(*row))
+        return found
+
+    def pending(self, limit=None):
+        """Return up to ``limit`` pending operations, oldest first.
+        """
+        return self._select(PENDING, limit)
+
+    def failed(self):
+        """Return the operations which failed permanently.
+        """
+        return self._select(FAILED, None)
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT COUNT(*) FROM operations WHERE status = ?',
+                (PENDING,)).fetchone()[0]
+
+    def _update(self, sql, ids, *params):
+        if not ids:
+            return
+        marks = ', '.join(['?'] * len(ids))
+        with self._connect() as conn:
+            conn.execute(sql % marks, list(params) + list(ids))
+
+    def sending(self, ids):
+        """Note that operations are about to be sent.
+        """
+        self._update('UPDATE operations SET attempts = attempts + 1 '
+                     'WHERE id IN (%s)', ids)
+
+    def remove(self, ids):
+        self._update('DELETE FROM operations WHERE id IN (%s)', ids)
+
+    def defer(self, ids, error):
+        """Keep operations pending, noting why they could not be sent.
+        """
+        self._update('UPDATE operations SET last_error = ? '
+                     'WHERE id IN (%s)', ids, error)
+
+    def fail(self, ids, error):
+        """Set operations aside, as replaying them can never succeed.
+        """
+        self._update('UPDATE operations SET status = ?, last_error = ? '
+                     'WHERE id IN (%s)', ids, FAILED, error)
+
+
+def _combine(first, second):
+    """Return the operation equivalent to ``first`` then ``second``.
+
+    Return None if they cancel out, or ``first`` itself if they can't be
+    combined.
+    """
+    kind = (first.operation, second.operation)
+    if kind == ('create', 'update'):
+        return Operation(first.id, first.token, 'create', first.employee_id,
+                         first.report_id, second.payload)
+    if kind == ('create', 'delete'):
+        return None
+    if first.operation == 'update' and second.operation != 'create':
+        return second
+    return first
+
+
+def coalesce(operations):
+    """Merge successive operations on each report.
+
+    Return a list of ``(operation, ids)``:  applying ``operation`` settles
+    each of the queued operations in ``ids``;  ``operation`` is None where
+    they cancel out (a report created, then deleted, while offline).
+
+    Only operations never sent are merged:  one which a flush may have
+    applied is replayed as queued, under its own token.
+    """
+    merged = []
+    open_ = {}  # report -> index in ``merged`` of its last, unsent entry
+    for op in operations:
+        index = open_.pop(op.report, None)
+        if index is not None and not op.attempts:
+            first, ids = merged[index]
+            if first is None:
+                combined = op
+            else:
+                combined = _combine(first, op)
+            if combined is not first:
+                merged[index] = (combined, ids + [op.id])
+                open_[op.report] = index
+                continue
+        merged.append((op, [op.id]))
+        if not op.attempts:
+            open_[op.report] = len(merged) - 1
+    return merged
+
+
+def _report_of(entry):
+    op = entry[0]
+    return None if op is None else op.report
+
+
+def apply_operation(op):
+    """Apply a queued operation, passing its token as idempotency key.
+
+    Only an operation sent by an earlier flush may have been applied
+    already.
+    """
+    payload = op.payload
+    kw = {'token': op.token, 'maybe_committed': op.attempts > 0}
+    if op.operation == 'create':
+        create_report(op.employee_id, op.report_id, payload['rows'],
+                      payload['description'], **kw)
+    elif op.operation == 'update':
+        update_report(op.employee_id, op.report_id, payload['rows'],
+                      payload['description'], **kw)
+    elif op.operation == 'delete':
+        delete_report(op.employee_id, op.report_id, payload['force'], **kw)
+    else:
+        raise ValueError('Unknown operation: %s' % op.operation)
+
+
+def flush(outbox, batch_size=50, workers=4, apply=apply_operation,
+          new_client=new_client):
+    """Replay queued operations, ``batch_size`` at a time, oldest first.
+
+    Operations on distinct reports are sent concurrently, by up to
+    ``workers`` threads, each over the connection of a client of its own
+    (made by ``new_client``).  An operation failing with one of
+    :data:`PERMANENT_ERRORS` is set aside;  any other error (e.g. the
+    network being down) leaves it, and later operations on the same report,
+    queued, and ends the flush after the current batch.
+
+    Return a dict:  ``applied``, the number of queued operations settled;
+    ``failed``, a list of ``(operation, message)``;  ``error``, the message
+    of the error which ended the flush, if any;  and ``remaining``.
+    """
+    clients = ThreadClients(new_client)
+    applied = 0
+    failed = []
+    error = None
+    while error is None:
+        batch = outbox.pending(batch_size)
+        if not batch:
+            break
+        merged = coalesce(batch)
+        blocked = set()  # reports with an operation left queued
+
+        def _apply(entry):
+            op, ids = entry
+            if op is None:
+                return True
+            if op.report in blocked:
+                return False
+            # Only now may these operations have been applied.
+            outbox.sending(ids)
+            previous = activate(clients().connection)
+            try:
+                apply(op)
+            except PERMANENT_ERRORS:
+                raise
+            except Exception:
+                blocked.add(op.report)
+                raise
+            finally:
+                activate(previous)
+            return True
+
+        results = run_batch(_apply, merged, key=_report_of, workers=workers)
+        for (op, ids), result in zip(merged, results):
+            if result.error is None:
+                if result.value:
+                    outbox.remove(ids)
+                    applied += len(ids)
+                continue
+            message = '%s: %s' % (type(result.error).__name__, result.error)
+            if isinstance(result.error, PERMANENT_ERRORS):
+                outbox.fail(ids, message)
+                failed.append((op, message))
+            else:
+                outbox.defer(ids, message)
+                error = message
+    return {
+        'applied': applied,
+        'failed': failed,
+        'error': error,
+        'remaining': len(outbox),
+        }
+
+
+class BackgroundFlusher(threading.Thread):
+    """Flush an outbox every ``interval`` seconds, until stopped.
+
+    ``report`` is called with the result of each flush which did anything.
+    """
+    def __init__(self, outbox, interval=30.0, report=None, **kw):
+        super(BackgroundFlusher, self).__init__(name='outbox-flusher')
+        self.daemon = True
+        self.outbox = outbox
+        self.interval = interval
+        self.report = report
+        self.kw = kw
+        self._stopping = threading.Event()
+
+    def flush_once(self):
+        result = flush(self.outbox, **self.kw)
+        if self.report is not None and (
+                result['applied'] or result['failed'] or result['error']):
+            self.report(result)
+        return result
+
+    def run(self):
+        while not self._stopping.is_set():
+            self.flush_once()
+            self._stopping.wait(self.interval)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self.join(timeout)
@@ -0,0 +1,181 @@
+import collections
+import logging
+import random
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetriesExhausted(Exception):
+    """An operation kept failing with retryable errors until out of budget.
+    """
+    def __init__(self, name, attempts, last_error):
+        super(RetriesExhausted, self).__init__(
+            '%s: gave up after %d attempts (%s: %s)'
+            % (name, attempts, type(last_error).__name__, last_error))
+        self.name = name
+        self.attempts = attempts
+        self.last_error = last_error
+
+
+class RetryPolicy(object):
+    """Jittered exponential backoff, bounded by attempts and elapsed time.
+
+    The delay before retry ``n`` is drawn uniformly from
+    ``[0, min(max_delay, initial_delay * multiplier ** (n - 1))]`` ("full
+    jitter"), so that clients colliding on the same entity spread out.  No
+    retry is started once ``budget`` seconds have been spent.
+    """
+    def __init__(self, max_attempts=5, initial_delay=0.05, max_delay=2.0,
+                 multiplier=2.0, budget=10.0):
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.budget = budget
+
+    def delay(self, retry):
+        ceiling = min(self.max_delay,
+                      self.initial_delay * self.multiplier ** (retry - 1))
+        return random.uniform(0, ceiling)
+
+
+class Attempt(object):
+    """State shared across the attempts of a single logical operation.
+
+    ``token`` is unique to the operation:  write it onto the entities it
+    changes via :meth:`mark`, so that a retry can tell, via
+    :meth:`already_applied`, that an earlier attempt did commit even though
+    the caller saw an error.
+
+    ``committing`` should be set once the operation's work is done and it is
+    about to commit;  a non-conflict error raised after that point leaves
+    the outcome unknown, and sets ``maybe_committed``.  In that case,
+    ``committed_result`` holds the value returned by that attempt.
+
+    A caller replaying a queued operation passes that operation's ``token``,
+    and ``maybe_committed`` if it was sent before (e.g. by an interrupted
+    flush):  the outcome is then unknown from the start.
+    """
+    TOKEN_PROPERTY = 'operation_token'
+
+    def __init__(self, token=None, maybe_committed=False):
+        self.token = token or uuid.uuid4().hex
+        self.number = 0
+        self.committing = False
+        self.maybe_committed = maybe_committed
+        self.result = None
+        self.committed_result = None
+
+    def mark(self, entity):
+        entity[self.TOKEN_PROPERTY] = self.token
+
+    def already_applied(self, entity):
+        return (self.maybe_committed and
+                entity.get(self.TOKEN_PROPERTY) == self.token)
+
+
+class ContentionStats(object):
+    """Thread-safe counters of retried operations, by operation name.
+
+    For each name, track the number of calls, of conflicts, of retries, of
+    calls which gave up, and the total seconds spent after a first failure
+    (backing off and re-running).  Conflicts are also counted by key, to
+    expose contention hot spots.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._by_name = {}
+            self._by_key = collections.Counter()
+
+    def record(self, name, retries, conflicts, retry_time, gave_up,
+               key=None):
+        with self._lock:
+            stats = self._by_name.setdefault(name, {
+                'calls': 0,
+                'conflicts': 0,
+                'retries': 0,
+                'gave_up': 0,
+                'retry_time': 0.0,
+                })
+            stats['calls'] += 1
+            stats['conflicts'] += conflicts
+            stats['retries'] += retries
+            stats['gave_up'] += int(gave_up)
+            stats['retry_time'] += retry_time
+            if conflicts and key is not None:
+                self._by_key[(name, key)] += conflicts
+
+    def snapshot(self):
+        """Return a mapping name -> counters (a copy).
+        """
+        with self._lock:
+            return dict([(name, dict(stats))
+                         for name, stats in self._by_name.items()])
+
+    def hot_spots(self, n=10):
+        """Return the ``n`` most-conflicted ``((name, key), count)`` pairs.
+        """
+        with self._lock:
+            return self._by_key.most_common(n)
+
+
+def call_with_retries(name, func, policy, stats, retry_on, conflicts=(),
+                      key=None, sleep=time.sleep, clock=time.time,
+                      token=None, maybe_committed=False):
+    """Call ``func(attempt)``, retrying on errors in ``retry_on``.
+
+    ``conflicts`` names the subset of those errors which mean "not
+    committed, try again":  any other retryable error raised while
+    ``attempt.committing`` is set leaves the outcome unknown (see
+    :class:`Attempt`).
+
+    ``token``, if passed, is the operation's idempotency key, and
+    ``maybe_committed`` tells whether it may have been applied already (see
+    :class:`Attempt`).
+
+    Raise :exc:`RetriesExhausted` once ``policy`` runs out of attempts or
+    time;  other errors propagate immediately.
+    """
+    attempt = Attempt(token, maybe_committed)
+    started = clock()
+    first_failure = None
+    n_conflicts = 0
+    while True:
+        attempt.number += 1
+        attempt.committing = False
+        try:
+            result = func(attempt)
+        except retry_on as e:
+            if first_failure is None:
+                first_failure = clock()
+            if isinstance(e, conflicts):
+                n_conflicts += 1
+            elif attempt.committing:
+                attempt.maybe_committed = True
+                attempt.committed_result = attempt.result
+            if (attempt.number >= policy.max_attempts or
+                    clock() - started >= policy.budget):
+                stats.record(name, attempt.number - 1, n_conflicts,
+                             clock() - first_failure, True, key)
+                logger.warning('%s %r: giving up after %d attempts: %s',
+                               name, key, attempt.number, e)
+                raise RetriesExhausted(name, attempt.number, e)
+            delay = policy.delay(attempt.number)
+            logger.info('%s %r: retrying in %.3fs after %s',
+                        name, key, delay, type(e).__name__)
+            sleep(delay)
+        else:
+            retry_time = 0.0
+            if first_failure is not None:
+                retry_time = clock() - first_failure
+            stats.record(name, attempt.number - 1, n_conflicts, retry_time,
+                         False, key)
+            return result
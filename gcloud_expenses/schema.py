@@ -0,0 +1,161 @@
+""" Typed schema for expense item rows.
+
+Rows are parsed from CSV once, at submission, into typed values;  all
+errors in a file are collected in a single pass, with their line numbers,
+so that a bad file is rejected before any transaction is begun.
+"""
+import csv
+import datetime
+import decimal
+
+
+DATE_FORMAT = '%Y-%m-%d'
+CENTS = decimal.Decimal('0.01')
+
+
+class InvalidRows(ValueError):
+    """Rows failed validation.
+
+    ``errors`` is a list of ``(line_number, field, message)``.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        ValueError.__init__(self, '\n'.join(
+            ['Line %d: %s: %s' % x for x in errors]))
+
+
+def parse_text(value):
+    return value.strip()
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        number = decimal.Decimal(value)  # e.g. '2.00'
+        if number != number.to_integral_value():
+            raise ValueError('Not a whole number: %s' % value)
+        return int(number)
+
+
+def parse_decimal(value):
+    try:
+        number = decimal.Decimal(value.replace(',', '').lstrip('$'))
+    except decimal.InvalidOperation:
+        raise ValueError('Not a number: %s' % value)
+    if not number.is_finite():
+        raise ValueError('Not a number: %s' % value)
+    return number.quantize(CENTS)
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value.strip(), DATE_FORMAT).date()
+    except ValueError:
+        raise ValueError('Not a YYYY-MM-DD date: %s' % value)
+
+
+class Field(object):
+    """A column of the item schema.
+
+    Empty values take ``default``, or are errors if ``required``.
+    """
+    def __init__(self, name, parse=parse_text, required=False, default=''):
+        self.name = name
+        self.parse = parse
+        self.required = required
+        self.default = default
+
+
+ITEM_SCHEMA = (
+    Field('Date', parse_date, required=True),
+    Field('Vendor', required=True),
+    Field('Type'),
+    Field('Quantity', parse_int, default=1),
+    Field('Price', parse_decimal, required=True),
+    Field('Memo'),
+)
+
+
+def parse_rows(rows, schema=ITEM_SCHEMA, first_line=2):
+    """Parse an iterable of string lists, the first being the header.
+
+    Return a list of dicts of typed values, keyed by field name;  columns
+    not in the schema are kept as text.  Raise :exc:`InvalidRows` listing
+    every error found.
+    """
+    rows = iter(rows)
+    try:
+        header = [x.strip() for x in next(rows)]
+    except StopIteration:
+        raise InvalidRows([(first_line - 1, '-', 'Missing header')])
+    errors = []
+    by_name = dict([(x.name, x) for x in schema])
+    for field in schema:
+        if field.required and field.name not in header:
+            errors.append((first_line - 1, field.name, 'Missing column'))
+    if errors:
+        raise InvalidRows(errors)
+    # Resolve the columns once, rather than per row.
+    columns = []
+    for index, name in enumerate(header):
+        field = by_name.get(name)
+        if field is None:
+            columns.append((index, name, parse_text, False, ''))
+        else:
+            columns.append((index, name, field.parse, field.required,
+                            field.default))
+    absent = [(x.name, x.default) for x in schema
+              if x.name not in header and not x.required]
+    parsed = []
+    for line, row in enumerate(rows, first_line):
+        if not any(x.strip() for x in row):
+            continue
+        item = dict(absent)
+        for index, name, parse, required, default in columns:
+            value = row[index].strip() if index < len(row) else ''
+            if not value:
+                if required:
+                    errors.append((line, name, 'Required'))
+                item[name] = default
+                continue
+            try:
+                item[name] = parse(value)
+            except (ValueError, decimal.InvalidOperation) as e:
+                errors.append((line, name, str(e)))
+        parsed.append(item)
+    if errors:
+        raise InvalidRows(errors)
+    return parsed
+
+
+def parse_csv(f, schema=ITEM_SCHEMA):
+    """Parse an open CSV file;  see :func:`parse_rows`.
+    """
+    return parse_rows(csv.reader(f), schema)
+
+
+def to_datastore(value):
+    """Convert a typed value to one the datastore can store.
+    """
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if (isinstance(value, datetime.date)
+            and not isinstance(value, datetime.datetime)):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+def from_datastore(item):
+    """Return a dict of display-ready values for a stored item.
+
+    Items stored before typed parsing hold strings, which are passed through.
+    """
+    info = dict(item)
+    date = info.get('Date')
+    if isinstance(date, datetime.datetime):
+        info['Date'] = date.strftime(DATE_FORMAT)
+    price = info.get('Price')
+    if isinstance(price, float):
+        info['Price'] = decimal.Decimal(repr(price)).quantize(CENTS)
+    return info
@@ -0,0 +1,71 @@
+""" Measure the start-up time of the command-line scripts.
+
+Each entry point is run repeatedly, in a fresh interpreter, with arguments
+which should not touch the backend (``--help-commands`` by default);  the
+report also flags any entry point which imported the gcloud libraries.
+"""
+import optparse
+import subprocess
+import sys
+import time
+
+from ..batch import percentile
+
+
+ENTRY_POINTS = [
+    ('submit_expenses', 'gcloud_expenses.scripts.submit_expenses'),
+    ('review_expenses', 'gcloud_expenses.scripts.review_expenses'),
+    ('expense_receipts', 'gcloud_expenses.scripts.expense_receipts'),
+]
+
+_PROGRAM = """\
+import sys
+from %s import main
+try:
+    main(%r)
+except SystemExit:
+    pass
+imported = 'gcloud.datastore' in sys.modules
+sys.stderr.write('gcloud-imported: %%s\\n' %% imported)
+"""
+
+
+def time_entry_point(module, args, python=sys.executable):
+    """Run ``module``'s ``main(args)`` once.
+
+    Return ``(seconds, imported)``, ``imported`` being true if the run
+    imported the gcloud libraries.
+    """
+    started = time.time()
+    proc = subprocess.Popen([python, '-c', _PROGRAM % (module, args)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    elapsed = time.time() - started
+    imported = b'gcloud-imported: True' in err
+    return elapsed, imported
+
+
+def main(argv=sys.argv[1:]):
+    parser = optparse.OptionParser(
+        usage="%prog [OPTIONS] [-- SCRIPT_ARGS]",
+        description="Time the start-up of each command-line script.")
+    parser.add_option(
+        '-n', '--runs',
+        action='store',
+        type='int',
+        dest='runs',
+        default=10,
+        help="Number of runs per script")
+    options, args = parser.parse_args(argv)
+    args = args or ['--help-commands']
+    for name, module in ENTRY_POINTS:
+        times = []
+        imported = False
+        for _ in range(options.runs):
+            elapsed, found = time_entry_point(module, args)
+            times.append(elapsed)
+            imported = imported or found
+        sys.stdout.write(
+            '%-18s min %.3fs  p50 %.3fs  max %.3fs%s\n'
+            % (name, min(times), percentile(sorted(times), 0.5), max(times),
+               '  (imported gcloud)' if imported else ''))
@@ -1,17 +1,28 @@
 import csv
 import optparse
 import os
+import shutil
+import tempfile
 import textwrap
 import sys
 
+from .. import ChecksumMismatch
 from .. import DuplicateReceipt
 from .. import NoSuchReceipt
 from .. import NoSuchReport
+from .. import _get_bucket
 from .. import delete_receipt
 from .. import download_receipt
-from .. import initialize_gcloud
 from .. import list_receipts
 from .. import upload_receipt
+from .. import verify_receipts
+from .. import tracing
+from ..normalize import MAX_DIMENSION
+from ..normalize import QUALITY
+from ..normalize import normalize_files
+from . import jobs
+from . import shell
+from . import timings
 
 
 class InvalidCommandLine(ValueError):
@@ -39,44 +50,129 @@ def _get_csv(args):
 
 
 class UploadReceipt(object):
-    """Upload a receipt for a given expense report.
+    """Upload receipts for a given expense report, optionally shrinking
+    images and PDFs first.
     """
     def __init__(self, receipter, *args):
         self.receipter = receipter
         args = list(args)
         parser = optparse.OptionParser(
-            usage="%prog [OPTIONS] EMPLOYEE_ID REPORT_ID FILENAME")
+            usage="%prog [OPTIONS] EMPLOYEE_ID REPORT_ID FILENAME...")
 
-        _, args = parser.parse_args(args)
+        parser.add_option(
+            '-n', '--normalize',
+            action='store_true',
+            dest='normalize',
+            default=False,
+            help="Downsample and recompress images, strip their metadata, "
+                 "and optimize PDFs before uploading")
+
+        parser.add_option(
+            '--max-dimension',
+            action='store',
+            type='int',
+            dest='max_dimension',
+            default=MAX_DIMENSION,
+            help="Largest width / height of normalized images, in pixels")
+
+        parser.add_option(
+            '--quality',
+            action='store',
+            type='int',
+            dest='quality',
+            default=QUALITY,
+            help="JPEG quality of normalized images (1-95)")
+
+        parser.add_option(
+            '--keep-original',
+            action='store_true',
+            dest='keep_original',
+            default=False,
+            help="Also store the original of each normalized receipt")
+
+        parser.add_option(
+            '-w', '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=None,
+            help="Number of processes normalizing receipts "
+                 "(default: one per CPU)")
+
+        options, args = parser.parse_args(args)
         try:
-            self.employee_id, self.report_id, filename = args
+            self.employee_id, self.report_id = args[:2]
+            filenames = args[2:]
+            if not filenames:
+                raise ValueError
         except:
             raise InvalidCommandLine(
                 'Specify employee ID, report ID, filename')
 
-        filename = os.path.abspath(
-                    os.path.normpath(filename))
+        self.filenames = []
+        for filename in filenames:
+            filename = os.path.abspath(
+                        os.path.normpath(filename))
 
-        if not os.path.isfile(filename):
-            raise InvalidCommandLine(
-                'Invalid filename: %s' % filename)
+            if not os.path.isfile(filename):
+                raise InvalidCommandLine(
+                    'Invalid filename: %s' % filename)
 
-        self.filename = filename
+            self.filenames.append(filename)
+
+        self.normalize = options.normalize
+        self.max_dimension = options.max_dimension
+        self.quality = options.quality
+        self.keep_original = options.keep_original
+        self.workers = options.workers
 
     def __call__(self):
+        if not self.normalize:
+            for filename in self.filenames:
+                self.upload(filename, os.path.basename(filename), None)
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for result in normalize_files(self.filenames, tmpdir,
+                                          self.max_dimension, self.quality,
+                                          self.workers):
+                if result['error'] is not None:
+                    self.receipter.blather("Not normalized: %s, %s"
+                                           % (result['source'],
+                                              result['error']))
+                shrunk = result['path'] != result['source']
+                original = None
+                if self.keep_original and shrunk:
+                    original = result['source']
+                if (self.upload(result['path'], result['name'], original)
+                        and shrunk):
+                    self.receipter.blather(
+                        "Normalized: %d -> %d bytes"
+                        % (result['original_bytes'], result['bytes']))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def upload(self, filename, name, original):
         try:
-            upload_receipt(self.employee_id, self.report_id, self.filename)
+            upload_receipt(self.employee_id, self.report_id, filename,
+                           bucket=self.receipter.get_bucket(), name=name,
+                           original=original)
         except NoSuchReport:
             self.receipter.blather("No such report: %s/%s"
                 % (self.employee_id, self.report_id))
         except DuplicateReceipt:
             self.receipter.blather("Duplicate receipt: %s/%s/%s"
-                % (self.employee_id, self.report_id, self.filename))
+                % (self.employee_id, self.report_id, name))
+        except ChecksumMismatch as e:
+            self.receipter.error("Upload corrupted: %s" % e)
         else:
             self.receipter.blather("Employee-ID: %s" % self.employee_id)
             self.receipter.blather("Report-ID: %s" % self.report_id)
             self.receipter.blather("")
-            self.receipter.blather("Uploaded: %s" % self.filename)
+            self.receipter.blather("Uploaded: %s" % name)
+            tracing.count('bytes', os.path.getsize(filename))
+            return True
+        return False
 
 
 class ListReceipts(object):
@@ -96,7 +192,8 @@ class ListReceipts(object):
 
     def __call__(self):
         try:
-            filenames = list_receipts(self.employee_id, self.report_id)
+            filenames = list_receipts(self.employee_id, self.report_id,
+                                      bucket=self.receipter.get_bucket())
         except NoSuchReport:
             self.receipter.blather("No such report: %s/%s"
                                    % (self.employee_id, self.report_id))
@@ -108,6 +205,7 @@ class ListReceipts(object):
             for filename in filenames:
                 self.receipter.blather("Receipt: %s" % filename)
                 count += 1
+            tracing.count('rows', count)
             self.receipter.blather("--------------------------")
             self.receipter.blather("Number of receipts: %d" % count)
 
@@ -122,26 +220,92 @@ class DownloadReceipt(object):
         parser = optparse.OptionParser(
             usage="%prog [OPTIONS] EMPLOYEE_ID REPORT_ID FILENAME")
 
+        parser.add_option(
+            '--original',
+            action='store_true',
+            dest='original',
+            default=False,
+            help="Download the original kept for a normalized receipt")
+
         options, args = parser.parse_args(args)
         try:
             self.employee_id, self.report_id, self.filename = args
         except:
             raise InvalidCommandLine('Specify employee ID, report ID, filename')
+        self.original = options.original
 
     def __call__(self):
         try:
-            download_receipt(self.employee_id, self.report_id, self.filename)
+            download_receipt(self.employee_id, self.report_id, self.filename,
+                             bucket=self.receipter.get_bucket(),
+                             original=self.original)
         except NoSuchReport:
             self.receipter.blather("No such report: %s/%s"
                                    % (self.employee_id, self.report_id))
         except NoSuchReceipt:
             self.receipter.blather("No such report: %s/%s"
                                    % (self.employee_id, self.report_id))
+        except ChecksumMismatch as e:
+            self.receipter.error("Download corrupted: %s" % e)
         else:
             self.receipter.blather("Employee-ID: %s" % self.employee_id)
             self.receipter.blather("Report-ID: %s" % self.report_id)
             self.receipter.blather("")
             self.receipter.blather("Downloaded: %s" % self.filename)
+            tracing.count('bytes', os.path.getsize(self.filename))
+
+
+class VerifyReceipts(object):
+    """Check the receipts of an expense report against their stored
+    checksums.
+    """
+    def __init__(self, receipter, *args):
+        self.receipter = receipter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS] EMPLOYEE_ID REPORT_ID")
+
+        parser.add_option(
+            '-w', '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=8,
+            help="Number of receipts downloaded concurrently")
+
+        options, args = parser.parse_args(args)
+        try:
+            self.employee_id, self.report_id = args
+        except:
+            raise InvalidCommandLine('Specify employee ID, report ID')
+        self.workers = options.workers
+
+    def __call__(self):
+        try:
+            results = verify_receipts(self.employee_id, self.report_id,
+                                      bucket=self.receipter.get_bucket(),
+                                      workers=self.workers)
+        except NoSuchReport:
+            self.receipter.blather("No such report: %s/%s"
+                                   % (self.employee_id, self.report_id))
+            return
+        self.receipter.blather("Employee-ID: %s" % self.employee_id)
+        self.receipter.blather("Report-ID: %s" % self.report_id)
+        self.receipter.blather("")
+        failed = 0
+        for name, compared, error in results:
+            if error is not None:
+                failed += 1
+                self.receipter.error("Failed: %s, %s" % (name, error))
+            elif compared:
+                self.receipter.blather("Verified: %s" % name)
+            else:
+                self.receipter.blather("Unverified: %s (no stored checksum)"
+                                       % name)
+        tracing.count('rows', len(results))
+        self.receipter.blather("--------------------------")
+        self.receipter.blather("Receipts checked: %d, failed: %d"
+                               % (len(results), failed))
 
 
 class DeleteReceipt(object):
@@ -164,7 +328,8 @@ class DeleteReceipt(object):
 
     def __call__(self):
         try:
-            delete_receipt(self.employee_id, self.report_id, self.filename)
+            delete_receipt(self.employee_id, self.report_id, self.filename,
+                           bucket=self.receipter.get_bucket())
         except NoSuchReport:
             self.receipter.blather("No such report: %s/%s"
                 % (self.employee_id, self.report_id))
@@ -183,6 +348,7 @@ _COMMANDS = {
     'list': ListReceipts,
     'download': DownloadReceipt,
     'delete': DeleteReceipt,
+    'verify': VerifyReceipts,
 }
 
 
@@ -197,8 +363,10 @@ def get_description(command):
 class ExpenseReceipts(object):
     """ Driver for the :command:`review_expenses` command-line script.
     """
-    def __init__(self, argv=None, logger=None):
+    def __init__(self, argv=None, logger=None, get_bucket=None):
         self.commands = []
+        self._get_bucket = get_bucket
+        self._bucket = None
         if logger is None:
             logger = self._print
         self.logger = logger
@@ -246,6 +414,12 @@ class ExpenseReceipts(object):
             default=1,
             help="Increase verbosity")
 
+        timings.add_options(parser)
+
+        jobs.add_options(parser)
+
+        shell.add_options(parser)
+
         options, args = parser.parse_args(mine)
 
         self.options = options
@@ -274,11 +448,33 @@ class ExpenseReceipts(object):
     def __call__(self):
         """ Invoke sub-commands parsed by :meth:`parse_arguments`.
         """
+        if self.options.batch:
+            if self.commands:
+                raise InvalidCommandLine('Commands not allowed with --batch')
+            shell.run_batch(self, self._make_batch_driver, InvalidCommandLine)
+            return
+
         if not self.commands:
             raise InvalidCommandLine('No commands specified')
 
-        for command in self.commands:
-            command()
+        timings.run_commands(self, _COMMANDS)
+
+    def get_bucket(self):
+        """ Return the bucket handle, shared by all commands in this run.
+
+        Commands run concurrently (``--jobs``) use their thread's own.
+        """
+        client = jobs.current_client()
+        if client is not None:
+            return client.bucket
+        if self._get_bucket is not None:
+            return self._get_bucket()
+        if self._bucket is None:
+            self._bucket = _get_bucket()
+        return self._bucket
+
+    def _make_batch_driver(self, argv, logger):
+        return ExpenseReceipts(argv, logger, get_bucket=self.get_bucket)
 
     def _print(self, text):  # pragma NO COVERAGE
         sys.stdout.write('%s\n' % text)
@@ -292,7 +488,6 @@ class ExpenseReceipts(object):
 
 
 def main(argv=sys.argv[1:]):
-    initialize_gcloud()
     try:
         ExpenseReceipts(argv)()
     except InvalidCommandLine as e:  # pragma NO COVERAGE
@@ -0,0 +1,122 @@
+""" Global ``--jobs`` option for the script drivers.
+
+Runs the commands of one command line concurrently:  commands targeting
+the same expense report (and those targeting none, e.g. ``list``) still run
+in order, relative to each other.  Each command's output is held until the
+run finishes, then written in command order, so that it never interleaves.
+Each worker thread uses a client (datastore connection and bucket) of its
+own.
+"""
+import sys
+import threading
+
+from .. import new_client
+from ..batch import run_batch
+from ..clients import ThreadClients
+from ..clients import activate
+
+_local = threading.local()
+
+
+def add_options(parser):
+    parser.add_option(
+        '--jobs',
+        action='store',
+        type='int',
+        dest='jobs',
+        default=1,
+        metavar='N',
+        help="Run up to N commands concurrently")
+
+
+def job_key(command):
+    """Return the report targeted by ``command``, or None.
+    """
+    employee_id = getattr(command, 'employee_id', None)
+    report_id = getattr(command, 'report_id', None)
+    if employee_id is None or report_id is None:
+        return None
+    return employee_id, report_id
+
+
+class _ThreadOutput(object):
+    """Stand-in for a stream, buffering writes from threads running a command.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    @property
+    def buffer(self):
+        return getattr(self._local, 'buffer', None)
+
+    @buffer.setter
+    def buffer(self, buffer):
+        self._local.buffer = buffer
+
+    def write(self, text):
+        buffer = self.buffer
+        if buffer is None:
+            self._stream.write(text)
+        else:
+            buffer.append((self._stream.write, text))
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def current_client():
+    """Return the client of the job running in this thread, if any.
+    """
+    return getattr(_local, 'client', None)
+
+
+def run_concurrently(driver, run_one, jobs, new_client=new_client):
+    """Call ``run_one(index, command)`` for each of ``driver.commands``.
+
+    While a command runs, its thread's client (made by ``new_client``) is
+    returned by :func:`current_client`, and its datastore connection is
+    active.  Unlike the sequential loop, every command is run even if an
+    earlier one fails;  the first error is re-raised once all output is
+    written.
+    """
+    clients = ThreadClients(new_client)
+    output = _ThreadOutput(sys.stdout)
+    logger = driver.logger
+    buffers = [[] for _ in driver.commands]
+
+    def _logger(text):
+        buffer = output.buffer
+        if buffer is None:
+            logger(text)
+        else:
+            buffer.append((logger, text))
+
+    def _run(item):
+        index, command = item
+        client = _local.client = clients()
+        previous = activate(client.connection)
+        output.buffer = buffers[index]
+        try:
+            run_one(index, command)
+        finally:
+            output.buffer = None
+            activate(previous)
+            _local.client = None
+
+    saved, sys.stdout = sys.stdout, output
+    driver.logger = _logger
+    try:
+        results = run_batch(_run, list(enumerate(driver.commands)),
+                            key=lambda item: job_key(item[1]),
+                            workers=jobs)
+    finally:
+        sys.stdout = saved
+        driver.logger = logger
+
+    for buffer in buffers:
+        for write, text in buffer:
+            write(text)
+    for result in results:
+        if not result.ok:
+            raise result.error
@@ -0,0 +1,502 @@
+""" Load test the web application, in-process or over HTTP.
+
+Worker threads send a weighted mix of requests for the employee list, the
+employee and report pages, and a static file, to the application built by
+:func:`gcloud_expenses.webapp.main` from a configuration file (in this
+process), or to a running server (``--url``).  The pages requested are
+those of the reports created by ``--seed``.  With ``--fake-backend``, the
+application runs against an in-memory datastore (see
+:mod:`gcloud_expenses.memory`), seeded first;  otherwise, point the gcloud
+environment at a local stand-in backend (e.g. the ``gcd`` datastore
+emulator, through ``DATASTORE_HOST``) before seeding.
+
+The report gives throughput, latency percentiles and error rates for each
+route;  ``--save`` writes it as JSON, for comparison with a later run
+(``--compare``).
+"""
+import bisect
+import datetime
+import decimal
+import json
+import optparse
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+    from http.client import HTTPSConnection
+except ImportError:  # pragma: no cover
+    from httplib import HTTPConnection
+    from httplib import HTTPSConnection
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # pragma: no cover
+    from urlparse import urlparse
+
+from .. import DuplicateReport
+from .. import create_report
+from .. import ensure_employees
+from ..batch import percentile
+
+
+ROUTES = ('employees', 'employee', 'report', 'static')
+DEFAULT_MIX = 'employees=1,employee=3,report=5,static=1'
+STATIC_PATH = '/static/theme.css'
+
+_VENDORS = ('Acme Travel', 'Hotel Mountain View', 'Yellow Cab', 'Cafe Roma',
+            'Office Supply Co', 'Airline One')
+_TYPES = ('travel', 'lodging', 'meals', 'supplies')
+
+
+def parse_mix(text):
+    """Parse ``route=weight,...`` into a list of ``(route, weight)``.
+
+    A route without a weight counts once;  routes weighted zero are left
+    out.
+    """
+    mix = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise ValueError('Unknown route: %s' % route)
+        weight = int(weight) if weight.strip() else 1
+        if weight < 0:
+            raise ValueError('Negative weight: %s' % part)
+        if weight:
+            mix.append((route, weight))
+    if not mix:
+        raise ValueError('No routes in mix: %r' % text)
+    return mix
+
+
+def seeded_reports(employees, reports):
+    """Return the ``(employee_id, report_id)`` pairs created by ``--seed``.
+    """
+    return [('load-%04d' % employee, 'report-%03d' % report)
+            for employee in range(employees)
+            for report in range(reports)]
+
+
+def seed_rows(items, rnd):
+    """Return ``items`` typed item rows, as parsed from a report's CSV.
+    """
+    start = datetime.date(2014, 9, 1)
+    return [{
+        'Date': start + datetime.timedelta(days=index % 28),
+        'Vendor': rnd.choice(_VENDORS),
+        'Type': rnd.choice(_TYPES),
+        'Quantity': 1,
+        'Price': decimal.Decimal(rnd.randint(100, 50000)) / 100,
+        'Memo': 'Load test item %d' % (index + 1),
+        } for index in range(items)]
+
+
+def seed(targets, items, rnd, create=create_report, ensure=ensure_employees):
+    """Create those of the ``targets`` reports which do not exist yet.
+
+    Their employees are looked up, and created, in batches first.  Return
+    the number of reports created.
+    """
+    ensure([employee_id for employee_id, report_id in targets])
+    created = 0
+    for employee_id, report_id in targets:
+        try:
+            create(employee_id, report_id, seed_rows(items, rnd),
+                   'Load test report')
+        except DuplicateReport:
+            continue
+        created += 1
+    return created
+
+
+def path_for(route, employee_id, report_id):
+    if route == 'employees':
+        return '/employees/'
+    if route == 'employee':
+        return '/employees/%s' % employee_id
+    if route == 'report':
+        return '/employees/%s/%s' % (employee_id, report_id)
+    return STATIC_PATH
+
+
+def plan_requests(mix, targets, count, rnd):
+    """Return ``count`` ``(route, path)`` pairs, routes drawn by weight.
+
+    Each request for a page picks one of the ``targets`` reports at random.
+    """
+    routes = []
+    bounds = []
+    total = 0
+    for route, weight in mix:
+        total += weight
+        routes.append(route)
+        bounds.append(total)
+    plan = []
+    for _ in range(count):
+        route = routes[bisect.bisect_right(bounds, rnd.random() * total)]
+        employee_id, report_id = rnd.choice(targets)
+        plan.append((route, path_for(route, employee_id, report_id)))
+    return plan
+
+
+class WSGITransport(object):
+    """Send requests to a WSGI application, in this process.
+
+    The response body is consumed, then closed, as a server would.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, path):
+        from webob import Request
+        started = []
+        def _start_response(status, headers, exc_info=None):
+            started.append(status)
+            return lambda data: None
+        body = self.app(Request.blank(path).environ, _start_response)
+        try:
+            for _ in body:
+                pass
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+        return int(started[-1].split()[0])
+
+
+class HTTPTransport(object):
+    """Send requests to a server, over one keep-alive connection per thread.
+    """
+    def __init__(self, url, timeout=30.0):
+        parsed = urlparse(url)
+        self._klass = (HTTPSConnection if parsed.scheme == 'https'
+                       else HTTPConnection)
+        self.netloc = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self, path):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._klass(
+                self.netloc, timeout=self.timeout)
+        try:
+            connection.request('GET', self.prefix + path)
+            response = connection.getresponse()
+            response.read()
+        except Exception:
+            connection.close()
+            self._local.connection = None
+            raise
+        return response.status
+
+
+class Sample(object):
+    """The outcome of one request:  ``status`` is None if it raised.
+    """
+    def __init__(self, route, elapsed, status, error=None):
+        self.route = route
+        self.elapsed = elapsed
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.status is not None and self.status < 400
+
+
+def run(transport, plan, concurrency, clock=time.time):
+    """Send the ``plan`` requests from ``concurrency`` threads.
+
+    Return ``(samples, elapsed)``.
+    """
+    samples = []
+    lock = threading.Lock()
+    pending = iter(plan)
+
+    def _work():
+        while True:
+            with lock:
+                try:
+                    route, path = next(pending)
+                except StopIteration:
+                    return
+            started = clock()
+            try:
+                status, error = transport(path), None
+            except Exception as e:
+                status, error = None, '%s: %s' % (type(e).__name__, e)
+            samples.append(Sample(route, clock() - started, status, error))
+
+    started = clock()
+    threads = [threading.Thread(target=_work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, clock() - started
+
+
+def _stats(samples, elapsed):
+    timings = sorted(sample.elapsed for sample in samples)
+    errors = len([sample for sample in samples if not sample.ok])
+    statuses = {}
+    for sample in samples:
+        key = 'error' if sample.status is None else str(sample.status)
+        statuses[key] = statuses.get(key, 0) + 1
+    stats = {
+        'count': len(samples),
+        'errors': errors,
+        'error_rate': float(errors) / len(samples) if samples else 0.0,
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'statuses': statuses,
+        'mean': 0.0,
+        'p50': 0.0,
+        'p95': 0.0,
+        'p99': 0.0,
+        'max': 0.0,
+        }
+    if timings:
+        stats['mean'] = sum(timings) / len(timings)
+        stats['p50'] = percentile(timings, 0.50)
+        stats['p95'] = percentile(timings, 0.95)
+        stats['p99'] = percentile(timings, 0.99)
+        stats['max'] = timings[-1]
+    return stats
+
+
+def summarize(samples, elapsed):
+    """Compute statistics for each route, and for 'all' requests.
+
+    ``elapsed`` is the wall-clock time for the whole run.
+    """
+    by_route = {}
+    for sample in samples:
+        by_route.setdefault(sample.route, []).append(sample)
+    summary = {'all': _stats(samples, elapsed)}
+    for route, found in by_route.items():
+        summary[route] = _stats(found, elapsed)
+    return summary
+
+
+def _change(value, before):
+    if not before:
+        return '     -'
+    return '%+5.0f%%' % (100.0 * (value - before) / before)
+
+
+def format_summary(summary, baseline=None):
+    """Return the report's lines;  with a ``baseline`` summary, each route
+    is followed by the relative change in throughput and latencies.
+    """
+    lines = ['%-10s %7s %7s %9s %9s %9s %9s'
+             % ('route', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+                'p99 ms')]
+    for route in ROUTES + ('all',):
+        stats = summary.get(route)
+        if stats is None:
+            continue
+        lines.append('%-10s %7d %6.1f%% %9.1f %9.1f %9.1f %9.1f'
+                     % (route, stats['count'], 100.0 * stats['error_rate'],
+                        stats['throughput'], 1000 * stats['p50'],
+                        1000 * stats['p95'], 1000 * stats['p99']))
+        before = (baseline or {}).get(route)
+        if before is not None:
+            lines.append('%-10s %7s %+6.1f%% %9s %9s %9s %9s'
+                         % ('  vs base', '',
+                            100.0 * (stats['error_rate'] -
+                                     before['error_rate']),
+                            _change(stats['throughput'],
+                                    before['throughput']),
+                            _change(stats['p50'], before['p50']),
+                            _change(stats['p95'], before['p95']),
+                            _change(stats['p99'], before['p99'])))
+    return lines
+
+
+def main(argv=sys.argv[1:]):
+    parser = optparse.OptionParser(
+        usage="%prog [OPTIONS] (CONFIG_URI | --url URL)",
+        description="Load test the web application, reporting throughput, "
+                    "latency and errors for each route.")
+
+    parser.add_option(
+        '--url',
+        action='store',
+        dest='url',
+        default=None,
+        help="Send requests to the server at URL, rather than to the "
+             "application configured by CONFIG_URI in this process")
+
+    parser.add_option(
+        '-c', '--concurrency',
+        action='store',
+        type='int',
+        dest='concurrency',
+        default=10,
+        help="Number of concurrent clients (threads)")
+
+    parser.add_option(
+        '-n', '--requests',
+        action='store',
+        type='int',
+        dest='requests',
+        default=1000,
+        help="Number of requests to send")
+
+    parser.add_option(
+        '--warmup',
+        action='store',
+        type='int',
+        dest='warmup',
+        default=20,
+        help="Number of requests to send, and leave out of the report, "
+             "first")
+
+    parser.add_option(
+        '--mix',
+        action='store',
+        dest='mix',
+        default=DEFAULT_MIX,
+        help="Weight of each route (%s), as route=weight,... "
+             "(default: %s)" % (', '.join(ROUTES), DEFAULT_MIX))
+
+    parser.add_option(
+        '--employees',
+        action='store',
+        type='int',
+        dest='employees',
+        default=10,
+        help="Number of seeded employees to request")
+
+    parser.add_option(
+        '--reports',
+        action='store',
+        type='int',
+        dest='reports',
+        default=3,
+        help="Number of seeded reports per employee to request")
+
+    parser.add_option(
+        '--seed',
+        action='store_true',
+        dest='seed',
+        default=False,
+        help="Create the employees' reports first, if not there yet")
+
+    parser.add_option(
+        '--fake-backend',
+        action='store_true',
+        dest='fake_backend',
+        default=False,
+        help="Run the application against an in-memory datastore, seeded "
+             "first (no gcloud backend needed)")
+
+    parser.add_option(
+        '--items',
+        action='store',
+        type='int',
+        dest='items',
+        default=20,
+        help="Number of items in each seeded report")
+
+    parser.add_option(
+        '--random-seed',
+        action='store',
+        type='int',
+        dest='random_seed',
+        default=0,
+        help="Seed for the seeded data and the request plan, so that runs "
+             "are comparable")
+
+    parser.add_option(
+        '--save',
+        action='store',
+        dest='save',
+        default=None,
+        metavar='FILE',
+        help="Write the results to FILE, as JSON")
+
+    parser.add_option(
+        '--compare',
+        action='store',
+        dest='compare',
+        default=None,
+        metavar='FILE',
+        help="Compare the results with those saved in FILE")
+
+    options, args = parser.parse_args(argv)
+    if options.url is None:
+        try:
+            config_uri, = args
+        except ValueError:
+            parser.error('Specify one configuration file, or --url')
+    elif args:
+        parser.error('Specify either a configuration file or --url')
+    elif options.fake_backend:
+        parser.error('--fake-backend runs the application in this process:  '
+                     'specify a configuration file, not --url')
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if options.employees < 1 or options.reports < 1:
+        parser.error('Request at least one employee and report')
+    baseline = None
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)['routes']
+
+    rnd = random.Random(options.random_seed)
+    targets = seeded_reports(options.employees, options.reports)
+    if options.fake_backend:
+        # Before the application is imported;  see 'memory.install'.
+        from ..memory import install
+        install()
+    if options.seed or options.fake_backend:
+        created = seed(targets, options.items, rnd)
+        sys.stdout.write('Seeded %d reports (%d already there).\n'
+                         % (created, len(targets) - created))
+
+    if options.url is not None:
+        transport = HTTPTransport(options.url)
+    else:
+        from pyramid.paster import get_app
+        transport = WSGITransport(get_app(config_uri, 'main'))
+
+    run(transport, plan_requests(mix, targets, options.warmup, rnd),
+        options.concurrency)
+    samples, elapsed = run(
+        transport, plan_requests(mix, targets, options.requests, rnd),
+        options.concurrency)
+    summary = summarize(samples, elapsed)
+
+    sys.stdout.write('%d requests from %d clients in %.2fs\n'
+                     % (len(samples), options.concurrency, elapsed))
+    for line in format_summary(summary, baseline):
+        sys.stdout.write(line + '\n')
+    errors = {}
+    for sample in samples:
+        if sample.error is not None:
+            errors[sample.error] = errors.get(sample.error, 0) + 1
+    for error, count in sorted(errors.items(), key=lambda x: -x[1])[:5]:
+        sys.stdout.write('%6d x %s\n' % (count, error))
+
+    if options.save is not None:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'target': options.url or config_uri,
+                'concurrency': options.concurrency,
+                'requests': options.requests,
+                'mix': options.mix,
+                'routes': summary,
+                }, f, indent=2, sort_keys=True)
@@ -0,0 +1,70 @@
+""" Global ``--offline`` options for the :command:`submit_expenses` script.
+
+With ``--offline``, the ``create`` / ``update`` / ``delete`` commands queue
+their operation in a local outbox (see :mod:`gcloud_expenses.outbox`)
+rather than applying it;  the ``flush`` command, or a background flusher
+started by ``--background-flush``, sends the queued operations later.
+"""
+import contextlib
+
+from ..outbox import BackgroundFlusher
+
+
+def add_options(parser):
+    parser.add_option(
+        '--offline',
+        action='store_true',
+        dest='offline',
+        default=False,
+        help="Queue create / update / delete in the local outbox, "
+             "to be sent by 'flush'")
+
+    parser.add_option(
+        '--outbox',
+        action='store',
+        dest='outbox',
+        default=None,
+        metavar='PATH',
+        help="Path of the outbox file (default: $GCLOUD_EXPENSES_OUTBOX, "
+             "or ~/.gcloud_expenses/outbox.sqlite)")
+
+    parser.add_option(
+        '--background-flush',
+        action='store',
+        type='float',
+        dest='background_flush',
+        default=None,
+        metavar='SECONDS',
+        help="While running, flush the outbox every SECONDS, "
+             "then once more before exiting")
+
+
+def report_flush(driver, result):
+    """Log the outcome of a flush.
+    """
+    for op, message in result['failed']:
+        driver.error("Failed to %s %s/%s: %s"
+                     % (op.operation, op.employee_id, op.report_id, message))
+    if result['applied']:
+        driver.blather("Flushed %d queued operations." % result['applied'])
+    if result['error'] is not None:
+        driver.error("Backend unavailable, %d operations still queued: %s"
+                     % (result['remaining'], result['error']))
+
+
+@contextlib.contextmanager
+def background_flush(driver):
+    """Flush the outbox in a thread while the body runs, if asked to.
+    """
+    interval = driver.options.background_flush
+    if interval is None:
+        yield
+        return
+    flusher = BackgroundFlusher(driver.get_outbox(), interval,
+                                lambda result: report_flush(driver, result))
+    flusher.start()
+    try:
+        yield
+    finally:
+        flusher.stop()
+        flusher.flush_once()
@@ -0,0 +1,408 @@
+""" Prefork server for the :mod:`gcloud_expenses.webapp` application.
+
+The application is loaded once, in the master process, which then forks
+worker processes sharing its listening socket;  each worker serves requests
+on a waitress server with a few threads.  Handlers spend most of their time
+in Python code holding the GIL (rendering templates, encoding CSV / JSON),
+so that processes, rather than threads, are what let one box use all of
+its cores.
+
+The master replaces workers which exit, e.g. once they have served
+``--max-requests`` requests or grown past ``--max-memory``.  SIGHUP
+replaces all the workers;  SIGTERM or SIGINT stops them gracefully:  a
+stopping worker stops accepting connections, finishes the requests it has
+received, then exits.
+"""
+import errno
+import logging
+import optparse
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from configparser import ConfigParser
+except ImportError:  # pragma: no cover
+    from ConfigParser import ConfigParser
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 6543
+BACKLOG = 1024
+GRACEFUL_TIMEOUT = 30.0
+# Workers which die sooner than this are replaced only after this delay,
+# so that a broken application doesn't fork continuously.
+MIN_WORKER_LIFETIME = 1.0
+# Seconds between checks of a worker's memory use.
+MEMORY_CHECK_INTERVAL = 1.0
+# A stopping worker closes keep-alive connections idle for this long;  those
+# just accepted get the time to send their request.
+IDLE_GRACE = 0.5
+
+
+def server_settings(config_uri):
+    """Return ``(host, port)`` from the ``[server:main]`` section, if any.
+    """
+    path = config_uri.split('#')[0]
+    if path.startswith('config:'):
+        path = path[len('config:'):]
+    parser = ConfigParser()
+    parser.read(path)
+    host, port = DEFAULT_HOST, DEFAULT_PORT
+    if parser.has_section('server:main'):
+        if parser.has_option('server:main', 'host'):
+            host = parser.get('server:main', 'host')
+        if parser.has_option('server:main', 'port'):
+            port = int(parser.get('server:main', 'port'))
+    return host, port
+
+
+def bind_socket(host, port, backlog=BACKLOG):
+    """Return a socket listening on ``(host, port)``, for the workers.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def rss_bytes():
+    """Return this process's resident set size, in bytes.
+
+    Falls back to the peak size where ``/proc`` is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):  # pragma: no cover
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return peak
+        return peak * 1024
+
+
+def after_fork():
+    """Re-create per-process state in a newly forked worker.
+
+    Connections pooled before the fork would share their sockets, and HTTP
+    sessions, with the master and the other workers;  the random state
+    would be the same in each worker, giving them the same retry delays.
+    """
+    random.seed()
+    from .. import webapp
+    webapp.after_fork()
+
+
+class Worker(object):
+    """Serve ``app`` on ``sock`` until asked to stop;  run in the child.
+
+    ``max_requests`` and ``max_memory`` (in bytes) bound the requests
+    served and the memory used before the worker stops by itself;  zero
+    means no limit.
+    """
+    def __init__(self, app, sock, threads=4, max_requests=0, max_memory=0,
+                 graceful_timeout=GRACEFUL_TIMEOUT, clock=time.time):
+        self.app = app
+        self.sock = sock
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.graceful_timeout = graceful_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.served = 0
+        self.stopping = None  # the reason, once asked to stop
+        self.server = None
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.served += 1
+            if self.max_requests and self.served >= self.max_requests:
+                self.stop('served %d requests' % self.served)
+        return self.app(environ, start_response)
+
+    def stop(self, reason):
+        if self.stopping is None:
+            self.stopping = reason
+            if self.server is not None:
+                self.server.pull_trigger()
+
+    def _check_memory(self):
+        if self.max_memory:
+            rss = rss_bytes()
+            if rss > self.max_memory:
+                self.stop('using %d MB' % (rss // (1024 * 1024)))
+
+    def run(self):
+        from waitress.channel import HTTPChannel
+        from waitress.server import create_server
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: self.stop('terminated'))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        channels = {}
+        self.server = create_server(self, map=channels, sockets=[self.sock],
+                                    threads=self.threads)
+        asyncore = self.server.asyncore
+        next_check = self._clock()
+        while self.stopping is None:
+            asyncore.loop(timeout=MEMORY_CHECK_INTERVAL, map=channels,
+                          count=1)
+            if self._clock() >= next_check:
+                self._check_memory()
+                next_check = self._clock() + MEMORY_CHECK_INTERVAL
+        logger.info('Worker %d stopping: %s', os.getpid(), self.stopping)
+        # Stop accepting (leaving new connections to the other workers), but
+        # keep the trigger, which the task threads use to wake the loop.
+        asyncore.dispatcher.close(self.server)
+        deadline = self._clock() + self.graceful_timeout
+        while self._clock() < deadline:
+            open_channels = [x for x in list(channels.values())
+                             if isinstance(x, HTTPChannel)]
+            if not open_channels:
+                break
+            idle_since = self._clock() - IDLE_GRACE
+            for channel in open_channels:
+                if (not channel.requests and channel.request is None and
+                        not channel.total_outbufs_len and
+                        channel.last_activity <= idle_since):
+                    # Idle keep-alive connection:  the client reconnects
+                    # to another worker.
+                    channel.will_close = True
+            asyncore.loop(timeout=0.1, map=channels, count=1)
+        self.server.task_dispatcher.shutdown()
+
+
+class Arbiter(object):
+    """Keep ``workers`` worker processes running, in the master.
+
+    ``spawn()`` is called in each new child, and returns its exit status.
+    """
+    def __init__(self, spawn, workers, graceful_timeout=GRACEFUL_TIMEOUT,
+                 clock=time.time, sleep=time.sleep):
+        self.spawn = spawn
+        self.size = workers
+        self.graceful_timeout = graceful_timeout
+        self._clock = clock
+        self._sleep = sleep
+        self.workers = {}  # pid -> time spawned
+        self.retiring = set()
+        self.stopping = False
+        self.reloading = False
+        self._respawn_after = 0
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover  (child)
+            status = 1
+            try:
+                status = self.spawn() or 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        self.workers[pid] = self._clock()
+        logger.info('Started worker %d', pid)
+        return pid
+
+    def reap(self):
+        """Forget about workers which have exited;  return their pids.
+        """
+        reaped = []
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            started = self.workers.pop(pid, None)
+            self.retiring.discard(pid)
+            reaped.append(pid)
+            logger.info('Worker %d exited (status %d)', pid, status)
+            if (status and started is not None and
+                    self._clock() - started < MIN_WORKER_LIFETIME):
+                self._respawn_after = self._clock() + MIN_WORKER_LIFETIME
+        return reaped
+
+    def signal_workers(self, signum, pids=None):
+        for pid in list(self.workers if pids is None else pids):
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def maintain(self):
+        """Start enough workers to replace those exited or retiring.
+        """
+        if self._clock() < self._respawn_after:
+            return
+        while len(self.workers) - len(self.retiring) < self.size:
+            self.spawn_worker()
+
+    def reload(self):
+        """Replace all workers:  start new ones, then stop the old ones.
+        """
+        old = [pid for pid in self.workers if pid not in self.retiring]
+        self.retiring.update(old)
+        self.maintain()
+        self.signal_workers(signal.SIGTERM, old)
+
+    def stop(self):
+        """Stop the workers gracefully, killing those which take too long.
+        """
+        self.signal_workers(signal.SIGTERM)
+        deadline = self._clock() + self.graceful_timeout
+        while self.workers and self._clock() < deadline:
+            self.reap()
+            self._sleep(0.1)
+        if self.workers:
+            logger.warning('Killing %d workers', len(self.workers))
+            self.signal_workers(signal.SIGKILL)
+            while self.workers:
+                self.reap()
+                self._sleep(0.1)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        self.maintain()
+        while not self.stopping:
+            self.reap()
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            self.maintain()
+            self._sleep(0.2)
+        self.stop()
+
+
+def main(argv=sys.argv[1:]):
+    parser = optparse.OptionParser(
+        usage="%prog [OPTIONS] CONFIG_URI",
+        description="Serve the web application from several processes.")
+
+    parser.add_option(
+        '-w', '--workers',
+        action='store',
+        type='int',
+        dest='workers',
+        default=None,
+        help="Number of worker processes (default: one per CPU)")
+
+    parser.add_option(
+        '-t', '--threads',
+        action='store',
+        type='int',
+        dest='threads',
+        default=4,
+        help="Number of request threads in each worker")
+
+    parser.add_option(
+        '--host',
+        action='store',
+        dest='host',
+        default=None,
+        help="Address to listen on (default: from [server:main])")
+
+    parser.add_option(
+        '--port',
+        action='store',
+        type='int',
+        dest='port',
+        default=None,
+        help="Port to listen on (default: from [server:main])")
+
+    parser.add_option(
+        '--max-requests',
+        action='store',
+        type='int',
+        dest='max_requests',
+        default=0,
+        help="Replace each worker after it serves about this many "
+             "requests (default: never)")
+
+    parser.add_option(
+        '--max-requests-jitter',
+        action='store',
+        type='int',
+        dest='max_requests_jitter',
+        default=0,
+        help="Add up to this many requests to each worker's "
+             "--max-requests, so that workers are not replaced together")
+
+    parser.add_option(
+        '--max-memory',
+        action='store',
+        type='int',
+        dest='max_memory',
+        default=0,
+        help="Replace a worker once it uses more than this many MB "
+             "(default: never)")
+
+    parser.add_option(
+        '--graceful-timeout',
+        action='store',
+        type='float',
+        dest='graceful_timeout',
+        default=GRACEFUL_TIMEOUT,
+        help="Seconds a stopping worker may spend finishing its requests")
+
+    options, args = parser.parse_args(argv)
+    try:
+        config_uri, = args
+    except ValueError:
+        parser.error('Specify one configuration file')
+
+    from pyramid.paster import get_app
+    from pyramid.paster import setup_logging
+    setup_logging(config_uri)
+    host, port = server_settings(config_uri)
+    if options.host is not None:
+        host = options.host
+    if options.port is not None:
+        port = options.port
+    workers = options.workers
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+
+    # Load the application before forking, so that the workers share its
+    # code and templates, and start serving at once.
+    app = get_app(config_uri, 'main')
+    sock = bind_socket(host, port)
+    logger.info('Serving on http://%s:%d with %d workers', host, port,
+                workers)
+
+    def _spawn():
+        after_fork()
+        max_requests = options.max_requests
+        if max_requests and options.max_requests_jitter:
+            max_requests += random.randint(0, options.max_requests_jitter)
+        Worker(app, sock, options.threads, max_requests,
+               options.max_memory * 1024 * 1024,
+               options.graceful_timeout).run()
+        return 0
+
+    Arbiter(_spawn, workers, options.graceful_timeout).run()
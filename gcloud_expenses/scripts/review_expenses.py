@@ -2,14 +2,34 @@ import csv
 import optparse
 import os
 import textwrap
+import time
 import sys
 
+from .. import BadReportStatus
 from .. import NoSuchReport
+from .. import RetriesExhausted
 from .. import approve_report
+from .. import backup_expenses
 from .. import get_report_info
-from .. import initialize_gcloud
 from .. import list_reports
+from .. import new_client
+from .. import next_reports_to_review
+from .. import rebuild_review_queue
+from .. import rebuild_search_index
 from .. import reject_report
+from .. import restore_expenses
+from .. import scan_duplicates
+from .. import search_expenses
+from ..archive import ArchiveError
+from ..archive import parse_timestamp
+from ..archive import read_manifest
+from ..batch import run_batch
+from ..batch import summarize
+from ..clients import ThreadClients
+from .. import tracing
+from . import jobs
+from . import shell
+from . import timings
 
 
 class InvalidCommandLine(ValueError):
@@ -24,6 +44,20 @@ class NotACommand(object):
         raise InvalidCommandLine('Not a command: %s' % self.bogus)
 
 
+def _get_batch(args):
+    try:
+        batch_file, = args
+    except:
+        raise InvalidCommandLine("Specify one CSV file, or '-' for stdin")
+    if batch_file == '-':
+        return list(csv.reader(sys.stdin))
+    batch_file = os.path.abspath(os.path.normpath(batch_file))
+    if not os.path.exists(batch_file):
+        raise InvalidCommandLine('Invalid CSV file: %s' % batch_file)
+    with open(batch_file) as f:
+        return list(csv.reader(f))
+
+
 def _get_csv(args):
     try:
         csv_file, = args
@@ -77,6 +111,204 @@ class ListReports(object):
         writer.writerow([x[1] for x in _cols])
         for report in list_reports(self.employee_id, self.status):
             writer.writerow([report[x[0]] for x in _cols])
+            tracing.count('rows')
+
+
+class ReviewQueue(object):
+    """List the next pending expense reports to review, oldest first.
+    """
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS]")
+
+        parser.add_option(
+            '-n', '--limit',
+            action='store',
+            type='int',
+            dest='limit',
+            default=10,
+            help="Number of expense reports to list")
+
+        parser.add_option(
+            '--rebuild',
+            action='store_true',
+            dest='rebuild',
+            default=False,
+            help="Rebuild the review queue from all pending reports first")
+
+        options, args = parser.parse_args(args)
+        self.limit = options.limit
+        self.rebuild = options.rebuild
+
+    def __call__(self):
+        if self.rebuild:
+            count = rebuild_review_queue()
+            self.submitter.blather("Rebuilt review queue: %d reports" % count)
+        _cols = [
+            ('employee_id', 'Employee ID'),
+            ('report_id', 'Report ID'),
+            ('submitted', 'Submitted'),
+            ('description', 'Description'),
+            ('total', 'Total'),
+            ]
+        writer = csv.writer(sys.stdout)
+        writer.writerow([x[1] for x in _cols])
+        for report in next_reports_to_review(self.limit):
+            writer.writerow([report[x[0]] for x in _cols])
+            tracing.count('rows')
+
+
+class SearchExpenses(object):
+    """Search expense item vendors and memos, listing the best matches.
+    """
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS] TEXT...")
+
+        parser.add_option(
+            '-n', '--limit',
+            action='store',
+            type='int',
+            dest='limit',
+            default=20,
+            help="Number of matches to list")
+
+        parser.add_option(
+            '-o', '--offset',
+            action='store',
+            type='int',
+            dest='offset',
+            default=0,
+            help="Number of matches to skip")
+
+        parser.add_option(
+            '--reports',
+            action='store_true',
+            dest='reports',
+            default=False,
+            help="List matching reports, rather than items")
+
+        parser.add_option(
+            '--rebuild',
+            action='store_true',
+            dest='rebuild',
+            default=False,
+            help="Rebuild the search index from all reports first")
+
+        options, args = parser.parse_args(args)
+        if not args:
+            raise InvalidCommandLine('Specify text to search for')
+        self.text = ' '.join(args)
+        self.limit = options.limit
+        self.offset = options.offset
+        self.reports = options.reports
+        self.rebuild = options.rebuild
+
+    def __call__(self):
+        if self.rebuild:
+            count = rebuild_search_index()
+            self.submitter.blather("Rebuilt search index: %d reports" % count)
+        found = search_expenses(self.text, self.limit, self.offset)
+        if self.reports:
+            key, total = 'reports', found['total_reports']
+            _cols = [
+                ('employee_id', 'Employee ID'),
+                ('report_id', 'Report ID'),
+                ('status', 'Status'),
+                ('description', 'Description'),
+                ('items', 'Matching Items'),
+                ]
+        else:
+            key, total = 'items', found['total_items']
+            _cols = [
+                ('employee_id', 'Employee ID'),
+                ('report_id', 'Report ID'),
+                ('Date', 'Date'),
+                ('Vendor', 'Vendor'),
+                ('Price', 'Price'),
+                ('Memo', 'Memo'),
+                ]
+        writer = csv.writer(sys.stdout)
+        writer.writerow([x[1] for x in _cols])
+        for hit in found[key]:
+            writer.writerow([hit.get(x[0], '') for x in _cols])
+            tracing.count('rows')
+        self.submitter.blather("--------------------------")
+        self.submitter.blather("Showing %d-%d of %d %s"
+                               % (min(self.offset + 1, total),
+                                  self.offset + len(found[key]),
+                                  total, key))
+
+
+class FindDuplicates(object):
+    """Scan all expense items for charges appearing on more than one
+    report, allowing for small differences in date and amount.
+    """
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS]")
+
+        parser.add_option(
+            '--date-tolerance',
+            action='store',
+            type='int',
+            dest='date_tolerance',
+            default=0,
+            help="Days by which the dates of matching charges may differ")
+
+        parser.add_option(
+            '--amount-tolerance',
+            action='store',
+            type='float',
+            dest='amount_tolerance',
+            default=0.0,
+            help="Amount by which matching charges may differ")
+
+        parser.add_option(
+            '--partitions',
+            action='store',
+            type='int',
+            dest='partitions',
+            default=1,
+            help="Scan in this many passes, by vendor, to bound memory use")
+
+        options, args = parser.parse_args(args)
+        if options.date_tolerance < 0 or options.amount_tolerance < 0:
+            raise InvalidCommandLine('Tolerances must not be negative')
+        if options.partitions < 1:
+            raise InvalidCommandLine('Specify at least one partition')
+        self.date_tolerance = options.date_tolerance
+        self.cents_tolerance = int(round(options.amount_tolerance * 100))
+        self.partitions = options.partitions
+
+    def __call__(self):
+        _cols = [
+            ('employee_id', 'Employee ID'),
+            ('report_id', 'Report ID'),
+            ('item', 'Item'),
+            ('Date', 'Date'),
+            ('Vendor', 'Vendor'),
+            ('Price', 'Price'),
+            ('other_employee_id', 'Other Employee ID'),
+            ('other_report_id', 'Other Report ID'),
+            ('other_item', 'Other Item'),
+            ]
+        writer = csv.writer(sys.stdout)
+        writer.writerow([x[1] for x in _cols])
+        count = 0
+        for dup in scan_duplicates(self.date_tolerance, self.cents_tolerance,
+                                   self.partitions):
+            writer.writerow([dup.get(x[0], '') for x in _cols])
+            count += 1
+        tracing.count('rows', count)
+        self.submitter.blather("--------------------------")
+        self.submitter.blather("Possible duplicates: %d" % count)
 
 
 class ShowReport(object):
@@ -113,6 +345,7 @@ class ShowReport(object):
             writer.writerow([x for x in _cols])
             for item in info['items']:
                 writer.writerow([item[x] for x in _cols])
+                tracing.count('rows')
 
 
 class ApproveReport(object):
@@ -176,11 +409,277 @@ class RejectReport(object):
                                (self.employee_id, self.report_id, memo))
 
 
+class _BatchCommand(object):
+    """Base class for bulk approve / reject commands.
+
+    Reads ``EMPLOYEE_ID,REPORT_ID[,MEMO]`` rows from a CSV file (or stdin),
+    processing distinct reports concurrently:  each is passed to the
+    command's ``operation``, as ``operation(employee_id, report_id, memo,
+    connection=...)``, with a connection of the worker thread's own.
+    """
+    verb = None
+    memo_format = None
+    operation = None
+    new_client = staticmethod(new_client)
+
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS] CSV_FILE")
+
+        parser.add_option(
+            '-j', '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=8,
+            help="Number of reports to process concurrently")
+
+        options, args = parser.parse_args(args)
+        self.workers = options.workers
+        self.items = []
+        for row in _get_batch(args):
+            row = [x.strip() for x in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) < 2:
+                raise InvalidCommandLine(
+                    'Specify employee ID, report ID: %s' % ','.join(row))
+            memo = row[2] if len(row) > 2 else None
+            self.items.append((row[0], row[1], memo))
+
+    def __call__(self):
+        clients = ThreadClients(self.new_client)
+
+        def _process(item):
+            return self.operation(*item, connection=clients().connection)
+
+        started = time.time()
+        results = run_batch(_process,
+                            self.items,
+                            key=lambda item: item[:2],
+                            workers=self.workers)
+        stats = summarize(results, time.time() - started)
+        tracing.count('rows', stats['count'])
+        for result in results:
+            employee_id, report_id, memo = result.item
+            if result.ok:
+                memo = '' if not memo else self.memo_format % memo
+                self.submitter.blather("%s report: %s/%s%s" %
+                                       (self.verb, employee_id, report_id,
+                                        memo))
+            elif isinstance(result.error, NoSuchReport):
+                self.submitter.blather("No such report: %s/%s"
+                                       % (employee_id, report_id))
+            elif isinstance(result.error, BadReportStatus):
+                self.submitter.blather("Invalid report status: %s/%s, %s"
+                                       % (employee_id, report_id,
+                                          str(result.error)))
+            elif isinstance(result.error, RetriesExhausted):
+                self.submitter.blather("Too much contention: %s/%s, %s"
+                                       % (employee_id, report_id,
+                                          str(result.error)))
+            else:
+                self.submitter.blather("Failed report: %s/%s, %s: %s"
+                                       % (employee_id, report_id,
+                                          type(result.error).__name__,
+                                          str(result.error)))
+        self.submitter.blather("--------------------------")
+        self.submitter.blather("Processed %(count)d reports in %(elapsed).2fs "
+                               "(%(throughput).1f/s): %(succeeded)d "
+                               "succeeded, %(failed)d failed" % stats)
+        self.submitter.blather("Per-report seconds: mean %(mean).3f, "
+                               "p50 %(p50).3f, p95 %(p95).3f, max %(max).3f"
+                               % stats)
+
+
+def _approve(employee_id, report_id, check_number, connection=None):
+    approve_report(employee_id, report_id, check_number or '',
+                   connection=connection)
+
+
+class BulkApproveReports(_BatchCommand):
+    """Approve expense reports listed in a CSV file (or stdin) of
+    employee ID, report ID, check number.
+    """
+    verb = 'Approved'
+    memo_format = ', check #%s'
+    operation = staticmethod(_approve)
+
+
+class BulkRejectReports(_BatchCommand):
+    """Reject expense reports listed in a CSV file (or stdin) of
+    employee ID, report ID, reason.
+    """
+    verb = 'Rejected'
+    memo_format = ', reason: %s'
+    operation = staticmethod(reject_report)
+
+
+def _format_counts(counts):
+    return ', '.join(['%s: %d' % x for x in sorted(counts.items())])
+
+
+class BackupExpenses(object):
+    """Write a snapshot of all employees, reports, items and receipts to a
+    directory of compressed, checksummed chunks;  optionally incremental.
+    """
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS] DIRECTORY")
+
+        parser.add_option(
+            '--since',
+            action='store',
+            dest='since',
+            default=None,
+            help="Back up only reports updated after this UTC time "
+                 "(YYYY-MM-DD[THH:MM:SS])")
+
+        parser.add_option(
+            '--base',
+            action='store',
+            dest='base',
+            default=None,
+            help="Back up only changes since the backup in this directory")
+
+        parser.add_option(
+            '-j', '--shards',
+            action='store',
+            type='int',
+            dest='shards',
+            default=8,
+            help="Number of shards written concurrently")
+
+        parser.add_option(
+            '--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=64,
+            help="Megabytes of records per chunk, before compression")
+
+        parser.add_option(
+            '--no-receipts',
+            action='store_false',
+            dest='receipts',
+            default=True,
+            help="Skip receipt images")
+
+        options, args = parser.parse_args(args)
+        try:
+            self.directory, = args
+        except:
+            raise InvalidCommandLine('Specify one directory')
+        if options.since is not None and options.base is not None:
+            raise InvalidCommandLine('Specify at most one of --since, --base')
+        try:
+            if options.since is not None:
+                self.since = parse_timestamp(options.since)
+            elif options.base is not None:
+                self.since = parse_timestamp(
+                    read_manifest(options.base)['started'])
+            else:
+                self.since = None
+        except (ArchiveError, ValueError) as e:
+            raise InvalidCommandLine(str(e))
+        if options.shards < 1 or options.chunk_size < 1:
+            raise InvalidCommandLine('Shards and chunk size must be positive')
+        self.shards = options.shards
+        self.chunk_bytes = options.chunk_size * 1024 * 1024
+        self.receipts = options.receipts
+
+    def __call__(self):
+        started = time.time()
+        try:
+            manifest = backup_expenses(self.directory, self.since,
+                                       self.shards, self.receipts,
+                                       self.chunk_bytes)
+        except ArchiveError as e:
+            raise InvalidCommandLine(str(e))
+        counts = manifest['counts']
+        tracing.count('rows', counts.get('item', 0))
+        tracing.count('bytes', sum([x['bytes'] for x in manifest['chunks']]))
+        self.submitter.blather("Backed up to: %s%s" % (
+            self.directory,
+            ' (changes since %s)' % manifest['since']
+            if manifest['since'] else ''))
+        self.submitter.blather(_format_counts(counts))
+        self.submitter.blather("%d chunks, %d bytes in %.1fs" % (
+            len(manifest['chunks']),
+            sum([x['bytes'] for x in manifest['chunks']]),
+            time.time() - started))
+
+
+class RestoreExpenses(object):
+    """Restore a snapshot written by 'backup', replacing the reports it
+    holds;  restore incremental backups after the one they are based on.
+    """
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS] DIRECTORY")
+
+        parser.add_option(
+            '-j', '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=8,
+            help="Number of chunks restored concurrently")
+
+        parser.add_option(
+            '--prune',
+            action='store_true',
+            dest='prune',
+            default=False,
+            help="Delete reports which are not in the backup")
+
+        parser.add_option(
+            '--no-receipts',
+            action='store_false',
+            dest='receipts',
+            default=True,
+            help="Skip receipt images")
+
+        options, args = parser.parse_args(args)
+        try:
+            self.directory, = args
+        except:
+            raise InvalidCommandLine('Specify one directory')
+        self.workers = options.workers
+        self.prune = options.prune
+        self.receipts = options.receipts
+
+    def __call__(self):
+        started = time.time()
+        try:
+            counts = restore_expenses(self.directory, self.workers,
+                                      self.prune, self.receipts)
+        except ArchiveError as e:
+            raise InvalidCommandLine(str(e))
+        tracing.count('rows', counts.get('item', 0))
+        self.submitter.blather("Restored from: %s" % self.directory)
+        self.submitter.blather(_format_counts(counts))
+        self.submitter.blather("Done in %.1fs" % (time.time() - started))
+
+
 _COMMANDS = {
     'list': ListReports,
+    'queue': ReviewQueue,
+    'search': SearchExpenses,
+    'duplicates': FindDuplicates,
     'show': ShowReport,
     'approve': ApproveReport,
     'reject': RejectReport,
+    'bulk-approve': BulkApproveReports,
+    'bulk-reject': BulkRejectReports,
+    'backup': BackupExpenses,
+    'restore': RestoreExpenses,
 }
 
 
@@ -244,6 +743,12 @@ class ReviewExpenses(object):
             default=1,
             help="Increase verbosity")
 
+        timings.add_options(parser)
+
+        jobs.add_options(parser)
+
+        shell.add_options(parser)
+
         options, args = parser.parse_args(mine)
 
         self.options = options
@@ -272,11 +777,16 @@ class ReviewExpenses(object):
     def __call__(self):
         """ Invoke sub-commands parsed by :meth:`parse_arguments`.
         """
+        if self.options.batch:
+            if self.commands:
+                raise InvalidCommandLine('Commands not allowed with --batch')
+            shell.run_batch(self, ReviewExpenses, InvalidCommandLine)
+            return
+
         if not self.commands:
             raise InvalidCommandLine('No commands specified')
 
-        for command in self.commands:
-            command()
+        timings.run_commands(self, _COMMANDS)
 
     def _print(self, text):  # pragma NO COVERAGE
         sys.stdout.write('%s\n' % text)
@@ -290,7 +800,6 @@ class ReviewExpenses(object):
 
 
 def main(argv=sys.argv[1:]):
-    initialize_gcloud()
     try:
         ReviewExpenses(argv)()
     except InvalidCommandLine as e:  # pragma NO COVERAGE
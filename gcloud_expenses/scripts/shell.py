@@ -0,0 +1,108 @@
+""" Global ``--batch`` option for the script drivers.
+
+Runs many commands, one per line, in a single process, so that imports,
+client initialization and connections are paid for once.  Each line is
+parsed as a full command line for the script (global options included),
+and reported as a JSON object on its own line::
+
+  {"argv": [...], "error": null, "line": 1, "ok": true,
+   "output": [...], "seconds": 0.041}
+"""
+import json
+import shlex
+import sys
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:  # pragma: no cover
+    from io import StringIO
+
+
+def add_options(parser):
+    parser.add_option(
+        '-b', '--batch',
+        action='store',
+        dest='batch',
+        default=None,
+        metavar='FILE',
+        help="Run commands read one per line from FILE ('-' for stdin), "
+             "reporting results as JSON lines")
+
+
+def iter_command_lines(stream):
+    """Yield ``(line_number, line)`` for non-blank, non-comment lines.
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield number, line
+
+
+def run_line(factory, invalid, line):
+    """Parse and run one command line;  return the result mapping.
+
+    ``factory(argv, logger)`` makes a driver;  ``invalid`` is the script's
+    'InvalidCommandLine' exception.  Text written to stdout and stderr by
+    the commands (e.g. CSV listings, or usage errors from 'optparse') is
+    captured along with their log output.  A line which can't be split into
+    arguments, or whose options are rejected, is reported as an error.
+    """
+    argv = None
+    output = []
+    error = None
+    started = time.time()
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        try:
+            argv = shlex.split(line)
+            driver = factory(argv, output.append)
+            if driver.options.batch:
+                raise invalid('Nested --batch not allowed')
+            driver()
+        except invalid as e:
+            error = str(e)
+        except SystemExit as e:
+            # 'optparse' exits after writing usage errors (or '--help').
+            if e.code not in (None, 0):
+                lines = sys.stderr.getvalue().splitlines()
+                error = lines[-1] if lines else 'Exit status: %s' % e.code
+        except Exception as e:
+            if argv is None:
+                error = 'Invalid command line: %s' % e
+            else:
+                error = '%s: %s' % (type(e).__name__, e)
+    finally:
+        captured = sys.stdout.getvalue() + sys.stderr.getvalue()
+        sys.stdout, sys.stderr = saved
+    output.extend(captured.splitlines())
+    return {
+        'argv': argv,
+        'ok': error is None,
+        'error': error,
+        'output': output,
+        'seconds': round(time.time() - started, 6),
+        }
+
+
+def run_batch(driver, factory, invalid):
+    """Run the commands named by ``driver.options.batch``.
+    """
+    filename = driver.options.batch
+    if filename == '-':
+        stream = sys.stdin
+    else:
+        try:
+            stream = open(filename)
+        except IOError:
+            raise invalid('Invalid batch file: %s' % filename)
+    try:
+        for number, line in iter_command_lines(stream):
+            result = run_line(factory, invalid, line)
+            result['line'] = number
+            driver.logger(json.dumps(result, sort_keys=True))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
@@ -1,4 +1,3 @@
-import csv
 import optparse
 import os
 import textwrap
@@ -8,10 +7,21 @@ import sys
 from .. import BadReportStatus
 from .. import DuplicateReport
 from .. import NoSuchReport
+from .. import RetriesExhausted
 from .. import create_report
 from .. import delete_report
-from .. import initialize_gcloud
+from .. import find_duplicate_items
 from .. import update_report
+from .. import tracing
+from ..outbox import DEFAULT_PATH as DEFAULT_OUTBOX
+from ..outbox import Outbox
+from ..outbox import flush
+from ..schema import InvalidRows
+from ..schema import parse_csv
+from . import jobs
+from . import offline
+from . import shell
+from . import timings
 
 
 class InvalidCommandLine(ValueError):
@@ -35,7 +45,18 @@ def _get_csv(args):
     if not os.path.exists(csv_file):
         raise InvalidCommandLine('Invalid CSV file: %s' % csv_file)
     with open(csv_file) as f:
-        return csv_file, list(csv.DictReader(f))
+        try:
+            return csv_file, parse_csv(f)
+        except InvalidRows as e:
+            raise InvalidCommandLine('Invalid CSV file: %s\n%s'
+                                     % (csv_file, str(e)))
+
+
+def _enqueue(submitter, operation, employee_id, report_id, **payload):
+    submitter.get_outbox().append(operation, employee_id, report_id,
+                                  **payload)
+    submitter.blather("Queued %s: %s/%s"
+                      % (operation, employee_id, report_id))
 
 
 class _Command(object):
@@ -68,37 +89,74 @@ class _Command(object):
             default='',
             help="Short description of the expense report")
 
+        parser.add_option(
+            '--no-duplicate-check',
+            action='store_false',
+            dest='check_duplicates',
+            default=True,
+            help="Don't flag charges already submitted on other reports")
+
         options, args = parser.parse_args(args)
         self.employee_id = options.employee_id
         self.report_id = options.report_id
         self.description = options.description
+        self.check_duplicates = options.check_duplicates
         self.filename, self.rows = _get_csv(args)
         if self.report_id is None:
             fn = os.path.basename(self.filename)
             base, _ = os.path.splitext(fn)
             self.report_id = base
 
+    def enqueue(self, operation):
+        _enqueue(self.submitter, operation, self.employee_id,
+                 self.report_id, rows=self.rows,
+                 description=self.description)
+        tracing.count('rows', len(self.rows))
+
+    def report_duplicates(self):
+        if not self.check_duplicates:
+            return
+        for dup in find_duplicate_items(self.employee_id, self.report_id,
+                                        self.rows):
+            self.submitter.blather(
+                "Possible duplicate: item %d (%s, %s, %s) also on %s/%s"
+                % (dup['item'], dup['Date'], dup['Vendor'], dup['amount'],
+                   dup['other_employee_id'], dup['other_report_id']))
+
 
 class CreateReport(_Command):
     """Create a new expense report from a CSV file.
     """
     def __call__(self):
+        if self.submitter.options.offline:
+            self.enqueue('create')
+            return
         try:
             create_report(self.employee_id, self.report_id, self.rows,
                           self.description)
         except DuplicateReport:
             self.submitter.blather("Report already exists: %s/%s"
                                    % (self.employee_id, self.report_id))
+        except RetriesExhausted as e:
+            self.submitter.blather("Too much contention: %s/%s, %s"
+                                   % (self.employee_id, self.report_id,
+                                      str(e)))
         else:
             self.submitter.blather("Created report: %s/%s"
                                    % (self.employee_id, self.report_id))
             self.submitter.blather("Processed %d rows." % len(self.rows))
+            tracing.count('rows', len(self.rows))
+            tracing.count('bytes', os.path.getsize(self.filename))
+            self.report_duplicates()
 
 
 class UpdateReport(_Command):
     """Update an existing expense report from a CSV file.
     """
     def __call__(self):
+        if self.submitter.options.offline:
+            self.enqueue('update')
+            return
         try:
             update_report(self.employee_id, self.report_id, self.rows,
                           self.description)
@@ -109,10 +167,17 @@ class UpdateReport(_Command):
             self.submitter.blather("Invalid report status: %s/%s, %s"
                                    % (self.employee_id, self.report_id,
                                       str(e)))
+        except RetriesExhausted as e:
+            self.submitter.blather("Too much contention: %s/%s, %s"
+                                   % (self.employee_id, self.report_id,
+                                      str(e)))
         else:
             self.submitter.blather("Updated report: %s/%s"
                                    % (self.employee_id, self.report_id))
             self.submitter.blather("Processed %d rows." % len(self.rows))
+            tracing.count('rows', len(self.rows))
+            tracing.count('bytes', os.path.getsize(self.filename))
+            self.report_duplicates()
 
 
 class DeleteReport(object):
@@ -148,6 +213,10 @@ class DeleteReport(object):
         self.force = options.force
 
     def __call__(self):
+        if self.submitter.options.offline:
+            _enqueue(self.submitter, 'delete', self.employee_id,
+                     self.report_id, force=self.force)
+            return
         try:
             count = delete_report(self.employee_id, self.report_id, self.force)
         except NoSuchReport:
@@ -157,16 +226,76 @@ class DeleteReport(object):
             self.submitter.blather("Invalid report status: %s/%s, %s"
                                    % (self.employee_id, self.report_id,
                                       str(e)))
+        except RetriesExhausted as e:
+            self.submitter.blather("Too much contention: %s/%s, %s"
+                                   % (self.employee_id, self.report_id,
+                                      str(e)))
         else:
             self.submitter.blather("Deleted report: %s/%s"
                                    % (self.employee_id, self.report_id))
             self.submitter.blather("Removed %d items." % count)
 
 
+class FlushOutbox(object):
+    """Send the operations queued in the outbox by '--offline' commands.
+    """
+    def __init__(self, submitter, *args):
+        self.submitter = submitter
+        args = list(args)
+        parser = optparse.OptionParser(
+            usage="%prog [OPTIONS]")
+
+        parser.add_option(
+            '-n', '--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=50,
+            help="Number of queued operations sent per batch")
+
+        parser.add_option(
+            '-w', '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=4,
+            help="Number of reports updated concurrently")
+
+        parser.add_option(
+            '-l', '--list',
+            action='store_true',
+            dest='list_only',
+            default=False,
+            help="List queued and failed operations, without sending them")
+
+        options, args = parser.parse_args(args)
+        if args:
+            raise InvalidCommandLine('Unexpected arguments: %s'
+                                     % ' '.join(args))
+        self.batch_size = options.batch_size
+        self.workers = options.workers
+        self.list_only = options.list_only
+
+    def __call__(self):
+        outbox = self.submitter.get_outbox()
+        if self.list_only:
+            for op in outbox.pending() + outbox.failed():
+                self.submitter.blather(
+                    "%-7s %-6s %s/%s%s"
+                    % (op.status, op.operation, op.employee_id,
+                       op.report_id,
+                       op.last_error and ' (%s)' % op.last_error or ''))
+            return
+        result = flush(outbox, self.batch_size, self.workers)
+        offline.report_flush(self.submitter, result)
+        self.submitter.blather("%d operations queued." % result['remaining'])
+
+
 _COMMANDS = {
     'create': CreateReport,
     'update': UpdateReport,
     'delete': DeleteReport,
+    'flush': FlushOutbox,
 }
 
 
@@ -181,8 +310,9 @@ def get_description(command):
 class SubmitExpenses(object):
     """ Driver for the :command:`submit_expenses` command-line script.
     """
-    def __init__(self, argv=None, logger=None):
+    def __init__(self, argv=None, logger=None, outbox=None):
         self.commands = []
+        self._outbox = outbox
         if logger is None:
             logger = self._print
         self.logger = logger
@@ -230,6 +360,14 @@ class SubmitExpenses(object):
             default=1,
             help="Increase verbosity")
 
+        timings.add_options(parser)
+
+        jobs.add_options(parser)
+
+        shell.add_options(parser)
+
+        offline.add_options(parser)
+
         options, args = parser.parse_args(mine)
 
         self.options = options
@@ -258,11 +396,35 @@ class SubmitExpenses(object):
     def __call__(self):
         """ Invoke sub-commands parsed by :meth:`parse_arguments`.
         """
+        if self.options.batch:
+            if self.commands:
+                raise InvalidCommandLine('Commands not allowed with --batch')
+            with offline.background_flush(self):
+                shell.run_batch(self, self._make_batch_driver,
+                                InvalidCommandLine)
+            return
+
         if not self.commands:
             raise InvalidCommandLine('No commands specified')
 
-        for command in self.commands:
-            command()
+        with offline.background_flush(self):
+            timings.run_commands(self, _COMMANDS)
+
+    def get_outbox(self):
+        """ Return the outbox, shared by all commands in this run.
+        """
+        if self._outbox is None:
+            self._outbox = Outbox(self.options.outbox or DEFAULT_OUTBOX)
+        return self._outbox
+
+    def _make_batch_driver(self, argv, logger):
+        # Lines share this run's outbox, and its '--offline'.
+        if self.options.offline:
+            self.get_outbox()
+        driver = SubmitExpenses(argv, logger, outbox=self._outbox)
+        if self.options.offline:
+            driver.options.offline = True
+        return driver
 
     def _print(self, text):  # pragma NO COVERAGE
         sys.stdout.write('%s\n' % text)
@@ -276,7 +438,6 @@ class SubmitExpenses(object):
 
 
 def main(argv=sys.argv[1:]):
-    initialize_gcloud()
     try:
         SubmitExpenses(argv)()
     except InvalidCommandLine as e:  # pragma NO COVERAGE
@@ -0,0 +1,133 @@
+import unittest
+
+
+class _Command(object):
+
+    def __init__(self, driver, name, employee_id=None, report_id=None,
+                 delay=0.0, error=None):
+        self.driver = driver
+        self.name = name
+        if employee_id is not None:
+            self.employee_id = employee_id
+            self.report_id = report_id
+        self.delay = delay
+        self.error = error
+
+    def __call__(self):
+        import sys
+        import time
+        self.driver.logger('%s: start' % self.name)
+        time.sleep(self.delay)
+        sys.stdout.write('%s: stdout\n' % self.name)
+        self.driver.logger('%s: end' % self.name)
+        self.driver.ran.append(self.name)
+        if self.error is not None:
+            raise self.error
+
+
+class _Client(object):
+
+    def __init__(self):
+        self.connection = object()
+
+
+class _Driver(object):
+
+    def __init__(self):
+        self.logged = []
+        self.logger = self.logged.append
+        self.commands = []
+        self.ran = []
+
+
+class Test_job_key(unittest.TestCase):
+
+    def _callFUT(self, command):
+        from .jobs import job_key
+        return job_key(command)
+
+    def test_it(self):
+        driver = _Driver()
+        self.assertEqual(self._callFUT(_Command(driver, 'a', 'sally', 'r1')),
+                         ('sally', 'r1'))
+        self.assertTrue(self._callFUT(_Command(driver, 'b')) is None)
+
+
+class Test_run_concurrently(unittest.TestCase):
+
+    def _callFUT(self, driver, jobs=4, run_one=None):
+        from .jobs import run_concurrently
+        if run_one is None:
+            run_one = lambda index, command: command()
+        self.clients = []
+        def _new_client():
+            self.clients.append(_Client())
+            return self.clients[-1]
+        return run_concurrently(driver, run_one, jobs, _new_client)
+
+    def test_client_per_thread(self):
+        import threading
+        from ..clients import current
+        from .jobs import current_client
+        driver = _Driver()
+        driver.commands = [_Command(driver, str(x), 'sally', 'r%d' % x,
+                                    delay=0.01) for x in range(8)]
+        seen = []
+        def _run_one(index, command):
+            client = current_client()
+            seen.append((threading.current_thread(), client,
+                         current() is client.connection))
+            command()
+        self._callFUT(driver, run_one=_run_one)
+        self.assertEqual(len(seen), 8)
+        self.assertTrue(all(x[2] for x in seen))
+        by_thread = {}
+        for thread, client, _ in seen:
+            self.assertTrue(by_thread.setdefault(thread, client) is client)
+        self.assertEqual(len(self.clients), len(by_thread))
+        self.assertTrue(current_client() is None)
+        self.assertTrue(current() is None)
+
+    def test_output_in_command_order(self):
+        import sys
+        try:
+            from StringIO import StringIO
+        except ImportError:  # pragma: no cover
+            from io import StringIO
+        driver = _Driver()
+        logger = driver.logger
+        driver.commands = [
+            _Command(driver, 'a', 'sally', 'r1', delay=0.05),
+            _Command(driver, 'b', 'fred', 'r2'),
+            ]
+        saved, sys.stdout = sys.stdout, StringIO()
+        try:
+            self._callFUT(driver)
+            stdout = sys.stdout.getvalue()
+        finally:
+            sys.stdout = saved
+        self.assertEqual(driver.ran, ['b', 'a'])
+        self.assertEqual(driver.logged, ['a: start', 'a: end',
+                                         'b: start', 'b: end'])
+        self.assertEqual(stdout, 'a: stdout\nb: stdout\n')
+        self.assertTrue(driver.logger is logger)
+
+    def test_same_report_in_order(self):
+        driver = _Driver()
+        driver.commands = [
+            _Command(driver, 'a', 'sally', 'r1', delay=0.05),
+            _Command(driver, 'b', 'sally', 'r1'),
+            _Command(driver, 'c'),
+            ]
+        self._callFUT(driver)
+        self.assertTrue(driver.ran.index('a') < driver.ran.index('b'))
+
+    def test_error_raised_after_all_run(self):
+        driver = _Driver()
+        driver.commands = [
+            _Command(driver, 'a', 'sally', 'r1', error=KeyError('a')),
+            _Command(driver, 'b', 'fred', 'r2'),
+            ]
+        self.assertRaises(KeyError, self._callFUT, driver)
+        self.assertEqual(sorted(driver.ran), ['a', 'b'])
+        self.assertEqual(len(driver.logged), 4)
@@ -0,0 +1,193 @@
+import unittest
+
+
+class Test_parse_mix(unittest.TestCase):
+
+    def _callFUT(self, text):
+        from .load_test import parse_mix
+        return parse_mix(text)
+
+    def test_weights(self):
+        self.assertEqual(self._callFUT('employees=1, report=5,static'),
+                         [('employees', 1), ('report', 5), ('static', 1)])
+
+    def test_zero_weight_left_out(self):
+        self.assertEqual(self._callFUT('employee=0,report=2'),
+                         [('report', 2)])
+
+    def test_unknown_route(self):
+        self.assertRaises(ValueError, self._callFUT, 'reports=1')
+
+    def test_empty(self):
+        self.assertRaises(ValueError, self._callFUT, 'report=0')
+
+
+class Test_seed(unittest.TestCase):
+
+    def _callFUT(self, targets, create):
+        import random
+        from .load_test import seed
+        self.ensured = []
+        return seed(targets, 3, random.Random(0), create,
+                    self.ensured.append)
+
+    def test_skips_existing(self):
+        from .. import DuplicateReport
+        created = []
+        def _create(employee_id, report_id, rows, description):
+            if report_id == 'report-001':
+                raise DuplicateReport()
+            self.assertEqual(len(rows), 3)
+            created.append((employee_id, report_id))
+        from .load_test import seeded_reports
+        targets = seeded_reports(2, 2)
+        self.assertEqual(self._callFUT(targets, _create), 2)
+        self.assertEqual(created, [('load-0000', 'report-000'),
+                                   ('load-0001', 'report-000')])
+        self.assertEqual(self.ensured, [['load-0000', 'load-0000',
+                                         'load-0001', 'load-0001']])
+
+
+class Test_plan_requests(unittest.TestCase):
+
+    def _callFUT(self, mix, count=200):
+        import random
+        from .load_test import plan_requests
+        return plan_requests(mix, [('sally', 'r1'), ('fred', 'r2')], count,
+                             random.Random(0))
+
+    def test_paths(self):
+        plan = self._callFUT([('employees', 1), ('employee', 1),
+                              ('report', 1), ('static', 1)])
+        paths = dict((route, set()) for route, _ in plan)
+        for route, path in plan:
+            paths[route].add(path)
+        self.assertEqual(paths['employees'], set(['/employees/']))
+        self.assertEqual(paths['employee'],
+                         set(['/employees/sally', '/employees/fred']))
+        self.assertEqual(paths['report'],
+                         set(['/employees/sally/r1', '/employees/fred/r2']))
+        self.assertEqual(paths['static'], set(['/static/theme.css']))
+
+    def test_weights(self):
+        plan = self._callFUT([('employees', 1), ('report', 9)], 1000)
+        reports = len([x for x in plan if x[0] == 'report'])
+        self.assertEqual(len(plan), 1000)
+        self.assertTrue(850 < reports < 950)
+
+
+class Test_run(unittest.TestCase):
+
+    def _callFUT(self, transport, plan, concurrency=4):
+        from .load_test import run
+        return run(transport, plan, concurrency)
+
+    def test_records_each_request(self):
+        def _transport(path):
+            if path == '/boom':
+                raise IOError('reset')
+            if path == '/missing':
+                return 404
+            return 200
+        plan = ([('report', '/ok')] * 10 + [('employee', '/missing')] +
+                [('static', '/boom')])
+        samples, elapsed = self._callFUT(_transport, plan)
+        self.assertEqual(len(samples), 12)
+        self.assertTrue(elapsed >= 0)
+        failed = sorted((x.route, x.status, x.error) for x in samples
+                        if not x.ok)
+        self.assertEqual(failed, [('employee', 404, None),
+                                  ('static', None, 'IOError: reset')
+                                  if str is bytes else
+                                  ('static', None, 'OSError: reset')])
+
+
+class Test_summarize(unittest.TestCase):
+
+    def _callFUT(self, samples, elapsed):
+        from .load_test import summarize
+        return summarize(samples, elapsed)
+
+    def test_per_route(self):
+        from .load_test import Sample
+        samples = [Sample('report', x / 1000.0, 200) for x in range(1, 101)]
+        samples.append(Sample('static', 0.5, None, 'IOError: reset'))
+        summary = self._callFUT(samples, 2.0)
+        report = summary['report']
+        self.assertEqual(report['count'], 100)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['throughput'], 50.0)
+        self.assertEqual(report['p50'], 0.051)
+        self.assertEqual(report['p99'], 0.099)
+        self.assertEqual(summary['static']['error_rate'], 1.0)
+        self.assertEqual(summary['static']['statuses'], {'error': 1})
+        self.assertEqual(summary['all']['count'], 101)
+        self.assertEqual(summary['all']['statuses'],
+                         {'200': 100, 'error': 1})
+
+
+class Test_format_summary(unittest.TestCase):
+
+    def _callFUT(self, summary, baseline=None):
+        from .load_test import format_summary
+        return format_summary(summary, baseline)
+
+    def _stats(self, throughput, p95):
+        return {'count': 10, 'error_rate': 0.0, 'throughput': throughput,
+                'p50': 0.01, 'p95': p95, 'p99': p95}
+
+    def test_routes_in_order(self):
+        lines = self._callFUT({'all': self._stats(10.0, 0.02),
+                               'static': self._stats(5.0, 0.001),
+                               'employees': self._stats(5.0, 0.03)})
+        self.assertEqual([x.split()[0] for x in lines[1:]],
+                         ['employees', 'static', 'all'])
+
+    def test_baseline(self):
+        lines = self._callFUT({'all': self._stats(12.0, 0.015)},
+                              {'all': self._stats(10.0, 0.02)})
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[2].split(),
+                         ['vs', 'base', '+0.0%', '+20%', '+0%', '-25%',
+                          '-25%'])
+
+
+class WSGITransportTests(unittest.TestCase):
+
+    def test_it(self):
+        from .load_test import WSGITransport
+        closed = []
+        class _Body(list):
+            def close(self):
+                closed.append(True)
+        def _app(environ, start_response):
+            status = '200 OK' if environ['PATH_INFO'] == '/' else '404 No'
+            start_response(status, [('Content-Type', 'text/plain')])
+            return _Body([b'body'])
+        transport = WSGITransport(_app)
+        self.assertEqual(transport('/'), 200)
+        self.assertEqual(transport('/missing'), 404)
+        self.assertEqual(closed, [True, True])
+
+
+class _Output(object):
+
+    def __init__(self):
+        self.written = ''
+
+    def write(self, text):
+        self.written += text
+
+
+class Test_main(unittest.TestCase):
+
+    def test_fake_backend_needs_in_process_app(self):
+        import sys
+        from .load_test import main
+        saved, sys.stderr = sys.stderr, _Output()
+        try:
+            self.assertRaises(SystemExit, main,
+                              ['--fake-backend', '--url', 'http://x/'])
+        finally:
+            stderr, sys.stderr = sys.stderr, saved
+        self.assertTrue('--fake-backend' in stderr.written)
@@ -0,0 +1,132 @@
+import unittest
+
+
+class Test_server_settings(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _callFUT(self, config_uri):
+        from .prefork import server_settings
+        return server_settings(config_uri)
+
+    def _write(self, text):
+        import os
+        path = os.path.join(self.tmpdir, 'test.ini')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_from_server_main(self):
+        path = self._write('[server:main]\nhost = 127.0.0.1\nport = 8080\n')
+        self.assertEqual(self._callFUT(path + '#main'), ('127.0.0.1', 8080))
+
+    def test_defaults(self):
+        from .prefork import DEFAULT_HOST
+        from .prefork import DEFAULT_PORT
+        path = self._write('[app:main]\nuse = egg:gcloud_expenses\n')
+        self.assertEqual(self._callFUT('config:' + path),
+                         (DEFAULT_HOST, DEFAULT_PORT))
+
+
+class Test_rss_bytes(unittest.TestCase):
+
+    def test_it(self):
+        from .prefork import rss_bytes
+        self.assertTrue(rss_bytes() > 0)
+
+
+class _Server(object):
+
+    def __init__(self):
+        self.triggered = 0
+
+    def pull_trigger(self):
+        self.triggered += 1
+
+
+class WorkerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .prefork import Worker
+        return Worker
+
+    def _makeOne(self, **kw):
+        def _app(environ, start_response):
+            return [b'OK']
+        return self._getTargetClass()(_app, None, **kw)
+
+    def test_counts_requests_then_stops(self):
+        worker = self._makeOne(max_requests=2)
+        worker.server = _Server()
+        self.assertEqual(worker({}, None), [b'OK'])
+        self.assertTrue(worker.stopping is None)
+        self.assertEqual(worker({}, None), [b'OK'])
+        self.assertEqual(worker.stopping, 'served 2 requests')
+        self.assertEqual(worker.server.triggered, 1)
+
+    def test_no_limit(self):
+        worker = self._makeOne()
+        for i in range(10):
+            worker({}, None)
+        self.assertEqual(worker.served, 10)
+        self.assertTrue(worker.stopping is None)
+
+    def test_stop_keeps_first_reason(self):
+        worker = self._makeOne()
+        worker.stop('terminated')
+        worker.stop('using 600 MB')
+        self.assertEqual(worker.stopping, 'terminated')
+
+    def test_memory_limit(self):
+        worker = self._makeOne(max_memory=1)
+        worker._check_memory()
+        self.assertTrue(worker.stopping.startswith('using '))
+
+
+class ArbiterTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .prefork import Arbiter
+        return Arbiter
+
+    def _makeOne(self, workers=2):
+        arbiter = self._getTargetClass()(None, workers, clock=lambda: 100.0,
+                                         sleep=lambda seconds: None)
+        pids = iter(range(1, 100))
+        def _spawn_worker():
+            pid = next(pids)
+            arbiter.workers[pid] = 100.0
+            return pid
+        arbiter.spawn_worker = _spawn_worker
+        return arbiter
+
+    def test_maintain(self):
+        arbiter = self._makeOne()
+        arbiter.maintain()
+        self.assertEqual(sorted(arbiter.workers), [1, 2])
+        del arbiter.workers[1]
+        arbiter.maintain()
+        self.assertEqual(sorted(arbiter.workers), [2, 3])
+
+    def test_maintain_backs_off(self):
+        arbiter = self._makeOne()
+        arbiter._respawn_after = 101.0
+        arbiter.maintain()
+        self.assertEqual(arbiter.workers, {})
+
+    def test_reload_starts_new_workers_first(self):
+        signalled = []
+        arbiter = self._makeOne()
+        arbiter.signal_workers = lambda signum, pids=None: signalled.append(
+            sorted(pids))
+        arbiter.maintain()
+        arbiter.reload()
+        self.assertEqual(sorted(arbiter.workers), [1, 2, 3, 4])
+        self.assertEqual(arbiter.retiring, set([1, 2]))
+        self.assertEqual(signalled, [[1, 2]])
@@ -0,0 +1,74 @@
+import unittest
+
+
+class _Submitter(object):
+
+    def __init__(self):
+        self.logged = []
+
+    def blather(self, text):
+        self.logged.append(text)
+
+
+class _Client(object):
+
+    def __init__(self):
+        self.connection = object()
+
+
+class BulkApproveReportsTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, rows, workers=4):
+        import os
+        from .review_expenses import BulkApproveReports
+        path = os.path.join(self.tmpdir, 'batch.csv')
+        with open(path, 'w') as f:
+            f.write(''.join('%s\n' % row for row in rows))
+        command = BulkApproveReports(_Submitter(), '--workers=%d' % workers,
+                                     path)
+        self.clients = []
+        def _new_client():
+            self.clients.append(_Client())
+            return self.clients[-1]
+        command.new_client = _new_client
+        return command
+
+    def test_connection_per_worker_thread(self):
+        import threading
+        calls = []
+        def _operation(employee_id, report_id, memo, connection=None):
+            calls.append((threading.current_thread(), connection,
+                          employee_id, report_id, memo))
+        command = self._makeOne(['sally,r%d,%d' % (x, x) for x in range(8)])
+        command.operation = _operation
+        command()
+        self.assertEqual(sorted(x[2:] for x in calls),
+                         [('sally', 'r%d' % x, str(x)) for x in range(8)])
+        by_thread = {}
+        for thread, connection, _, _, _ in calls:
+            self.assertTrue(by_thread.setdefault(thread, connection)
+                            is connection)
+        self.assertEqual(len(self.clients), len(by_thread))
+        self.assertEqual(len(set(map(id, by_thread.values()))),
+                         len(by_thread))
+
+    def test_reports_failures(self):
+        from .. import NoSuchReport
+        def _operation(employee_id, report_id, memo, connection=None):
+            if report_id == 'r2':
+                raise NoSuchReport()
+        command = self._makeOne(['sally,r1,4093', 'sally,r2,4094'],
+                                workers=1)
+        command.operation = _operation
+        command()
+        self.assertEqual(command.submitter.logged[:2],
+                         ['Approved report: sally/r1, check #4093',
+                          'No such report: sally/r2'])
@@ -0,0 +1,121 @@
+import unittest
+
+
+class _Invalid(ValueError):
+    pass
+
+
+class _Driver(object):
+
+    def __init__(self, argv, logger):
+        import optparse
+        parser = optparse.OptionParser(prog='review_expenses')
+        parser.add_option('--batch', dest='batch', default=None)
+        self.options, self.argv = parser.parse_args(argv)
+        self.logger = logger
+        if self.argv[:1] == ['bogus']:
+            raise _Invalid('Not a command: bogus')
+
+    def __call__(self):
+        import sys
+        if self.argv[:1] == ['fail']:
+            raise KeyError('oops')
+        self.logger('Ran: %s' % ' '.join(self.argv))
+        sys.stdout.write('a,b\n1,2\n')
+
+
+class Test_iter_command_lines(unittest.TestCase):
+
+    def _callFUT(self, stream):
+        from .shell import iter_command_lines
+        return list(iter_command_lines(stream))
+
+    def test_it(self):
+        lines = ['# comment\n',
+                 '\n',
+                 'approve --check-number=1 sally "expenses 0901"\n']
+        self.assertEqual(self._callFUT(lines),
+                         [(3, 'approve --check-number=1 sally '
+                              '"expenses 0901"')])
+
+
+class Test_run_line(unittest.TestCase):
+
+    def _callFUT(self, line):
+        from .shell import run_line
+        return run_line(_Driver, _Invalid, line)
+
+    def test_ok_captures_log_and_stdout(self):
+        import sys
+        stdout, stderr = sys.stdout, sys.stderr
+        result = self._callFUT('show sally "r 1"')
+        self.assertTrue(sys.stdout is stdout)
+        self.assertTrue(sys.stderr is stderr)
+        self.assertTrue(result['ok'])
+        self.assertTrue(result['error'] is None)
+        self.assertEqual(result['argv'], ['show', 'sally', 'r 1'])
+        self.assertEqual(result['output'],
+                         ['Ran: show sally r 1', 'a,b', '1,2'])
+
+    def test_invalid_command_line(self):
+        result = self._callFUT('bogus')
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['error'], 'Not a command: bogus')
+
+    def test_unknown_option(self):
+        result = self._callFUT('list --bogus')
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['error'],
+                         'review_expenses: error: no such option: --bogus')
+        self.assertEqual(result['argv'], ['list', '--bogus'])
+
+    def test_help(self):
+        result = self._callFUT('--help')
+        self.assertTrue(result['ok'])
+        self.assertTrue(result['output'][0].startswith('Usage: '))
+
+    def test_unterminated_quote(self):
+        result = self._callFUT('list "unterminated')
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['error'],
+                         'Invalid command line: No closing quotation')
+        self.assertTrue(result['argv'] is None)
+
+    def test_error_does_not_propagate(self):
+        result = self._callFUT('fail')
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['error'], "KeyError: 'oops'")
+
+    def test_nested_batch(self):
+        result = self._callFUT('--batch -')
+        self.assertEqual(result['error'], 'Nested --batch not allowed')
+
+
+class Test_run_batch(unittest.TestCase):
+
+    def _callFUT(self, driver):
+        from .shell import run_batch
+        return run_batch(driver, _Driver, _Invalid)
+
+    def test_from_file(self):
+        import json
+        import os
+        import tempfile
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('show sally r1\n\nbogus\nlist --bogus\n'
+                        'list "unterminated\nshow sally r2\n')
+            logged = []
+            driver = _Driver(['--batch', filename], logged.append)
+            self._callFUT(driver)
+        finally:
+            os.remove(filename)
+        results = [json.loads(x) for x in logged]
+        self.assertEqual([x['line'] for x in results], [1, 3, 4, 5, 6])
+        self.assertEqual([x['ok'] for x in results],
+                         [True, False, False, False, True])
+
+    def test_invalid_file(self):
+        driver = _Driver(['--batch', '/nonesuch/commands.txt'], None)
+        self.assertRaises(_Invalid, self._callFUT, driver)
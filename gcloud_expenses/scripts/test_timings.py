@@ -0,0 +1,92 @@
+import unittest
+
+
+class _Options(object):
+    timings = False
+    profile = None
+
+
+class _Driver(object):
+
+    def __init__(self, commands, **kw):
+        self.commands = commands
+        self.options = _Options()
+        for k, v in kw.items():
+            setattr(self.options, k, v)
+        self.errors = []
+
+    def error(self, text):
+        self.errors.append(text)
+
+
+class _Command(object):
+
+    def __init__(self):
+        self.called = 0
+
+    def __call__(self):
+        from ..tracing import count
+        from ..tracing import traced
+        self.called += 1
+        with traced('datastore.get'):
+            pass
+        count('rows', 3)
+
+
+class Test_add_options(unittest.TestCase):
+
+    def test_it(self):
+        import optparse
+        from .timings import add_options
+        parser = optparse.OptionParser()
+        add_options(parser)
+        options, _ = parser.parse_args(['--timings', '--profile', 'run.prof'])
+        self.assertTrue(options.timings)
+        self.assertEqual(options.profile, 'run.prof')
+        options, _ = parser.parse_args([])
+        self.assertFalse(options.timings)
+        self.assertTrue(options.profile is None)
+
+
+class Test_run_commands(unittest.TestCase):
+
+    def _callFUT(self, driver, commands):
+        from .timings import run_commands
+        return run_commands(driver, commands)
+
+    def test_wo_options(self):
+        command = _Command()
+        driver = _Driver([command])
+        self._callFUT(driver, {'show': _Command})
+        self.assertEqual(command.called, 1)
+        self.assertEqual(driver.errors, [])
+
+    def test_w_timings(self):
+        from ..tracing import current
+        command = _Command()
+        driver = _Driver([command], timings=True)
+        self._callFUT(driver, {'show': _Command})
+        self.assertEqual(command.called, 1)
+        self.assertEqual(driver.errors[0], 'Timings:')
+        self.assertTrue(driver.errors[1].startswith(' show: '))
+        self.assertTrue(driver.errors[2].startswith(
+            '    datastore.get: 1 calls, '))
+        self.assertEqual(driver.errors[3], '    rows: 3')
+        self.assertTrue(current() is None)
+
+    def test_w_profile(self):
+        import os
+        import pstats
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'run.prof')
+            command = _Command()
+            driver = _Driver([command], profile=filename)
+            self._callFUT(driver, {'show': _Command})
+            stats = pstats.Stats(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(command.called, 1)
+        self.assertTrue(stats.total_calls > 0)
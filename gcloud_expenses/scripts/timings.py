@@ -0,0 +1,96 @@
+""" Global ``--timings`` and ``--profile`` options for the script drivers.
+"""
+import cProfile
+import time
+
+from .. import tracing
+from ..tracing import Trace
+from ..tracing import activate_globally
+from .jobs import run_concurrently
+
+
+def add_options(parser):
+    parser.add_option(
+        '--timings',
+        action='store_true',
+        dest='timings',
+        default=False,
+        help="Report wall time, backend calls and rows / bytes processed "
+             "for each command")
+
+    parser.add_option(
+        '--profile',
+        action='store',
+        dest='profile',
+        default=None,
+        metavar='FILE',
+        help="Write a cProfile dump of the whole run to FILE")
+
+
+def command_name(command, commands):
+    """Return the name under which ``command``'s class appears in ``commands``.
+    """
+    for name, klass in commands.items():
+        if type(command) is klass:
+            return name
+    return type(command).__name__
+
+
+def format_timings(name, seconds, trace):
+    lines = [' %s: %.3fs' % (name, seconds)]
+    for category, info in sorted(trace.summary().items()):
+        lines.append('    %s: %d calls, %.3fs'
+                     % (category, info['count'], info['seconds']))
+    for counter, amount in sorted(trace.counters.items()):
+        lines.append('    %s: %d' % (counter, amount))
+    return lines
+
+
+def run_commands(driver, commands):
+    """Invoke ``driver.commands``, honoring the timing / profiling options.
+
+    ``commands`` is the script's table of command classes, used to name
+    the commands when reporting timings.  Run sequentially, traces are
+    activated for all threads, so that work done by a command's worker
+    threads is counted;  run concurrently (``--jobs``), only work done by
+    the command's own thread is counted.
+    """
+    options = driver.options
+    jobs = getattr(options, 'jobs', 1) or 1
+    timings = []
+
+    def _run_one(index, command):
+        if not options.timings:
+            command()
+            return
+        trace = Trace()
+        activate = activate_globally if jobs <= 1 else tracing.activate
+        activate(trace)
+        started = time.time()
+        try:
+            command()
+        finally:
+            activate(None)
+            timings.append((index, command_name(command, commands),
+                            time.time() - started, trace))
+
+    def _run():
+        if jobs > 1:
+            run_concurrently(driver, _run_one, jobs)
+        else:
+            for index, command in enumerate(driver.commands):
+                _run_one(index, command)
+        if timings:
+            driver.error('Timings:')
+            for _, name, seconds, trace in sorted(timings):
+                for line in format_timings(name, seconds, trace):
+                    driver.error(line)
+
+    if options.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(_run)
+        finally:
+            profiler.dump_stats(options.profile)
+    else:
+        _run()
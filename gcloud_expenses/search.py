@@ -0,0 +1,87 @@
+""" Tokenizing and ranking for full-text search over expense items.
+
+The index itself lives in the datastore:  one ``Search Term`` entity per
+distinct term of each report, a child of the report, holding the numbers
+of the report's items whose ``Vendor`` / ``Memo`` contain that term.  A
+lookup reads one entity per matching report and term, however many items
+the reports hold.
+"""
+import re
+
+
+INDEXED_FIELDS = (
+    # (field, property holding item numbers, weight)
+    ('Vendor', 'vendor_items', 2),
+    ('Memo', 'memo_items', 1),
+)
+MIN_TERM_LENGTH = 2
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the distinct, lowercased terms of ``text``, in order.
+    """
+    if not text:
+        return []
+    found = []
+    for word in _WORD.findall(text.lower()):
+        if len(word) >= MIN_TERM_LENGTH and word not in found:
+            found.append(word)
+    return found
+
+
+def build_postings(rows):
+    """Map each term in ``rows`` to ``{property: [item_number, ...]}``.
+
+    Item numbers start at 1, matching the item keys.
+    """
+    postings = {}
+    for number, row in enumerate(rows, 1):
+        for field, prop, _ in INDEXED_FIELDS:
+            for term in tokenize(row.get(field)):
+                postings.setdefault(term, {}).setdefault(prop, []).append(
+                    number)
+    return postings
+
+
+class Hits(object):
+    """Accumulate matches of query terms, and rank them.
+
+    Items are ranked by the number of distinct query terms they match, then
+    by the weighted count of fields matched (vendor above memo), then by
+    position.  Reports rank by their best item, then by matching items.
+    """
+    def __init__(self):
+        self._items = {}  # (employee_id, report_id, number) -> [terms, score]
+
+    def add(self, employee_id, report_id, term_entity):
+        for _, prop, weight in INDEXED_FIELDS:
+            for number in term_entity.get(prop) or ():
+                key = (employee_id, report_id, number)
+                found = self._items.setdefault(key, [set(), 0])
+                found[0].add(term_entity['term'])
+                found[1] += weight
+
+    def items(self):
+        """Return ranked ``(employee_id, report_id, number, matched, score)``.
+        """
+        ranked = [(len(terms), score) + key
+                  for key, (terms, score) in self._items.items()]
+        ranked.sort(key=lambda x: (-x[0], -x[1], x[2], x[3], x[4]))
+        return [(e, r, n, matched, score)
+                for matched, score, e, r, n in ranked]
+
+    def reports(self):
+        """Return ranked ``(employee_id, report_id, matched, score, count)``.
+        """
+        by_report = {}
+        for e, r, _, matched, score in self.items():
+            found = by_report.get((e, r))
+            if found is None:
+                by_report[(e, r)] = [matched, score, 1]
+            else:
+                found[2] += 1
+        ranked = [(e, r, m, s, c) for (e, r), (m, s, c) in by_report.items()]
+        ranked.sort(key=lambda x: (-x[2], -x[3], -x[4], x[0], x[1]))
+        return ranked
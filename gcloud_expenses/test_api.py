@@ -0,0 +1,215 @@
+import unittest
+
+
+class Test_get_page(unittest.TestCase):
+
+    def _callFUT(self, request, *args):
+        from .api import get_page
+        return get_page(request, *args)
+
+    def _makeRequest(self, **params):
+        from pyramid import testing
+        return testing.DummyRequest(params=params)
+
+    def test_defaults(self):
+        self.assertEqual(self._callFUT(self._makeRequest()), (100, 0))
+        self.assertEqual(self._callFUT(self._makeRequest(), None, None),
+                         (None, 0))
+
+    def test_explicit_clamped(self):
+        request = self._makeRequest(limit='5000', offset='20')
+        self.assertEqual(self._callFUT(request), (1000, 20))
+
+    def test_invalid(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self.assertRaises(HTTPBadRequest, self._callFUT,
+                          self._makeRequest(limit='abc'))
+        self.assertRaises(HTTPBadRequest, self._callFUT,
+                          self._makeRequest(offset='-1'))
+
+
+class Test_get_fields_and_select(unittest.TestCase):
+
+    def _makeRequest(self, **params):
+        from pyramid import testing
+        return testing.DummyRequest(params=params)
+
+    def test_no_fields(self):
+        from .api import get_fields
+        from .api import select
+        fields = get_fields(self._makeRequest())
+        self.assertTrue(fields is None)
+        self.assertEqual(select({'a': 1}, fields), {'a': 1})
+
+    def test_fields(self):
+        from .api import get_fields
+        from .api import select
+        fields = get_fields(self._makeRequest(fields='a, c,'))
+        self.assertEqual(fields, set(['a', 'c']))
+        self.assertEqual(select({'a': 1, 'b': 2}, fields), {'a': 1})
+
+
+class Test_buffered(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from .api import buffered
+        return list(buffered(*args, **kw))
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([]), [])
+
+    def test_joins_small_chunks(self):
+        chunks = self._callFUT(['ab', 'cd', 'e', u'\xe9'], size=4)
+        self.assertEqual(chunks, [b'abcd', u'e\xe9'.encode('utf-8')])
+
+
+class Test_iter_json_object(unittest.TestCase):
+
+    def _callFUT(self, *args):
+        from .api import iter_json_object
+        return ''.join(iter_json_object(*args))
+
+    def test_empty_head_and_records(self):
+        import json
+        self.assertEqual(json.loads(self._callFUT({}, 'items', [])),
+                         {'items': []})
+
+    def test_with_head_and_records(self):
+        import datetime
+        import json
+        when = datetime.datetime(2014, 9, 4, 17, 32)
+        body = self._callFUT({'report_id': 'r', 'last_modified': when},
+                             'items', iter([{'a': 1}, {'a': 2}]))
+        self.assertEqual(json.loads(body), {
+            'report_id': 'r',
+            'last_modified': '2014-09-04T17:32:00',
+            'items': [{'a': 1}, {'a': 2}],
+            })
+
+
+class Test_iter_json_lines(unittest.TestCase):
+
+    def test_one_record_per_line(self):
+        import json
+        from .api import iter_json_lines
+        lines = list(iter_json_lines([{'a': 1}, {'b': [2]}]))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(line.endswith('\n') for line in lines))
+        self.assertEqual([json.loads(x) for x in lines],
+                         [{'a': 1}, {'b': [2]}])
+
+    def test_unserializable(self):
+        from .api import iter_json_lines
+        self.assertRaises(TypeError, list, iter_json_lines([{'a': object()}]))
+
+
+class Test_next_page_url(unittest.TestCase):
+
+    def _callFUT(self, limit, offset, more, **params):
+        from pyramid import testing
+        from .api import next_page_url
+        request = testing.DummyRequest(params=params)
+        request.path_url = 'http://example.com/api/x'
+        return next_page_url(request, limit, offset, more)
+
+    def test_more(self):
+        self.assertEqual(self._callFUT(10, 20, True, fields='Vendor'),
+                         'http://example.com/api/x'
+                         '?fields=Vendor&limit=10&offset=30')
+
+    def test_last_page(self):
+        self.assertTrue(self._callFUT(10, 20, False) is None)
+        self.assertTrue(self._callFUT(0, 20, True) is None)
+
+
+class _ReportItemsTests(object):
+
+    def setUp(self):
+        from . import api
+        self._saved = api.get_report_info, api.list_report_items
+        self.items = [{'Vendor': 'Yellow Cab', 'Memo': 'Taxi %d' % x}
+                      for x in range(1, 6)]
+        self.fetched = []
+        def _get_report_info(employee_id, report_id, items=True,
+                             connection=None):
+            from . import NoSuchReport
+            if report_id != 'r1':
+                raise NoSuchReport()
+            return {'employee_id': employee_id, 'report_id': report_id}
+        def _list_report_items(employee_id, report_id, limit=None, offset=0,
+                               connection=None):
+            self.fetched.append((limit, offset))
+            return iter(self.items[offset:offset + limit])
+        api.get_report_info = _get_report_info
+        api.list_report_items = _list_report_items
+
+    def tearDown(self):
+        from . import api
+        api.get_report_info, api.list_report_items = self._saved
+
+    def _callFUT(self, report_id, **params):
+        from pyramid import testing
+        request = testing.DummyRequest(params=params)
+        request.path_url = 'http://example.com/api/sally/%s' % report_id
+        request.matchdict = {'employee_id': 'sally', 'report_id': report_id}
+        request.datastore_connection = None
+        return self._getFUT()(request)
+
+    def test_no_such_report(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        self.assertRaises(HTTPNotFound, self._callFUT, 'nonesuch')
+
+
+class Test_api_report(_ReportItemsTests, unittest.TestCase):
+
+    def _getFUT(self):
+        from .api import api_report
+        return api_report
+
+    def test_default_page(self):
+        import json
+        body = json.loads(self._callFUT('r1').body.decode('utf-8'))
+        self.assertEqual(self.fetched, [(101, 0)])
+        self.assertEqual(len(body['items']), 5)
+        self.assertEqual((body['limit'], body['offset'], body['next']),
+                         (100, 0, None))
+
+    def test_pages(self):
+        import json
+        body = json.loads(self._callFUT('r1', limit='2', offset='1',
+                                        fields='Memo').body.decode('utf-8'))
+        self.assertEqual(body['items'], [{'Memo': 'Taxi 2'},
+                                         {'Memo': 'Taxi 3'}])
+        self.assertEqual(body['next'], 'http://example.com/api/sally/r1'
+                                       '?fields=Memo&limit=2&offset=3')
+
+    def test_limit_clamped(self):
+        self._callFUT('r1', limit='5000')
+        self.assertEqual(self.fetched, [(1001, 0)])
+
+
+class Test_api_report_items_ndjson(_ReportItemsTests, unittest.TestCase):
+
+    def _getFUT(self):
+        from .api import api_report_items_ndjson
+        return api_report_items_ndjson
+
+    def test_items(self):
+        import json
+        response = self._callFUT('r1', fields='Vendor')
+        self.assertEqual([json.loads(x) for x in response.body.splitlines()],
+                         [{'Vendor': 'Yellow Cab'}] * 5)
+        self.assertFalse('Link' in response.headers)
+
+    def test_pages(self):
+        import json
+        response = self._callFUT('r1', limit='3', offset='3')
+        self.assertEqual([json.loads(x)['Memo']
+                          for x in response.body.splitlines()],
+                         ['Taxi 4', 'Taxi 5'])
+        self.assertFalse('Link' in response.headers)
+        response = self._callFUT('r1', limit='3')
+        self.assertEqual(len(response.body.splitlines()), 3)
+        self.assertEqual(response.headers['Link'],
+                         '<http://example.com/api/sally/r1'
+                         '?limit=3&offset=3>; rel="next"')
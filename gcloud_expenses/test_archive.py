@@ -0,0 +1,112 @@
+import unittest
+
+
+class _TempDir(object):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+
+class Test_parse_timestamp(unittest.TestCase):
+
+    def _callFUT(self, text):
+        from .archive import parse_timestamp
+        return parse_timestamp(text)
+
+    def test_formats(self):
+        import datetime
+        self.assertEqual(self._callFUT('2015-01-02'),
+                         datetime.datetime(2015, 1, 2))
+        self.assertEqual(self._callFUT('2015-01-02T03:04:05'),
+                         datetime.datetime(2015, 1, 2, 3, 4, 5))
+        self.assertEqual(self._callFUT('2015-01-02T03:04:05.000006'),
+                         datetime.datetime(2015, 1, 2, 3, 4, 5, 6))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._callFUT, '01/02/2015')
+
+
+class ChunkWriterTests(_TempDir, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .archive import ChunkWriter
+        return ChunkWriter
+
+    def _makeOne(self, chunk_bytes=1024 * 1024):
+        return self._getTargetClass()(self.tmpdir, 'shard000', chunk_bytes)
+
+    def _read(self, chunks, verify=True):
+        from .archive import read_chunk
+        records = []
+        for chunk in chunks:
+            records.extend(read_chunk(self.tmpdir, chunk, verify))
+        return records
+
+    def test_roundtrip_typed_values(self):
+        import datetime
+        import decimal
+        record = {
+            'type': 'report',
+            'properties': {
+                'created': datetime.datetime(2015, 1, 2, 3, 4, 5, 6),
+                'Date': datetime.date(2015, 1, 2),
+                'Price': decimal.Decimal('12.50'),
+                'total': 12.5,
+                'description': u'Trip \xe0 Paris',
+                },
+            }
+        writer = self._makeOne()
+        writer.write(record)
+        chunk, = writer.close()
+        self.assertEqual(chunk['name'], 'shard000-0000.jsonl.gz')
+        self.assertEqual(chunk['records'], 1)
+        self.assertEqual(self._read([chunk]), [record])
+
+    def test_rolls_over_chunks(self):
+        writer = self._makeOne(chunk_bytes=100)
+        records = [{'type': 'item', 'memo': 'x' * 60, 'n': n}
+                   for n in range(5)]
+        for record in records:
+            writer.write(record)
+        chunks = writer.close()
+        self.assertEqual([x['records'] for x in chunks], [2, 2, 1])
+        self.assertEqual(self._read(chunks), records)
+
+    def test_no_records_no_chunks(self):
+        self.assertEqual(self._makeOne().close(), [])
+
+    def test_checksum_mismatch(self):
+        import os
+        from .archive import ArchiveError
+        writer = self._makeOne()
+        writer.write({'type': 'employee'})
+        chunk, = writer.close()
+        with open(os.path.join(self.tmpdir, chunk['name']), 'ab') as f:
+            f.write(b'garbage')
+        self.assertRaises(ArchiveError, self._read, [chunk])
+
+    def test_missing_chunk(self):
+        from .archive import ArchiveError
+        self.assertRaises(ArchiveError, self._read,
+                          [{'name': 'nonesuch.jsonl.gz', 'sha256': ''}])
+
+
+class ManifestTests(_TempDir, unittest.TestCase):
+
+    def test_roundtrip(self):
+        from .archive import FORMAT_VERSION
+        from .archive import read_manifest
+        from .archive import write_manifest
+        write_manifest(self.tmpdir, {'chunks': [], 'since': None})
+        self.assertEqual(read_manifest(self.tmpdir), {
+            'chunks': [], 'since': None, 'version': FORMAT_VERSION})
+
+    def test_incomplete(self):
+        from .archive import ArchiveError
+        from .archive import read_manifest
+        self.assertRaises(ArchiveError, read_manifest, self.tmpdir)
@@ -0,0 +1,118 @@
+import unittest
+
+
+class _TempStaticDir(object):
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        self.static_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_dir)
+        with open(os.path.join(self.static_dir, 'theme.css'), 'wb') as f:
+            f.write(b'body { color: black; }\n' * 100)
+        with open(os.path.join(self.static_dir, 'logo.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+
+
+class AssetManifestTests(_TempStaticDir, unittest.TestCase):
+
+    def _makeOne(self):
+        from .assets import AssetManifest
+        return AssetManifest(self.static_dir)
+
+    def test_fingerprinted_names(self):
+        from .assets import fingerprint
+        import os
+        manifest = self._makeOne()
+        digest = fingerprint(os.path.join(self.static_dir, 'theme.css'))
+        self.assertEqual(manifest.urls['theme.css'], 'theme.%s.css' % digest)
+        self.assertEqual(manifest.files['theme.%s.css' % digest],
+                         'theme.css')
+        self.assertEqual(sorted(manifest.urls), ['logo.png', 'theme.css'])
+
+    def test_build_compresses_text_only(self):
+        import gzip
+        import os
+        manifest = self._makeOne()
+        self.assertEqual(manifest.variants(manifest.urls['theme.css']), {})
+        written = manifest.build()
+        self.assertTrue(written)
+        self.assertFalse([x for x in written if 'logo' in x])
+        variants = manifest.variants(manifest.urls['theme.css'])
+        with gzip.open(variants['gzip'], 'rb') as f:
+            self.assertEqual(f.read(), b'body { color: black; }\n' * 100)
+        self.assertEqual(manifest.build(), [])
+        # Compressed variants are not assets themselves.
+        self.assertEqual(sorted(self._makeOne().urls),
+                         ['logo.png', 'theme.css'])
+
+
+class Test_choose_encoding(unittest.TestCase):
+
+    def _callFUT(self, header, available=('br', 'gzip')):
+        from .assets import choose_encoding
+        return choose_encoding(header, available)
+
+    def test_no_header(self):
+        self.assertTrue(self._callFUT(None) is None)
+
+    def test_prefers_available_order(self):
+        self.assertEqual(self._callFUT('gzip, deflate, br'), 'br')
+        self.assertEqual(self._callFUT('gzip, deflate'), 'gzip')
+        self.assertEqual(self._callFUT('gzip', ()), None)
+
+    def test_qualities(self):
+        self.assertEqual(self._callFUT('br;q=0, gzip;q=0.5'), 'gzip')
+        self.assertEqual(self._callFUT('*;q=0.1'), 'br')
+        self.assertEqual(self._callFUT('identity, *;q=0'), None)
+
+
+class Test_serve_asset(_TempStaticDir, unittest.TestCase):
+
+    def setUp(self):
+        from pyramid import testing
+        from .assets import AssetManifest
+        super(Test_serve_asset, self).setUp()
+        self.config = testing.setUp()
+        self.manifest = AssetManifest(self.static_dir)
+        self.config.registry.asset_manifest = self.manifest
+
+    def tearDown(self):
+        from pyramid import testing
+        testing.tearDown()
+
+    def _callFUT(self, name, **headers):
+        from pyramid.request import Request
+        from .assets import serve_asset
+        request = Request.blank('/', headers=headers)
+        request.registry = self.config.registry
+        request.matchdict = {'filename': name}
+        return serve_asset(request)
+
+    def test_unknown(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        self.assertRaises(HTTPNotFound, self._callFUT, 'theme.css')
+
+    def test_identity(self):
+        response = self._callFUT(self.manifest.urls['theme.css'],
+                                 **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_type, 'text/css')
+        self.assertTrue(response.content_encoding is None)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue('immutable' in response.headers['Cache-Control'])
+
+    def test_precompressed(self):
+        self.manifest.build()
+        response = self._callFUT(self.manifest.urls['theme.css'],
+                                 **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_type, 'text/css')
+        self.assertEqual(response.content_encoding, 'gzip')
+
+    def test_not_compressible(self):
+        self.manifest.build()
+        response = self._callFUT(self.manifest.urls['logo.png'],
+                                 **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_type, 'image/png')
+        self.assertTrue(response.content_encoding is None)
+        self.assertFalse('Vary' in response.headers)
@@ -0,0 +1,92 @@
+import unittest
+
+
+class Test_run_batch(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from .batch import run_batch
+        return run_batch(*args, **kw)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT(lambda item: item, []), [])
+
+    def test_results_in_input_order(self):
+        results = self._callFUT(lambda item: item * 2, [3, 1, 2], workers=3)
+        self.assertEqual([result.item for result in results], [3, 1, 2])
+        self.assertEqual([result.value for result in results], [6, 2, 4])
+        self.assertTrue(all(result.ok for result in results))
+
+    def test_captures_errors(self):
+        def _func(item):
+            if item == 2:
+                raise KeyError(item)
+            return item
+        results = self._callFUT(_func, [1, 2, 3])
+        self.assertTrue(results[0].ok)
+        self.assertFalse(results[1].ok)
+        self.assertTrue(isinstance(results[1].error, KeyError))
+        self.assertTrue(results[2].ok)
+
+    def test_same_key_runs_in_order(self):
+        import threading
+        seen = []
+        threads = {}
+        def _func(item):
+            seen.append(item)
+            threads.setdefault(item[0], set()).add(
+                threading.current_thread().ident)
+        items = [('a', 1), ('b', 1), ('a', 2), ('b', 2), ('a', 3)]
+        self._callFUT(_func, items, key=lambda item: item[0], workers=4)
+        self.assertEqual([x for x in seen if x[0] == 'a'],
+                         [('a', 1), ('a', 2), ('a', 3)])
+        self.assertEqual([x for x in seen if x[0] == 'b'],
+                         [('b', 1), ('b', 2)])
+        self.assertEqual(len(threads['a']), 1)
+        self.assertEqual(len(threads['b']), 1)
+
+
+class Test_percentile(unittest.TestCase):
+
+    def _callFUT(self, ordered, fraction):
+        from .batch import percentile
+        return percentile(ordered, fraction)
+
+    def test_nearest_rank(self):
+        ordered = list(range(1, 11))
+        self.assertEqual(self._callFUT(ordered, 0.0), 1)
+        self.assertEqual(self._callFUT(ordered, 0.6), 6)
+        self.assertEqual(self._callFUT(ordered, 0.95), 10)
+        self.assertEqual(self._callFUT(ordered, 1.0), 10)
+
+    def test_single(self):
+        self.assertEqual(self._callFUT([0.25], 0.99), 0.25)
+
+
+class Test_summarize(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from .batch import summarize
+        return summarize(*args, **kw)
+
+    def _makeResult(self, elapsed, error=None):
+        from .batch import BatchResult
+        return BatchResult(None, error=error, elapsed=elapsed)
+
+    def test_empty(self):
+        stats = self._callFUT([], 0.0)
+        self.assertEqual(stats['count'], 0)
+        self.assertEqual(stats['throughput'], 0.0)
+        self.assertEqual(stats['max'], 0.0)
+
+    def test_counts_and_percentiles(self):
+        results = [self._makeResult(x / 100.0) for x in range(1, 101)]
+        results[0].error = ValueError()
+        stats = self._callFUT(results, 2.0)
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['succeeded'], 99)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['throughput'], 50.0)
+        self.assertAlmostEqual(stats['mean'], 0.505)
+        self.assertEqual(stats['p50'], 0.51)
+        self.assertEqual(stats['p95'], 0.95)
+        self.assertEqual(stats['max'], 1.0)
@@ -0,0 +1,211 @@
+import unittest
+
+
+class TTLCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .cache import TTLCache
+        return TTLCache
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_ctor_defaults(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.maxsize, 1024)
+        self.assertEqual(cache.ttl, 3600)
+        self.assertEqual(len(cache), 0)
+
+    def test_get_miss(self):
+        cache = self._makeOne()
+        self.assertTrue(cache.get('a') is None)
+        self.assertEqual(cache.get('a', 0), 0)
+        self.assertFalse('a' in cache)
+
+    def test_set_get(self):
+        cache = self._makeOne()
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+
+    def test_expiry(self):
+        now = [1000.0]
+        cache = self._makeOne(ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        now[0] += 9
+        self.assertTrue('a' in cache)
+        now[0] += 1
+        self.assertFalse('a' in cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = self._makeOne(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def test_invalidate_and_clear(self):
+        cache = self._makeOne()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        cache.invalidate('nonesuch')
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class SizedLRUCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .cache import SizedLRUCache
+        return SizedLRUCache
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_set_get(self):
+        cache = self._makeOne(10)
+        cache.set('a', 'xxx')
+        self.assertEqual(cache.get('a'), 'xxx')
+        self.assertTrue('a' in cache)
+        self.assertEqual(cache.size, 3)
+        self.assertTrue(cache.get('b') is None)
+
+    def test_replace_adjusts_size(self):
+        cache = self._makeOne(10)
+        cache.set('a', 'xxx')
+        cache.set('a', 'xxxxx')
+        self.assertEqual(cache.size, 5)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = self._makeOne(10)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.get('a')
+        cache.set('c', 'xxxx')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(cache.size, 8)
+
+    def test_too_large_not_stored(self):
+        cache = self._makeOne(4)
+        cache.set('a', 'xx')
+        cache.set('a', 'xxxxx')
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_max_size_setter_shrinks(self):
+        cache = self._makeOne(10)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.max_size = 5
+        self.assertEqual(cache.max_size, 5)
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+
+    def test_custom_sizeof(self):
+        cache = self._makeOne(10, sizeof=lambda value: 6)
+        cache.set('a', None)
+        cache.set('b', None)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.size, 6)
+
+    def test_invalidate_and_clear(self):
+        cache = self._makeOne(10)
+        cache.set('a', 'x')
+        cache.set('b', 'x')
+        cache.invalidate('a')
+        self.assertEqual(cache.size, 1)
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(len(cache), 0)
+
+
+class DiskLRUCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = 1000.0
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _getTargetClass(self):
+        from .cache import DiskLRUCache
+        return DiskLRUCache
+
+    def _makeOne(self, max_bytes=10):
+        import os
+        return self._getTargetClass()(os.path.join(self.tmpdir, 'cache'),
+                                      max_bytes, clock=lambda: self.now)
+
+    def _file(self, data):
+        import os
+        path = os.path.join(self.tmpdir, 'source')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _read(self, cache, key):
+        f = cache.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def test_put_open(self):
+        cache = self._makeOne()
+        self.assertTrue(cache.open('a') is None)
+        cache.put('a', self._file(b'xxx'))
+        self.assertEqual(self._read(cache, 'a'), b'xxx')
+        self.assertEqual(cache.size, 3)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = self._makeOne()
+        cache.put('a', self._file(b'xxxx'))
+        self.now += 1
+        cache.put('b', self._file(b'xxxx'))
+        self.now += 1
+        self._read(cache, 'a')
+        self.now += 1
+        cache.put('c', self._file(b'xxxx'))
+        self.assertEqual(self._read(cache, 'a'), b'xxxx')
+        self.assertTrue(cache.open('b') is None)
+        self.assertEqual(self._read(cache, 'c'), b'xxxx')
+        self.assertEqual(cache.size, 8)
+
+    def test_too_large_not_stored(self):
+        cache = self._makeOne(4)
+        cache.put('a', self._file(b'xxxxx'))
+        self.assertTrue(cache.open('a') is None)
+
+    def test_shared_between_instances(self):
+        writer, reader = self._makeOne(), self._makeOne()
+        writer.put('a', self._file(b'xxx'))
+        self.assertEqual(self._read(reader, 'a'), b'xxx')
+        reader.discard('a')
+        reader.discard('a')
+        self.assertTrue(writer.open('a') is None)
+
+    def test_stale_temp_files_removed(self):
+        import os
+        cache = self._makeOne()
+        path = os.path.join(cache.directory, cache.TEMP_PREFIX + 'crashed')
+        with open(path, 'wb') as f:
+            f.write(b'xx')
+        os.utime(path, (self.now, self.now))
+        self.assertEqual(cache.size, 0)
+        self.assertTrue(os.path.exists(path))
+        self.now += cache.STALE_TEMP_SECONDS + 1
+        self.assertEqual(cache.size, 0)
+        self.assertFalse(os.path.exists(path))
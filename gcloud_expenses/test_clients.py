@@ -0,0 +1,159 @@
+import unittest
+
+
+class _Connection(object):
+    pass
+
+
+class ClientTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .clients import Client
+        return Client
+
+    def test_bucket_looked_up_once(self):
+        calls = []
+        def _get_bucket():
+            calls.append(1)
+            return 'bucket'
+        client = self._getTargetClass()('http', 'connection', _get_bucket)
+        self.assertEqual(calls, [])
+        self.assertEqual(client.bucket, 'bucket')
+        self.assertEqual(client.bucket, 'bucket')
+        self.assertEqual(calls, [1])
+
+
+class ThreadClientsTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from .clients import ThreadClients
+        made = []
+        def _factory():
+            made.append(_Connection())
+            return made[-1]
+        return ThreadClients(_factory), made
+
+    def test_one_per_thread(self):
+        import threading
+        clients, made = self._makeOne()
+        mine = clients()
+        self.assertTrue(clients() is mine)
+        others = []
+        thread = threading.Thread(target=lambda: others.append(clients()))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(made), 2)
+        self.assertTrue(others[0] is not mine)
+
+
+class Test_accepts_connection(unittest.TestCase):
+
+    def tearDown(self):
+        from .clients import activate
+        activate(None)
+
+    def _callFUT(self, func):
+        from .clients import accepts_connection
+        return accepts_connection(func)
+
+    def test_function(self):
+        from .clients import current
+        connection = _Connection()
+        wrapped = self._callFUT(lambda x: (x, current()))
+        self.assertEqual(wrapped(1), (1, None))
+        self.assertEqual(wrapped(1, connection=connection), (1, connection))
+        self.assertTrue(current() is None)
+
+    def test_function_restores_on_error(self):
+        from .clients import activate
+        from .clients import current
+        outer = _Connection()
+        activate(outer)
+        def _fail():
+            raise ValueError()
+        wrapped = self._callFUT(_fail)
+        self.assertRaises(ValueError, wrapped, connection=_Connection())
+        self.assertTrue(current() is outer)
+
+    def test_generator_active_while_iterated(self):
+        from .clients import current
+        connection = _Connection()
+        def _gen():
+            yield current()
+            yield current()
+        iterator = self._callFUT(_gen)(connection=connection)
+        self.assertTrue(current() is None)
+        self.assertTrue(next(iterator) is connection)
+        self.assertTrue(current() is None)
+        self.assertEqual(list(iterator), [connection])
+
+    def test_generator_without_connection(self):
+        from .clients import current
+        def _gen():
+            yield current()
+        self.assertEqual(list(self._callFUT(_gen)()), [None])
+
+
+class _Module(object):
+
+    def get(self, keys, connection=None):
+        return keys, connection
+
+
+class ConnectedNamespaceTests(unittest.TestCase):
+
+    def tearDown(self):
+        from .clients import activate
+        activate(None)
+
+    def _makeOne(self):
+        from .clients import ConnectedNamespace
+        return ConnectedNamespace(_Module(), ('get',))
+
+    def test_passes_active_connection(self):
+        from .clients import activate
+        namespace = self._makeOne()
+        self.assertEqual(namespace.get(['k']), (['k'], None))
+        connection = _Connection()
+        activate(connection)
+        self.assertEqual(namespace.get(['k']), (['k'], connection))
+        other = _Connection()
+        self.assertEqual(namespace.get(['k'], connection=other),
+                         (['k'], other))
+
+    def test_passes_through_other_attributes(self):
+        namespace = self._makeOne()
+        self.assertEqual(namespace.__class__.__name__, 'ConnectedNamespace')
+        self.assertEqual(namespace.get.__name__, 'get')
+
+
+class Test_connected_classes(unittest.TestCase):
+
+    def tearDown(self):
+        from .clients import activate
+        activate(None)
+
+    def test_query_fetch(self):
+        from .clients import activate
+        from .clients import connected_query_class
+        class Query(object):
+            def fetch(self, limit=None, connection=None):
+                return limit, connection
+        klass = connected_query_class(Query)
+        self.assertEqual(klass.__name__, 'Query')
+        self.assertEqual(klass().fetch(5), (5, None))
+        connection = _Connection()
+        activate(connection)
+        self.assertEqual(klass().fetch(5), (5, connection))
+
+    def test_transaction(self):
+        from .clients import activate
+        from .clients import connected_transaction_class
+        class Transaction(object):
+            def __init__(self, dataset_id=None, connection=None):
+                self.connection = connection
+        klass = connected_transaction_class(Transaction)
+        self.assertTrue(klass().connection is None)
+        connection = _Connection()
+        activate(connection)
+        self.assertTrue(klass().connection is connection)
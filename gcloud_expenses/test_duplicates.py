@@ -0,0 +1,86 @@
+import unittest
+
+
+class Test_fingerprint(unittest.TestCase):
+
+    def _callFUT(self, row):
+        from .duplicates import fingerprint
+        return fingerprint(row)
+
+    def test_typed(self):
+        import datetime
+        import decimal
+        row = {'Date': datetime.date(2014, 8, 26), 'Vendor': 'Marriott, SFO',
+               'Quantity': 2, 'Price': decimal.Decimal('112.00')}
+        self.assertEqual(self._callFUT(row), u'2014-08-26|marriott sfo|22400')
+
+    def test_stored_and_legacy_agree(self):
+        import datetime
+        stored = {'Date': datetime.datetime(2014, 8, 26), 'Vendor': 'Hertz',
+                  'Quantity': 1, 'Price': 19.99}
+        legacy = {'Date': '2014-08-26', 'Vendor': ' HERTZ ',
+                  'Quantity': '', 'Price': '19.99'}
+        self.assertEqual(self._callFUT(stored), self._callFUT(legacy))
+
+    def test_incomplete(self):
+        self.assertTrue(self._callFUT({'Vendor': 'Hertz'}) is None)
+        self.assertTrue(self._callFUT({'Date': '2014-08-26', 'Vendor': '',
+                                       'Price': '1'}) is None)
+        self.assertTrue(self._callFUT({'Date': '2014-08-26', 'Vendor': 'x',
+                                       'Price': 'abc'}) is None)
+
+
+class Test_build_fingerprints(unittest.TestCase):
+
+    def test_it(self):
+        from .duplicates import build_fingerprints
+        rows = [{'Date': '2014-08-26', 'Vendor': 'Hertz', 'Price': '10'},
+                {'Date': '2014-08-27', 'Vendor': 'Hertz', 'Price': '10'},
+                {'Date': '2014-08-26', 'Vendor': 'hertz', 'Price': '10.00'},
+                ]
+        self.assertEqual(build_fingerprints(rows), {
+            u'2014-08-26|hertz|1000': [1, 3],
+            u'2014-08-27|hertz|1000': [2],
+            })
+
+
+class DuplicateScannerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .duplicates import DuplicateScanner
+        return DuplicateScanner
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def _row(self, date, vendor, price):
+        return {'Date': date, 'Vendor': vendor, 'Price': price}
+
+    def test_exact(self):
+        scanner = self._makeOne()
+        records = [
+            ('a1', 'a', self._row('2014-08-26', 'Hertz', '10')),
+            ('a2', 'a', self._row('2014-08-26', 'Hertz', '10')),
+            ('b1', 'b', self._row('2014-08-26', 'Hertz', '10')),
+            ('c1', 'c', self._row('2014-08-27', 'Hertz', '10')),
+            ]
+        self.assertEqual(list(scanner.scan(records)),
+                         [('b1', 'b', 'a1', 'a'), ('b1', 'b', 'a2', 'a')])
+        self.assertEqual(len(scanner), 4)
+
+    def test_tolerances(self):
+        scanner = self._makeOne(date_tolerance=1, cents_tolerance=50)
+        records = [
+            ('a1', 'a', self._row('2014-08-31', 'Hertz', '10.00')),
+            ('b1', 'b', self._row('2014-09-01', 'Hertz', '10.50')),
+            ('c1', 'c', self._row('2014-09-02', 'Hertz', '10.51')),
+            ('d1', 'd', self._row('2014-08-29', 'Hertz', '10.00')),
+            ('e1', 'e', self._row('2014-08-31', 'Avis', '10.00')),
+            ]
+        self.assertEqual(list(scanner.scan(records)),
+                         [('b1', 'b', 'a1', 'a'), ('c1', 'c', 'b1', 'b')])
+
+    def test_incomplete_rows_skipped(self):
+        scanner = self._makeOne()
+        self.assertEqual(scanner.add('a1', 'a', {'Vendor': 'Hertz'}), [])
+        self.assertEqual(len(scanner), 0)
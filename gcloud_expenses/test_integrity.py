@@ -0,0 +1,261 @@
+import unittest
+
+
+def _has_gcloud():
+    try:
+        import gcloud
+    except ImportError:
+        return False
+    return True
+
+
+def _b64md5(data):
+    import base64
+    import hashlib
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+class Test_crc32c(unittest.TestCase):
+
+    def _callFUT(self, data, crc=0):
+        from .integrity import _crc32c_python
+        return _crc32c_python(data, crc)
+
+    def test_check_value(self):
+        self.assertEqual(self._callFUT(b'123456789'), 0xE3069283)
+
+    def test_incremental(self):
+        self.assertEqual(self._callFUT(b'6789', self._callFUT(b'12345')),
+                         0xE3069283)
+
+    def test_update_matches_fallback(self):
+        from .integrity import crc32c_update
+        self.assertEqual(crc32c_update(b'123456789'), 0xE3069283)
+
+
+class DigestsTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .integrity import Digests
+        return Digests
+
+    def _makeOne(self, algorithms=('md5', 'crc32c')):
+        return self._getTargetClass()(algorithms)
+
+    def test_b64(self):
+        digests = self._makeOne()
+        digests.update(b'12345')
+        digests.update(b'6789')
+        self.assertEqual(digests.b64(), {'md5': _b64md5(b'123456789'),
+                                         'crc32c': '4waSgw=='})
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, self._makeOne, ['sha1'])
+
+
+class Test_stored_hashes(unittest.TestCase):
+
+    def _callFUT(self, blob):
+        from .integrity import stored_hashes
+        return stored_hashes(blob)
+
+    def test_attributes(self):
+        class _Blob(object):
+            md5_hash = 'MD5'
+            crc32c = 'CRC'
+        self.assertEqual(self._callFUT(_Blob()),
+                         {'md5': 'MD5', 'crc32c': 'CRC'})
+
+    def test_properties_composite(self):
+        class _Blob(object):
+            properties = {'crc32c': 'CRC'}
+        self.assertEqual(self._callFUT(_Blob()), {'crc32c': 'CRC'})
+
+
+class Test_verify(unittest.TestCase):
+
+    def _callFUT(self, digests, stored):
+        from .integrity import verify
+        return verify('e/r/a.jpg', digests, stored)
+
+    def _digests(self, data):
+        from .integrity import Digests
+        digests = Digests(['md5'])
+        digests.update(data)
+        return digests
+
+    def test_match(self):
+        self.assertEqual(self._callFUT(self._digests(b'abc'),
+                                       {'md5': _b64md5(b'abc')}), 1)
+
+    def test_nothing_stored(self):
+        self.assertEqual(self._callFUT(self._digests(b'abc'), {}), 0)
+
+    def test_mismatch(self):
+        from .integrity import ChecksumMismatch
+        try:
+            self._callFUT(self._digests(b'abd'), {'md5': _b64md5(b'abc')})
+        except ChecksumMismatch as e:
+            self.assertEqual(e.name, 'e/r/a.jpg')
+            self.assertEqual(e.algorithm, 'md5')
+        else:
+            self.fail('ChecksumMismatch not raised')
+
+
+class HashingReaderTests(unittest.TestCase):
+
+    def _makeOne(self, data):
+        import io
+        from .integrity import Digests
+        from .integrity import HashingReader
+        return HashingReader(io.BytesIO(data), Digests(['md5']))
+
+    def test_rewind_hashes_once(self):
+        reader = self._makeOne(b'0123456789')
+        self.assertEqual(reader.read(6), b'012345')
+        reader.seek(2)
+        self.assertEqual(reader.read(6), b'234567')
+        self.assertEqual(reader.read(), b'89')
+        self.assertEqual(reader.hashed, 10)
+        self.assertEqual(reader.digests.b64()['md5'], _b64md5(b'0123456789'))
+
+    def test_skip_ahead_leaves_gap(self):
+        reader = self._makeOne(b'0123456789')
+        reader.seek(5)
+        reader.read()
+        self.assertEqual(reader.hashed, 0)
+
+
+class _Blob(object):
+
+    def __init__(self, name, data, stored=None):
+        self.name = name
+        self.data = data
+        self.md5_hash = _b64md5(data) if stored is None else stored
+        self.corrupt = 0
+
+    def download_to_file(self, f):
+        data = self.data
+        if self.corrupt:
+            self.corrupt -= 1
+            data = b'X' + data[1:]
+        f.write(data[:3])
+        f.write(data[3:])
+
+
+class _TempDir(object):
+
+    def setUp(self):
+        import tempfile
+        from . import TRANSFER_RETRY_POLICY
+        self.tmpdir = tempfile.mkdtemp()
+        self._initial_delay = TRANSFER_RETRY_POLICY.initial_delay
+        TRANSFER_RETRY_POLICY.initial_delay = 0
+
+    def tearDown(self):
+        import shutil
+        from . import TRANSFER_RETRY_POLICY
+        TRANSFER_RETRY_POLICY.initial_delay = self._initial_delay
+        shutil.rmtree(self.tmpdir)
+
+
+@unittest.skipUnless(_has_gcloud(), 'gcloud not installed')
+class Test__verified_download(_TempDir, unittest.TestCase):
+
+    def _callFUT(self, blob, filename):
+        from . import _verified_download
+        return _verified_download(blob, filename)
+
+    def _path(self):
+        import os
+        return os.path.join(self.tmpdir, 'a.jpg')
+
+    def test_verified(self):
+        self.assertEqual(self._callFUT(_Blob('e/r/a.jpg', b'receipt'),
+                                       self._path()), 1)
+        with open(self._path(), 'rb') as f:
+            self.assertEqual(f.read(), b'receipt')
+
+    def test_retries_corrupt_transfer(self):
+        blob = _Blob('e/r/a.jpg', b'receipt')
+        blob.corrupt = 2
+        self.assertEqual(self._callFUT(blob, self._path()), 1)
+        with open(self._path(), 'rb') as f:
+            self.assertEqual(f.read(), b'receipt')
+
+    def test_mismatch_keeps_nothing(self):
+        import os
+        from .integrity import ChecksumMismatch
+        blob = _Blob('e/r/a.jpg', b'receipt', stored=_b64md5(b'other'))
+        self.assertRaises(ChecksumMismatch, self._callFUT, blob,
+                          self._path())
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_discard(self):
+        self.assertEqual(self._callFUT(_Blob('e/r/a.jpg', b'receipt'),
+                                       None), 1)
+
+    def test_unverifiable(self):
+        self.assertEqual(self._callFUT(_Blob('e/r/a.jpg', b'receipt', ''),
+                                       None), 0)
+
+
+class Test__cached_download(_TempDir, unittest.TestCase):
+
+    def setUp(self):
+        import os
+        from . import _receipt_cache
+        from .cache import DiskLRUCache
+        super(Test__cached_download, self).setUp()
+        self._saved = _receipt_cache[:]
+        self.cache = DiskLRUCache(os.path.join(self.tmpdir, 'cache'), 1024)
+        _receipt_cache[:] = [self.cache]
+
+    def tearDown(self):
+        from . import _receipt_cache
+        _receipt_cache[:] = self._saved
+        super(Test__cached_download, self).tearDown()
+
+    def _callFUT(self, blob, filename):
+        from . import _cached_download
+        return _cached_download(blob, filename)
+
+    def _path(self):
+        import os
+        return os.path.join(self.tmpdir, 'a.jpg')
+
+    def _blob(self, data=b'receipt'):
+        blob = _Blob('e/r/a.jpg', data)
+        blob.generation = 7
+        blob.download_to_file = None  # a hit must not download
+        return blob
+
+    def _cache(self, data):
+        import os
+        source = os.path.join(self.tmpdir, 'source')
+        with open(source, 'wb') as f:
+            f.write(data)
+        self.cache.put('e/r/a.jpg#7', source)
+
+    def test_hit(self):
+        self._cache(b'receipt')
+        self.assertEqual(self._callFUT(self._blob(), self._path()), 1)
+        with open(self._path(), 'rb') as f:
+            self.assertEqual(f.read(), b'receipt')
+
+    @unittest.skipUnless(_has_gcloud(), 'gcloud not installed')
+    def test_miss_fills_cache(self):
+        blob = _Blob('e/r/a.jpg', b'receipt')
+        blob.generation = 7
+        self.assertEqual(self._callFUT(blob, self._path()), 1)
+        with self.cache.open('e/r/a.jpg#7') as f:
+            self.assertEqual(f.read(), b'receipt')
+
+    @unittest.skipUnless(_has_gcloud(), 'gcloud not installed')
+    def test_corrupt_entry_replaced(self):
+        self._cache(b'rotten!')
+        blob = _Blob('e/r/a.jpg', b'receipt')
+        blob.generation = 7
+        self.assertEqual(self._callFUT(blob, self._path()), 1)
+        with self.cache.open('e/r/a.jpg#7') as f:
+            self.assertEqual(f.read(), b'receipt')
@@ -0,0 +1,74 @@
+import unittest
+
+
+class LazyModuleTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .lazy import LazyModule
+        return LazyModule
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_imports_on_first_access(self):
+        import json
+        calls = []
+        lazy = self._makeOne('json', lambda: calls.append(1))
+        self.assertEqual(calls, [])
+        self.assertTrue(lazy.dumps is json.dumps)
+        self.assertTrue(lazy.loads is json.loads)
+        self.assertEqual(calls, [1])
+
+    def test_setup_failure_retried(self):
+        calls = []
+        def _setup():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError()
+        lazy = self._makeOne('json', _setup)
+        self.assertRaises(ValueError, getattr, lazy, 'dumps')
+        lazy.dumps
+        self.assertEqual(len(calls), 2)
+
+
+class LazyAttributeTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .lazy import LazyAttribute
+        return LazyAttribute
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_call(self):
+        from .lazy import LazyModule
+        lazy = self._makeOne(LazyModule('collections'), 'OrderedDict')
+        self.assertEqual(lazy(a=1), {'a': 1})
+
+    def test_wrap_applied_once(self):
+        import collections
+        from .lazy import LazyModule
+        wrapped = []
+        def _wrap(klass):
+            wrapped.append(klass)
+            return klass
+        lazy = self._makeOne(LazyModule('collections'), 'OrderedDict', _wrap)
+        lazy()
+        lazy()
+        self.assertEqual(wrapped, [collections.OrderedDict])
+
+
+class ScriptImportTests(unittest.TestCase):
+
+    def test_scripts_do_not_import_gcloud(self):
+        import subprocess
+        import sys
+        program = (
+            'import sys\n'
+            'import gcloud_expenses.scripts.submit_expenses\n'
+            'import gcloud_expenses.scripts.review_expenses\n'
+            'import gcloud_expenses.scripts.expense_receipts\n'
+            'sys.stdout.write(str(sorted('
+            'x for x in sys.modules if x.startswith("gcloud."))))\n')
+        output = subprocess.check_output([sys.executable, '-c', program])
+        self.assertEqual(output.strip(), b'[]')
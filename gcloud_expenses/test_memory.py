@@ -0,0 +1,120 @@
+import unittest
+
+
+class MemoryDatastoreTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .memory import MemoryDatastore
+        return MemoryDatastore
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def _entity(self, *path, **properties):
+        from .memory import Entity
+        from .memory import Key
+        entity = Entity(Key(*path))
+        entity.update(properties)
+        return entity
+
+    def test_put_get_delete(self):
+        from .memory import Key
+        store = self._makeOne()
+        store.put([self._entity('Employee', 'sally', name='Sally')])
+        found, = store.get([Key('Employee', 'sally'), Key('Employee', 'x')])
+        self.assertEqual(found, {'name': 'Sally'})
+        self.assertEqual(found.key.path, [{'kind': 'Employee',
+                                           'name': 'sally'}])
+        found['name'] = 'changed'
+        store.delete([Key('Employee', 'fred')])
+        self.assertEqual(store.get([Key('Employee', 'sally')])[0]['name'],
+                         'Sally')
+        store.delete([Key('Employee', 'sally')])
+        self.assertEqual(store.get([Key('Employee', 'sally')]), [])
+
+    def test_query(self):
+        from .memory import Key
+        store = self._makeOne()
+        store.put([
+            self._entity('Employee', 'sally', 'Expense Report', 'r2',
+                         status='paid', total=5),
+            self._entity('Employee', 'sally', 'Expense Report', 'r1',
+                         status='pending', total=5),
+            self._entity('Employee', 'fred', 'Expense Report', 'r3',
+                         status='pending', total=7),
+            self._entity('Employee', 'sally', 'Expense Report', 'r1',
+                         'Expense Item', 2),
+            self._entity('Employee', 'sally', 'Expense Report', 'r1',
+                         'Expense Item', 10),
+            ])
+        def _paths(found):
+            return [x.key.flat_path[1::2] for x in found]
+        self.assertEqual(_paths(store.query('Expense Report')),
+                         [('fred', 'r3'), ('sally', 'r1'), ('sally', 'r2')])
+        self.assertEqual(_paths(store.query(
+            'Expense Report', Key('Employee', 'sally'),
+            [('status', 'pending')])), [('sally', 'r1')])
+        self.assertEqual(_paths(store.query('Expense Report',
+                                            order=['-total'])),
+                         [('fred', 'r3'), ('sally', 'r1'), ('sally', 'r2')])
+        self.assertEqual(_paths(store.query('Expense Item', limit=1,
+                                            offset=1)),
+                         [('sally', 'r1', 10)])
+
+    def test_transaction(self):
+        from .memory import Key
+        store = self._makeOne()
+        Transaction = store.transaction_class()
+        with Transaction():
+            store.put([self._entity('Employee', 'sally')])
+            self.assertEqual(store.get([Key('Employee', 'sally')]), [])
+        self.assertEqual(len(store.get([Key('Employee', 'sally')])), 1)
+        try:
+            with Transaction():
+                store.delete([Key('Employee', 'sally')])
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(len(store.get([Key('Employee', 'sally')])), 1)
+
+
+class Test_install(unittest.TestCase):
+
+    _PATCHED = ('datastore', 'exceptions', 'Key', 'Entity', 'Query',
+                'Transaction', 'new_client', '_initialized')
+
+    def setUp(self):
+        import gcloud_expenses
+        self._saved = dict([(name, getattr(gcloud_expenses, name))
+                            for name in self._PATCHED])
+        gcloud_expenses._initialized = list(gcloud_expenses._initialized)
+        gcloud_expenses.known_employees.clear()
+
+    def tearDown(self):
+        import gcloud_expenses
+        for name, value in self._saved.items():
+            setattr(gcloud_expenses, name, value)
+        gcloud_expenses.known_employees.clear()
+
+    def test_data_functions_use_store(self):
+        import datetime
+        import decimal
+        import gcloud_expenses
+        from .clients import activate
+        from .memory import install
+        store = install()
+        gcloud_expenses.initialize_gcloud()  # no gcloud import
+        client = gcloud_expenses.new_client()
+        previous = activate(client.connection)
+        try:
+            gcloud_expenses.create_report('sally', 'r1', [{
+                'Date': datetime.date(2014, 9, 1), 'Vendor': 'Yellow Cab',
+                'Quantity': 1, 'Price': decimal.Decimal('12.50'),
+                'Memo': 'Taxi'}], 'Trip')
+            info = gcloud_expenses.get_report_info('sally', 'r1')
+        finally:
+            activate(previous)
+        self.assertEqual(info['description'], 'Trip')
+        self.assertEqual([x['Memo'] for x in info['items']], ['Taxi'])
+        self.assertEqual(len(store.query('Expense Report')), 1)
+        self.assertRaises(NotImplementedError, lambda: client.bucket)
@@ -0,0 +1,131 @@
+import unittest
+
+
+def _has_pillow():
+    from .normalize import Image
+    return Image is not None
+
+
+class _TempDir(object):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _write(self, name, data):
+        import os
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _target_dir(self):
+        import tempfile
+        return tempfile.mkdtemp(dir=self.tmpdir)
+
+
+class Test_normalize_file(_TempDir, unittest.TestCase):
+
+    def _callFUT(self, source, **kw):
+        from .normalize import normalize_file
+        return normalize_file(source, self._target_dir(), **kw)
+
+    def test_other_types_passed_through(self):
+        source = self._write('notes.txt', b'taxi to IAD')
+        self.assertEqual(self._callFUT(source), {
+            'source': source,
+            'path': source,
+            'name': 'notes.txt',
+            'original_bytes': 11,
+            'bytes': 11,
+            'error': None,
+            })
+
+    def test_shrunk_keeps_source_name(self):
+        import os
+        from . import normalize
+        def _normalize_image(source, target_dir, max_dimension, quality):
+            target = os.path.join(target_dir, 'receipt.png')
+            with open(target, 'wb') as f:
+                f.write(b'PNG')
+            return target
+        saved, normalize.normalize_image = (normalize.normalize_image,
+                                            _normalize_image)
+        try:
+            result = self._callFUT(self._write('receipt.png', b'PNG' * 10))
+        finally:
+            normalize.normalize_image = saved
+        self.assertEqual(result['name'], 'receipt.png')
+        self.assertEqual(os.path.basename(result['path']), 'receipt.png')
+        self.assertEqual(result['bytes'], 3)
+
+    def test_pdf_without_ghostscript(self):
+        import os
+        source = self._write('scan.pdf', b'%PDF-1.4 not really')
+        saved, os.environ['PATH'] = os.environ.get('PATH', ''), ''
+        try:
+            result = self._callFUT(source)
+        finally:
+            os.environ['PATH'] = saved
+        self.assertEqual(result['path'], source)
+        self.assertEqual(result['error'], None)
+
+    @unittest.skipUnless(_has_pillow(), 'Pillow not installed')
+    def test_unreadable_image(self):
+        source = self._write('photo.jpg', b'not an image')
+        result = self._callFUT(source)
+        self.assertEqual(result['path'], source)
+        self.assertTrue(result['error'])
+
+    @unittest.skipUnless(_has_pillow(), 'Pillow not installed')
+    def test_image_downsampled_without_metadata(self):
+        import os
+        from .normalize import Image
+        source = os.path.join(self.tmpdir, 'photo.png')
+        # Noise compresses poorly as PNG, as does a photo.
+        image = Image.frombytes('RGB', (2400, 1800),
+                                os.urandom(2400 * 1800 * 3))
+        image.save(source)
+        result = self._callFUT(source, max_dimension=1000)
+        self.assertEqual(result['name'], 'photo.png')
+        self.assertTrue(result['path'].endswith('photo.png'))
+        self.assertTrue(result['bytes'] < result['original_bytes'])
+        normalized = Image.open(result['path'])
+        self.assertEqual(normalized.format, 'PNG')
+        self.assertEqual(normalized.size, (1000, 750))
+        self.assertFalse('exif' in normalized.info)
+
+
+    @unittest.skipUnless(_has_pillow(), 'Pillow not installed')
+    def test_jpeg_recompressed(self):
+        import os
+        from .normalize import Image
+        source = os.path.join(self.tmpdir, 'photo.jpg')
+        image = Image.frombytes('RGB', (1600, 1200),
+                                os.urandom(1600 * 1200 * 3))
+        image.save(source, quality=95)
+        result = self._callFUT(source, max_dimension=800, quality=60)
+        self.assertTrue(result['path'].endswith('photo.jpg'))
+        self.assertTrue(result['bytes'] < result['original_bytes'])
+        normalized = Image.open(result['path'])
+        self.assertEqual(normalized.format, 'JPEG')
+        self.assertEqual(normalized.size, (800, 600))
+
+
+class Test_normalize_files(_TempDir, unittest.TestCase):
+
+    def _callFUT(self, sources, **kw):
+        from .normalize import normalize_files
+        return normalize_files(sources, self._target_dir(), **kw)
+
+    def test_results_in_order(self):
+        sources = [self._write('r%d.txt' % n, b'x' * n) for n in range(4)]
+        for workers in (1, 2):
+            results = self._callFUT(sources, workers=workers)
+            self.assertEqual([x['source'] for x in results], sources)
+            self.assertEqual([x['bytes'] for x in results], [0, 1, 2, 3])
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([]), [])
@@ -0,0 +1,261 @@
+import unittest
+
+
+class _TempDir(object):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOutbox(self):
+        import os
+        from .outbox import Outbox
+        return Outbox(os.path.join(self.tmpdir, 'sub', 'outbox.sqlite'))
+
+
+class OutboxTests(_TempDir, unittest.TestCase):
+
+    def test_append_and_pending_roundtrip(self):
+        import datetime
+        import decimal
+        outbox = self._makeOutbox()
+        rows = [{'Date': datetime.date(2015, 1, 2),
+                 'Price': decimal.Decimal('12.50'),
+                 'Vendor': u'Acme'}]
+        op = outbox.append('create', 'sally', 'r1', rows=rows,
+                           description='Trip')
+        outbox.append('delete', 'fred', 'r2', force=True)
+        self.assertEqual(len(outbox), 2)
+        first, second = outbox.pending()
+        self.assertEqual(first.id, op.id)
+        self.assertEqual(first.token, op.token)
+        self.assertEqual(first.report, ('sally', 'r1'))
+        self.assertEqual(first.payload, {'rows': rows,
+                                         'description': 'Trip'})
+        self.assertEqual(second.payload, {'force': True})
+        self.assertEqual([x.id for x in outbox.pending(1)], [op.id])
+
+    def test_sending_fail_remove(self):
+        outbox = self._makeOutbox()
+        a = outbox.append('delete', 'sally', 'r1', force=False)
+        b = outbox.append('delete', 'sally', 'r2', force=False)
+        outbox.sending([a.id, b.id])
+        outbox.fail([a.id], 'NoSuchReport: ')
+        outbox.remove([b.id])
+        self.assertEqual(len(outbox), 0)
+        failed, = outbox.failed()
+        self.assertEqual(failed.attempts, 1)
+        self.assertEqual(failed.last_error, 'NoSuchReport: ')
+
+    def test_shared_between_instances(self):
+        outbox = self._makeOutbox()
+        outbox.append('delete', 'sally', 'r1', force=False)
+        self.assertEqual(len(self._makeOutbox()), 1)
+
+
+def _op(id, operation, report_id='r1', attempts=0, **payload):
+    from .outbox import Operation
+    return Operation(id, 'token-%d' % id, operation, 'sally', report_id,
+                     payload, attempts=attempts)
+
+
+class Test_coalesce(unittest.TestCase):
+
+    def _callFUT(self, operations):
+        from .outbox import coalesce
+        return [(op and (op.operation, op.token, op.payload), ids)
+                for op, ids in coalesce(operations)]
+
+    def test_create_then_updates(self):
+        self.assertEqual(self._callFUT([
+            _op(1, 'create', rows=[1]),
+            _op(2, 'update', rows=[2]),
+            _op(3, 'update', rows=[3]),
+            ]), [(('create', 'token-1', {'rows': [3]}), [1, 2, 3])])
+
+    def test_create_then_delete_cancel(self):
+        self.assertEqual(self._callFUT([
+            _op(1, 'create', rows=[1]),
+            _op(2, 'delete', force=False),
+            _op(3, 'create', rows=[3]),
+            ]), [(('create', 'token-3', {'rows': [3]}), [1, 2, 3])])
+
+    def test_delete_then_create_kept(self):
+        self.assertEqual(self._callFUT([
+            _op(1, 'update', rows=[1]),
+            _op(2, 'delete', force=False),
+            _op(3, 'create', rows=[3]),
+            ]), [(('delete', 'token-2', {'force': False}), [1, 2]),
+                 (('create', 'token-3', {'rows': [3]}), [3])])
+
+    def test_reports_kept_apart(self):
+        self.assertEqual(self._callFUT([
+            _op(1, 'update', 'r1', rows=[1]),
+            _op(2, 'update', 'r2', rows=[2]),
+            _op(3, 'update', 'r1', rows=[3]),
+            ]), [(('update', 'token-3', {'rows': [3]}), [1, 3]),
+                 (('update', 'token-2', {'rows': [2]}), [2])])
+
+    def test_sent_operations_not_merged(self):
+        self.assertEqual(self._callFUT([
+            _op(1, 'create', attempts=1, rows=[1]),
+            _op(2, 'update', rows=[2]),
+            _op(3, 'update', attempts=1, rows=[3]),
+            ]), [(('create', 'token-1', {'rows': [1]}), [1]),
+                 (('update', 'token-2', {'rows': [2]}), [2]),
+                 (('update', 'token-3', {'rows': [3]}), [3])])
+
+
+class _Client(object):
+
+    def __init__(self):
+        self.connection = object()
+
+
+class Test_apply_operation(unittest.TestCase):
+
+    def setUp(self):
+        from . import outbox
+        self._saved = outbox.create_report, outbox.delete_report
+        self.calls = []
+        def _create_report(*args, **kw):
+            self.calls.append(('create', args, kw))
+        def _delete_report(*args, **kw):
+            self.calls.append(('delete', args, kw))
+        outbox.create_report = _create_report
+        outbox.delete_report = _delete_report
+
+    def tearDown(self):
+        from . import outbox
+        outbox.create_report, outbox.delete_report = self._saved
+
+    def _callFUT(self, op):
+        from .outbox import apply_operation
+        return apply_operation(op)
+
+    def test_first_send(self):
+        self._callFUT(_op(1, 'create', rows=[1], description='Trip'))
+        self.assertEqual(self.calls, [
+            ('create', ('sally', 'r1', [1], 'Trip'),
+             {'token': 'token-1', 'maybe_committed': False})])
+
+    def test_sent_before(self):
+        self._callFUT(_op(2, 'delete', attempts=1, force=False))
+        self.assertEqual(self.calls, [
+            ('delete', ('sally', 'r1', False),
+             {'token': 'token-2', 'maybe_committed': True})])
+
+
+class Test_flush(_TempDir, unittest.TestCase):
+
+    def _callFUT(self, outbox, apply, **kw):
+        from .outbox import flush
+        self.clients = []
+        def _new_client():
+            self.clients.append(_Client())
+            return self.clients[-1]
+        return flush(outbox, apply=apply, new_client=_new_client, **kw)
+
+    def test_connection_per_thread(self):
+        import threading
+        from .clients import current
+        outbox = self._makeOutbox()
+        for report_id in ('r1', 'r2', 'r3', 'r4', 'r5'):
+            outbox.append('update', 'sally', report_id, rows=[],
+                          description='')
+        seen = []
+        def _apply(op):
+            seen.append((threading.current_thread(), current()))
+        self.assertEqual(self._callFUT(outbox, _apply)['applied'], 5)
+        by_thread = {}
+        for thread, connection in seen:
+            self.assertTrue(by_thread.setdefault(thread, connection)
+                            is connection)
+        self.assertEqual(sorted(map(id, by_thread.values())),
+                         sorted(id(x.connection) for x in self.clients))
+        self.assertTrue(current() is None)
+
+    def test_applies_in_batches(self):
+        outbox = self._makeOutbox()
+        for report_id in ('r1', 'r2', 'r1', 'r3'):
+            outbox.append('update', 'sally', report_id, rows=[],
+                          description=report_id)
+        applied = []
+        result = self._callFUT(outbox, applied.append, batch_size=3)
+        self.assertEqual(result, {'applied': 4, 'failed': [], 'error': None,
+                                  'remaining': 0})
+        self.assertEqual(sorted(x.report_id for x in applied),
+                         ['r1', 'r2', 'r3'])
+        self.assertEqual(len(outbox), 0)
+
+    def test_permanent_error_set_aside(self):
+        from . import NoSuchReport
+        outbox = self._makeOutbox()
+        outbox.append('update', 'sally', 'r1', rows=[], description='')
+        outbox.append('delete', 'sally', 'r2', force=False)
+
+        def _apply(op):
+            if op.report_id == 'r1':
+                raise NoSuchReport()
+        result = self._callFUT(outbox, _apply)
+        self.assertEqual(result['applied'], 1)
+        (op, message), = result['failed']
+        self.assertEqual(op.report_id, 'r1')
+        self.assertEqual(message, 'NoSuchReport: ')
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(len(outbox.failed()), 1)
+
+    def test_transient_error_keeps_report_queued(self):
+        outbox = self._makeOutbox()
+        outbox.append('create', 'sally', 'r1', rows=[], description='')
+        outbox.append('delete', 'sally', 'r2', force=False)
+        # Already sent once:  not merged with the create.
+        sent = outbox.append('update', 'sally', 'r1', rows=[],
+                             description='')
+        outbox.sending([sent.id])
+        applied = []
+
+        def _apply(op):
+            if op.operation == 'create':
+                raise RuntimeError('unreachable')
+            applied.append(op)
+        result = self._callFUT(outbox, _apply, workers=1)
+        self.assertEqual(result['applied'], 1)
+        self.assertEqual(result['error'], 'RuntimeError: unreachable')
+        self.assertEqual(result['remaining'], 2)
+        self.assertEqual([x.report_id for x in applied], ['r2'])
+        pending = outbox.pending()
+        self.assertEqual([x.operation for x in pending], ['create', 'update'])
+        self.assertEqual([x.attempts for x in pending], [1, 1])
+        self.assertEqual(pending[0].last_error, 'RuntimeError: unreachable')
+
+    def test_blocked_operations_still_coalesced(self):
+        outbox = self._makeOutbox()
+        sent = outbox.append('update', 'sally', 'r1', rows=[],
+                             description='sent')
+        outbox.sending([sent.id])
+        outbox.append('update', 'sally', 'r1', rows=[], description='b')
+        outbox.append('update', 'sally', 'r1', rows=[], description='c')
+
+        def _down(op):
+            raise RuntimeError('unreachable')
+        result = self._callFUT(outbox, _down, workers=1)
+        self.assertEqual(result['remaining'], 3)
+        # Never sent:  still unsent, and so still mergeable.
+        self.assertEqual([x.attempts for x in outbox.pending()], [2, 0, 0])
+        applied = []
+        result = self._callFUT(outbox, applied.append, workers=1)
+        self.assertEqual(result['applied'], 3)
+        self.assertEqual([(x.payload['description'], x.attempts)
+                          for x in applied], [('sent', 2), ('c', 0)])
+
+    def test_replay_passes_token(self):
+        outbox = self._makeOutbox()
+        op = outbox.append('create', 'sally', 'r1', rows=[], description='')
+        tokens = []
+        self._callFUT(outbox, lambda x: tokens.append(x.token))
+        self.assertEqual(tokens, [op.token])
@@ -0,0 +1,701 @@
+import datetime
+import unittest
+import urllib
+
+
+def _has_gcloud():
+    try:
+        import gcloud
+    except ImportError:
+        return False
+    return True
+
+
+class _Key(object):
+
+    def __init__(self, *path_args):
+        self.flat_path = tuple(path_args)
+        self.path = []
+        for kind, id_or_name in zip(path_args[::2], path_args[1::2]):
+            if isinstance(id_or_name, int):
+                self.path.append({'kind': kind, 'id': id_or_name})
+            else:
+                self.path.append({'kind': kind, 'name': id_or_name})
+
+    def __eq__(self, other):
+        return self.flat_path == getattr(other, 'flat_path', None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.flat_path)
+
+    def __repr__(self):
+        return '<Key %r>' % (self.flat_path,)
+
+
+class _Entity(dict):
+
+    def __init__(self, key=None):
+        super(_Entity, self).__init__()
+        self.key = key
+
+
+class _Conflict(Exception):
+    pass
+
+
+class _InternalServerError(Exception):
+    pass
+
+
+class _ServiceUnavailable(Exception):
+    pass
+
+
+class _NotFound(Exception):
+    pass
+
+
+class _Exceptions(object):
+    Conflict = _Conflict
+    InternalServerError = _InternalServerError
+    ServiceUnavailable = _ServiceUnavailable
+    NotFound = _NotFound
+
+
+def _sort_key(key):
+    return tuple((0, x, '') if isinstance(x, int) else (1, 0, x)
+                 for x in key.flat_path)
+
+
+class _Datastore(object):
+    """In-memory datastore:  writes made in a transaction apply on commit.
+
+    ``commit_errors`` are raised by the next commits:  a conflict discards
+    the transaction's writes, any other error is raised after applying them
+    (the caller can't tell whether the commit happened).
+    """
+    def __init__(self):
+        self.entities = {}
+        self.pending = None
+        self.commit_errors = []
+        self.connections = []
+
+    def _load(self, key):
+        entity = _Entity(key)
+        entity.update(self.entities[key])
+        return entity
+
+    def _write(self, key, properties):
+        if self.pending is not None:
+            self.pending.append((key, properties))
+        elif properties is None:
+            self.entities.pop(key, None)
+        else:
+            self.entities[key] = properties
+
+    def get(self, keys, connection=None):
+        self.connections.append(connection)
+        return [self._load(key) for key in keys if key in self.entities]
+
+    def put(self, entities, connection=None):
+        self.connections.append(connection)
+        for entity in entities:
+            self._write(entity.key, dict(entity))
+
+    def delete(self, keys, connection=None):
+        self.connections.append(connection)
+        for key in keys:
+            self._write(key, None)
+
+    def query(self, kind, ancestor, filters, order):
+        found = []
+        for key in sorted(self.entities, key=_sort_key):
+            if key.flat_path[-2] != kind:
+                continue
+            if (ancestor is not None and
+                    key.flat_path[:len(ancestor.flat_path)] !=
+                    ancestor.flat_path):
+                continue
+            entity = self._load(key)
+            if all(entity.get(name) == value for name, value in filters):
+                found.append(entity)
+        for name in reversed(order):
+            found.sort(key=lambda x: x.get(name.lstrip('-')),
+                       reverse=name.startswith('-'))
+        return found
+
+    def commit(self, pending):
+        error = self.commit_errors.pop(0) if self.commit_errors else None
+        if isinstance(error, _Conflict):
+            raise error
+        self.pending = None
+        for key, properties in pending:
+            self._write(key, properties)
+        if error is not None:
+            raise error
+
+    def items(self, kind):
+        return sorted([k.flat_path for k in self.entities
+                       if k.flat_path[-2] == kind])
+
+
+def _query_class(store):
+    class _Query(object):
+        def __init__(self, kind=None):
+            self.kind = kind
+            self.ancestor = None
+            self.filters = []
+            self.order = []
+
+        def add_filter(self, name, operator, value):
+            assert operator == '='
+            self.filters.append((name, value))
+
+        def fetch(self, limit=None, offset=0, connection=None):
+            store.connections.append(connection)
+            found = store.query(self.kind, self.ancestor, self.filters,
+                                self.order)
+            end = None if limit is None else offset + limit
+            return iter(found[offset:end])
+    return _Query
+
+
+def _transaction_class(store):
+    class _Transaction(object):
+        def __init__(self, connection=None):
+            self.connection = connection
+
+        def __enter__(self):
+            store.connections.append(self.connection)
+            store.pending = []
+            return self
+
+        def __exit__(self, exc_type, exc_value, tb):
+            pending, store.pending = store.pending, None
+            if exc_type is None:
+                store.commit(pending)
+            return False
+    return _Transaction
+
+
+class _UTC(datetime.tzinfo):
+
+    def utcoffset(self, when):
+        return datetime.timedelta(0)
+
+    def dst(self, when):
+        return datetime.timedelta(0)
+
+    def tzname(self, when):
+        return 'UTC'
+
+
+class _Blob(object):
+
+    def __init__(self, name, bucket=None, properties=None):
+        self.name = name
+        self.bucket = bucket
+        self.properties = dict(properties or {})
+        self.updated = None
+
+    def download_as_string(self):
+        return self.bucket.blobs[self.name]
+
+    def download_to_file(self, f):
+        self.bucket.downloads.append(self.name)
+        f.write(self.bucket.blobs[self.name])
+
+    def upload_from_string(self, data):
+        self.bucket.blobs[self.name] = data
+
+
+class _Bucket(object):
+
+    def __init__(self, blobs=None):
+        self.blobs = dict(blobs or {})
+        self.updated = {}
+        self.properties = {}
+        self.downloads = []
+
+    def iterator(self, prefix=''):
+        found = []
+        for name in sorted(self.blobs):
+            if name.startswith(prefix):
+                blob = _Blob(name, self, self.properties.get(name))
+                blob.updated = self.updated.get(name)
+                found.append(blob)
+        return found
+
+    def new_blob(self, name):
+        return _Blob(name, self)
+
+
+class _Client(object):
+
+    def __init__(self, bucket):
+        self.connection = object()
+        self.bucket = bucket
+
+
+class _DatastoreTests(object):
+    """Mixin:  run the data functions against an in-memory datastore.
+    """
+    _PATCHED = ('datastore', 'exceptions', 'Key', 'Entity', 'Query',
+                'Transaction')
+
+    def setUp(self):
+        import gcloud_expenses
+        from .clients import ConnectedNamespace
+        from .clients import connected_query_class
+        from .clients import connected_transaction_class
+        self._saved = dict([(name, getattr(gcloud_expenses, name))
+                            for name in self._PATCHED])
+        self._initial_delay = (
+            gcloud_expenses.TRANSACTION_RETRY_POLICY.initial_delay)
+        gcloud_expenses.TRANSACTION_RETRY_POLICY.initial_delay = 0
+        gcloud_expenses.known_employees.clear()
+        self.store = store = _Datastore()
+        gcloud_expenses.datastore = ConnectedNamespace(
+            store, ('get', 'put', 'delete'))
+        gcloud_expenses.exceptions = _Exceptions
+        gcloud_expenses.Key = _Key
+        gcloud_expenses.Entity = _Entity
+        gcloud_expenses.Query = connected_query_class(_query_class(store))
+        gcloud_expenses.Transaction = connected_transaction_class(
+            _transaction_class(store))
+
+    def tearDown(self):
+        import gcloud_expenses
+        for name, value in self._saved.items():
+            setattr(gcloud_expenses, name, value)
+        gcloud_expenses.TRANSACTION_RETRY_POLICY.initial_delay = (
+            self._initial_delay)
+        gcloud_expenses.known_employees.clear()
+
+    def _rows(self, *prices):
+        import datetime
+        import decimal
+        return [{'Date': datetime.date(2014, 9, 1), 'Vendor': 'Yellow Cab',
+                 'Quantity': 1, 'Price': decimal.Decimal(price),
+                 'Memo': 'Taxi'} for price in prices]
+
+    def _queue(self):
+        from . import next_reports_to_review
+        return [(x['employee_id'], x['report_id'], x['total'])
+                for x in next_reports_to_review()]
+
+
+class ReviewQueueTests(_DatastoreTests, unittest.TestCase):
+
+    def test_create_enqueues(self):
+        from . import create_report
+        create_report('sally', 'r1', self._rows('10.00', '2.50'), 'Trip')
+        self.assertEqual(self._queue(), [('sally', 'r1', '12.50')])
+
+    def test_update_replaces_entry(self):
+        from . import create_report
+        from . import update_report
+        create_report('sally', 'r1', self._rows('10.00'), 'Trip')
+        update_report('sally', 'r1', self._rows('7.00'), None)
+        self.assertEqual(self._queue(), [('sally', 'r1', '7.00')])
+
+    def test_approve_reject_delete_dequeue(self):
+        from . import approve_report
+        from . import create_report
+        from . import delete_report
+        from . import reject_report
+        for report_id in ('r1', 'r2', 'r3', 'r4'):
+            create_report('sally', report_id, self._rows('1.00'), None)
+        approve_report('sally', 'r1', '4093')
+        reject_report('sally', 'r2', 'No receipts')
+        delete_report('sally', 'r3', False)
+        self.assertEqual(self._queue(), [('sally', 'r4', '1.00')])
+
+    def test_failed_approval_keeps_entry(self):
+        from . import BadReportStatus
+        from . import approve_report
+        from . import create_report
+        from . import reject_report
+        create_report('sally', 'r1', self._rows('1.00'), None)
+        reject_report('sally', 'r1', 'No receipts')
+        self.assertRaises(BadReportStatus, approve_report, 'sally', 'r1',
+                          '4093')
+        self.assertEqual(self._queue(), [])
+
+    def test_order_oldest_then_largest(self):
+        import datetime
+        from . import create_report
+        from . import REVIEW_QUEUE_KIND
+        create_report('sally', 'r1', self._rows('1.00'), None)
+        create_report('fred', 'r2', self._rows('50.00'), None)
+        create_report('fred', 'r3', self._rows('5.00'), None)
+        submitted = {'r1': datetime.datetime(2014, 9, 2),
+                     'r2': datetime.datetime(2014, 9, 1),
+                     'r3': datetime.datetime(2014, 9, 1)}
+        for key, properties in self.store.entities.items():
+            if key.flat_path[-2] == REVIEW_QUEUE_KIND:
+                properties['submitted'] = submitted[key.flat_path[3]]
+        self.assertEqual(self._queue(), [('fred', 'r2', '50.00'),
+                                         ('fred', 'r3', '5.00'),
+                                         ('sally', 'r1', '1.00')])
+
+    def test_rebuild(self):
+        from . import REVIEW_QUEUE_KIND
+        from . import create_report
+        from . import rebuild_review_queue
+        create_report('sally', 'r1', self._rows('3.00'), None)
+        for key in list(self.store.entities):
+            if key.flat_path[-2] == REVIEW_QUEUE_KIND:
+                del self.store.entities[key]
+        self.assertEqual(rebuild_review_queue(), 1)
+        self.assertEqual(self._queue(), [('sally', 'r1', '3.00')])
+
+
+class RetryingTransactionTests(_DatastoreTests, unittest.TestCase):
+
+    def _report(self, employee_id='sally', report_id='r1'):
+        return self.store.entities.get(
+            _Key('Employee', employee_id, 'Expense Report', report_id))
+
+    def _stats(self, name):
+        from . import transaction_stats
+        return transaction_stats.snapshot().get(name, {})
+
+    def test_conflict_retried(self):
+        from . import create_report
+        before = self._stats('create_report').get('conflicts', 0)
+        self.store.commit_errors = [_Conflict()]
+        create_report('sally', 'r1', self._rows('1.00', '2.00'), 'Trip')
+        self.assertEqual(self._report()['status'], 'pending')
+        self.assertEqual(len(self.store.items('Expense Item')), 2)
+        self.assertEqual(self._stats('create_report')['conflicts'],
+                         before + 1)
+
+    def test_conflicts_exhausted(self):
+        from . import RetriesExhausted
+        from . import TRANSACTION_RETRY_POLICY
+        from . import create_report
+        self.store.commit_errors = (
+            [_Conflict()] * TRANSACTION_RETRY_POLICY.max_attempts)
+        self.assertRaises(RetriesExhausted, create_report, 'sally', 'r1',
+                          self._rows('1.00'), None)
+        self.assertTrue(self._report() is None)
+
+    def test_create_ambiguous_commit_applied_once(self):
+        from . import create_report
+        self.store.commit_errors = [_ServiceUnavailable()]
+        create_report('sally', 'r1', self._rows('1.00'), None)
+        report = self._report()
+        self.assertEqual(report['status'], 'pending')
+        self.assertTrue(report['operation_token'])
+
+    def test_approve_ambiguous_commit_applied_once(self):
+        from . import approve_report
+        from . import create_report
+        create_report('sally', 'r1', self._rows('1.00'), None)
+        self.store.commit_errors = [_ServiceUnavailable()]
+        # Without the token, the retry would find the report already paid.
+        approve_report('sally', 'r1', '4093')
+        self.assertEqual(self._report()['status'], 'paid')
+        self.assertEqual(self._report()['check_number'], '4093')
+
+    def test_delete_ambiguous_commit_returns_count(self):
+        from . import create_report
+        from . import delete_report
+        create_report('sally', 'r1', self._rows('1.00', '2.00'), None)
+        self.store.commit_errors = [_ServiceUnavailable()]
+        self.assertEqual(delete_report('sally', 'r1', False), 2)
+        self.assertTrue(self._report() is None)
+
+    def test_other_operation_not_mistaken(self):
+        from . import BadReportStatus
+        from . import approve_report
+        from . import create_report
+        from . import reject_report
+        create_report('sally', 'r1', self._rows('1.00'), None)
+        reject_report('sally', 'r1', 'No receipts')
+        self.store.commit_errors = [_ServiceUnavailable()]
+        self.assertRaises(BadReportStatus, approve_report, 'sally', 'r1',
+                          '4093')
+
+
+class EnsureEmployeesTests(_DatastoreTests, unittest.TestCase):
+
+    def _callFUT(self, employee_ids):
+        from . import ensure_employees
+        return ensure_employees(employee_ids)
+
+    def test_creates_missing_once(self):
+        from . import ensure_employee
+        ensure_employee('sally')
+        self.assertEqual(self._callFUT(['fred', 'sally', 'fred', 'joan']), 2)
+        self.assertEqual(self.store.items('Employee'),
+                         [('Employee', 'fred'), ('Employee', 'joan'),
+                          ('Employee', 'sally')])
+        calls = len(self.store.connections)
+        self.assertEqual(self._callFUT(['fred', 'joan']), 0)
+        self.assertEqual(len(self.store.connections), calls)
+
+
+class ScanDuplicatesTests(_DatastoreTests, unittest.TestCase):
+
+    def _callFUT(self, **kw):
+        from . import scan_duplicates
+        return list(scan_duplicates(**kw))
+
+    def test_reads_items_once(self):
+        from . import create_report
+        create_report('sally', 'r1', self._rows('10.00', '3.00'), None)
+        create_report('fred', 'r2', self._rows('10.00'), None)
+        create_report('fred', 'r3', self._rows('3.01'), None)
+        for partitions in (1, 3):
+            del self.store.connections[:]
+            found = self._callFUT(cents_tolerance=1, partitions=partitions)
+            self.assertEqual(len(self.store.connections), 1)
+            self.assertEqual(
+                sorted((x['employee_id'], x['report_id'], x['item'],
+                        x['other_report_id'], x['other_item'])
+                       for x in found),
+                [('sally', 'r1', 1, 'r2', 1), ('sally', 'r1', 2, 'r3', 1)])
+
+    def test_one_partition_scanner_at_a_time(self):
+        import gc
+        import weakref
+        import gcloud_expenses
+        from . import create_report
+        from .duplicates import DuplicateScanner
+        live = weakref.WeakSet()
+        seen = []
+        class _Scanner(DuplicateScanner):
+            def add(self, ref, report, row):
+                gc.collect()
+                live.add(self)
+                seen.append(len(live))
+                return super(_Scanner, self).add(ref, report, row)
+        create_report('sally', 'r1', self._rows('10.00', '3.00'), None)
+        create_report('fred', 'r2', self._rows('10.00', '3.00'), None)
+        for number in range(3, 9):
+            rows = self._rows('1.00')
+            rows[0]['Vendor'] = 'Vendor %d' % number
+            create_report('fred', 'r%d' % number, rows, None)
+        gcloud_expenses.DuplicateScanner = _Scanner
+        try:
+            found = self._callFUT(partitions=4)
+        finally:
+            gcloud_expenses.DuplicateScanner = DuplicateScanner
+        self.assertEqual(
+            sorted((x['report_id'], x['item'], x['other_report_id'])
+                   for x in found),
+            [('r1', 1, 'r2'), ('r1', 2, 'r2')])
+        self.assertEqual(len(seen), 10)
+        self.assertEqual(set(seen), set([1]))
+
+    def test_queued_delete_of_missing_report(self):
+        from . import NoSuchReport
+        from . import delete_report
+        self.assertRaises(NoSuchReport, delete_report, 'sally', 'r1', False,
+                          token='abc')
+        self.assertTrue(delete_report('sally', 'r1', False, token='abc',
+                                      maybe_committed=True) is None)
+
+
+class BackupRestoreTests(_DatastoreTests, unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import gcloud_expenses
+        super(BackupRestoreTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.bucket = _Bucket()
+        self.clients = []
+        def _new_client():
+            self.clients.append(_Client(self.bucket))
+            return self.clients[-1]
+        self._new_client = gcloud_expenses.new_client
+        gcloud_expenses.new_client = _new_client
+
+    def tearDown(self):
+        import shutil
+        import gcloud_expenses
+        gcloud_expenses.new_client = self._new_client
+        shutil.rmtree(self.tmpdir)
+        super(BackupRestoreTests, self).tearDown()
+
+    def _backup(self, name='full', **kw):
+        import os
+        from . import backup_expenses
+        directory = os.path.join(self.tmpdir, name)
+        kw.setdefault('shards', 2)
+        return directory, backup_expenses(directory, **kw)
+
+    def _restore(self, directory, **kw):
+        from . import restore_expenses
+        kw.setdefault('workers', 2)
+        return restore_expenses(directory, **kw)
+
+    def _keys(self, *kinds):
+        return sorted([k.flat_path for k in self.store.entities
+                       if k.flat_path[-2] in kinds])
+
+    def _index(self):
+        from . import FINGERPRINT_KIND
+        from . import SEARCH_TERM_KIND
+        return self._keys(SEARCH_TERM_KIND, FINGERPRINT_KIND)
+
+    def _report(self, employee_id, report_id):
+        return self.store.entities.get(
+            _Key('Employee', employee_id, 'Expense Report', report_id))
+
+    def _seed(self):
+        from . import approve_report
+        from . import create_report
+        create_report('sally', 'r1', self._rows('10.00', '2.50'), 'Trip')
+        create_report('fred', 'r2', self._rows('7.00'), None)
+        approve_report('fred', 'r2', '4093')
+
+    def test_roundtrip(self):
+        self._seed()
+        entities = dict(self.store.entities)
+        queue = self._queue()
+        directory, manifest = self._backup(receipts=False)
+        self.assertEqual(manifest['counts'],
+                         {'employee': 2, 'report': 2, 'item': 3})
+        self.store.entities.clear()
+        counts = self._restore(directory, receipts=False)
+        self.assertEqual(counts, {'employee': 2, 'report': 2, 'item': 3,
+                                  'pruned': 0})
+        self.assertEqual(sorted(self.store.entities, key=repr),
+                         sorted(entities, key=repr))
+        self.assertEqual(self._queue(), queue)
+        self.assertEqual(self._report('fred', 'r2')['status'], 'paid')
+
+    @unittest.skipUnless(hasattr(urllib, 'unquote'), 'Python 2 only')
+    def test_receipts(self):
+        self._seed()
+        self.bucket.blobs['sally/r1/hotel.jpg'] = b'JPEG'
+        self.bucket.updated['sally/r1/hotel.jpg'] = datetime.datetime(
+            2014, 9, 1, tzinfo=_UTC())
+        directory, manifest = self._backup()
+        self.assertEqual(manifest['counts']['receipt'], 1)
+        self.assertEqual(manifest['counts']['receipt_bytes'], 4)
+        self.bucket.blobs.clear()
+        self.assertEqual(self._restore(directory)['receipt'], 1)
+        self.assertEqual(self.bucket.blobs, {'sally/r1/hotel.jpg': b'JPEG'})
+        for key in self.store.items('Expense Report'):
+            self.store.entities[_Key(*key)]['updated'] = datetime.datetime(
+                2014, 9, 1, tzinfo=_UTC())
+        directory, manifest = self._backup(
+            'incremental', since=datetime.datetime(2014, 9, 2))
+        self.assertFalse('receipt' in manifest['counts'])
+
+    def test_client_per_worker(self):
+        self._seed()
+        directory, _ = self._backup(shards=2, receipts=False)
+        used = set(map(id, self.store.connections))
+        self.assertTrue(1 <= len(self.clients) <= 2)
+        for client in self.clients:
+            self.assertTrue(id(client.connection) in used)
+        del self.clients[:]
+        del self.store.connections[:]
+        self._restore(directory, workers=2, receipts=False)
+        self.assertTrue(1 <= len(self.clients) <= 2)
+        connections = set(map(id, self.store.connections))
+        self.assertEqual(connections,
+                         set(id(x.connection) for x in self.clients))
+
+    def test_incremental_with_aware_datetimes(self):
+        self._seed()
+        since = datetime.datetime(2014, 9, 2)
+        # The datastore hands back timezone-aware datetimes.
+        for report_id, day in (('r1', 1), ('r2', 3)):
+            report = self._report('fred' if report_id == 'r2' else 'sally',
+                                  report_id)
+            report['updated'] = datetime.datetime(2014, 9, day,
+                                                  tzinfo=_UTC())
+        directory, manifest = self._backup('incremental', since=since,
+                                           receipts=False)
+        self.assertEqual(manifest['counts'],
+                         {'employee': 2, 'report': 1, 'item': 1})
+
+    def test_restore_prunes_and_unindexes(self):
+        from . import create_report
+        self._seed()
+        directory, _ = self._backup(receipts=False)
+        index = self._index()
+        create_report('sally', 'r3', self._rows('99.00'), 'Later')
+        self.assertNotEqual(self._index(), index)
+        counts = self._restore(directory, prune=True, receipts=False)
+        self.assertEqual(counts['pruned'], 1)
+        self.assertTrue(self._report('sally', 'r3') is None)
+        self.assertEqual(self._index(), index)
+        self.assertEqual(self._queue(), [('sally', 'r1', '12.50')])
+
+    def test_restore_report_reindexes(self):
+        from . import FINGERPRINT_KIND
+        from . import SEARCH_TERM_KIND
+        from . import _restore_report
+        self._seed()
+        report = dict(self._report('sally', 'r1'))
+        report['status'] = 'rejected'
+        report['reason'] = 'No receipts'
+        item = dict(self.store.entities[_Key(
+            'Employee', 'sally', 'Expense Report', 'r1', 'Expense Item', 1)])
+        item['Vendor'] = 'Acme Hotel'
+        _restore_report('sally', 'r1', report,
+                        [{'id': 1, 'properties': item}])
+        self.assertEqual(self.store.items('Expense Item'),
+                         [('Employee', 'fred', 'Expense Report', 'r2',
+                           'Expense Item', 1),
+                          ('Employee', 'sally', 'Expense Report', 'r1',
+                           'Expense Item', 1)])
+        terms = [x[-1] for x in self._keys(SEARCH_TERM_KIND)
+                 if x[3] == 'r1']
+        self.assertTrue('acme' in terms)
+        self.assertFalse('yellow' in terms)
+        fingerprints = [x[-1] for x in self._keys(FINGERPRINT_KIND)
+                        if x[3] == 'r1']
+        self.assertEqual(len(fingerprints), 1)
+        self.assertTrue('acme hotel' in fingerprints[0])
+        self.assertEqual(self._queue(), [])
+
+
+class VerifyReceiptsTests(unittest.TestCase):
+
+    def setUp(self):
+        import gcloud_expenses
+        self.blobs = {}
+        self.clients = []
+        def _new_client():
+            # Each worker's bucket serves the same objects.
+            self.clients.append(_Client(_Bucket(self.blobs)))
+            return self.clients[-1]
+        self._new_client = gcloud_expenses.new_client
+        gcloud_expenses.new_client = _new_client
+
+    def tearDown(self):
+        import gcloud_expenses
+        gcloud_expenses.new_client = self._new_client
+
+    @unittest.skipUnless(_has_gcloud(), 'gcloud not installed')
+    @unittest.skipUnless(hasattr(urllib, 'unquote'), 'Python 2 only')
+    def test_downloads_over_worker_clients(self):
+        import base64
+        import hashlib
+        from . import verify_receipts
+        listed = _Bucket()
+        for x in range(6):
+            name, data = 'sally/r1/receipt%d.jpg' % x, b'JPEG' * x
+            self.blobs[name] = listed.blobs[name] = data
+            listed.properties[name] = {'md5Hash': base64.b64encode(
+                hashlib.md5(data).digest()).decode('ascii')}
+        results = verify_receipts('sally', 'r1', bucket=listed, workers=4)
+        self.assertEqual(sorted(results),
+                         [('receipt%d.jpg' % x, 1, None) for x in range(6)])
+        self.assertEqual(listed.downloads, [])
+        self.assertTrue(1 <= len(self.clients) <= 4)
+        self.assertEqual(sorted(sum([x.bucket.downloads
+                                     for x in self.clients], [])),
+                         sorted(self.blobs))
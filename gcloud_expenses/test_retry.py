@@ -0,0 +1,181 @@
+import unittest
+
+
+class RetryPolicyTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .retry import RetryPolicy
+        return RetryPolicy
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_delay_bounded_by_backoff(self):
+        policy = self._makeOne(initial_delay=0.1, max_delay=1.0,
+                               multiplier=2.0)
+        for _ in range(100):
+            self.assertTrue(0 <= policy.delay(1) <= 0.1)
+            self.assertTrue(0 <= policy.delay(3) <= 0.4)
+            self.assertTrue(0 <= policy.delay(10) <= 1.0)
+
+
+class AttemptTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .retry import Attempt
+        return Attempt
+
+    def _makeOne(self, token=None, maybe_committed=False):
+        return self._getTargetClass()(token, maybe_committed)
+
+    def test_tokens_unique(self):
+        self.assertNotEqual(self._makeOne().token, self._makeOne().token)
+
+    def test_already_applied(self):
+        attempt = self._makeOne()
+        entity = {}
+        attempt.mark(entity)
+        self.assertFalse(attempt.already_applied(entity))
+        attempt.maybe_committed = True
+        self.assertTrue(attempt.already_applied(entity))
+        self.assertFalse(attempt.already_applied({}))
+
+    def test_replayed_token(self):
+        attempt = self._makeOne('abc', True)
+        self.assertEqual(attempt.token, 'abc')
+        entity = {}
+        attempt.mark(entity)
+        self.assertTrue(attempt.already_applied(entity))
+        self.assertFalse(self._makeOne('def', True).already_applied(entity))
+
+    def test_token_never_sent(self):
+        attempt = self._makeOne('abc')
+        self.assertFalse(attempt.maybe_committed)
+        entity = {}
+        attempt.mark(entity)
+        self.assertFalse(attempt.already_applied(entity))
+
+
+class ContentionStatsTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .retry import ContentionStats
+        return ContentionStats
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_record_and_snapshot(self):
+        stats = self._makeOne()
+        stats.record('op', 0, 0, 0.0, False, 'a')
+        stats.record('op', 2, 2, 0.5, True, 'b')
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['op'], {
+            'calls': 2,
+            'conflicts': 2,
+            'retries': 2,
+            'gave_up': 1,
+            'retry_time': 0.5,
+            })
+        self.assertEqual(stats.hot_spots(), [(('op', 'b'), 2)])
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+
+class Test_call_with_retries(unittest.TestCase):
+
+    def _callFUT(self, func, policy=None, stats=None, **kw):
+        from .retry import RetryPolicy
+        from .retry import call_with_retries
+        if policy is None:
+            policy = RetryPolicy(max_attempts=3)
+        if stats is None:
+            stats = self._makeStats()
+        kw.setdefault('sleep', self._sleep)
+        return call_with_retries('op', func, policy, stats,
+                                 (_Conflict, _Unavailable), (_Conflict,),
+                                 key='k', **kw)
+
+    def _makeStats(self):
+        from .retry import ContentionStats
+        return ContentionStats()
+
+    def setUp(self):
+        self._slept = []
+
+    def _sleep(self, delay):
+        self._slept.append(delay)
+
+    def test_success_first_time(self):
+        stats = self._makeStats()
+        self.assertEqual(self._callFUT(lambda attempt: 42, stats=stats), 42)
+        self.assertEqual(self._slept, [])
+        self.assertEqual(stats.snapshot()['op']['retries'], 0)
+
+    def test_retries_conflict(self):
+        stats = self._makeStats()
+        def _func(attempt):
+            if attempt.number < 3:
+                raise _Conflict()
+            self.assertFalse(attempt.maybe_committed)
+            return attempt.number
+        self.assertEqual(self._callFUT(_func, stats=stats), 3)
+        self.assertEqual(len(self._slept), 2)
+        snapshot = stats.snapshot()['op']
+        self.assertEqual(snapshot['conflicts'], 2)
+        self.assertEqual(snapshot['retries'], 2)
+        self.assertEqual(stats.hot_spots(), [(('op', 'k'), 2)])
+
+    def test_ambiguous_commit(self):
+        def _func(attempt):
+            if attempt.number == 1:
+                attempt.result = 'first'
+                attempt.committing = True
+                raise _Unavailable()
+            return (attempt.maybe_committed, attempt.committed_result)
+        self.assertEqual(self._callFUT(_func), (True, 'first'))
+
+    def test_error_before_commit_not_ambiguous(self):
+        def _func(attempt):
+            if attempt.number == 1:
+                raise _Unavailable()
+            return attempt.maybe_committed
+        self.assertFalse(self._callFUT(_func))
+
+    def test_other_errors_propagate(self):
+        def _func(attempt):
+            raise KeyError()
+        self.assertRaises(KeyError, self._callFUT, _func)
+        self.assertEqual(self._slept, [])
+
+    def test_gives_up_after_max_attempts(self):
+        from .retry import RetriesExhausted
+        stats = self._makeStats()
+        def _func(attempt):
+            raise _Conflict()
+        self.assertRaises(RetriesExhausted, self._callFUT, _func, stats=stats)
+        self.assertEqual(len(self._slept), 2)
+        self.assertEqual(stats.snapshot()['op']['gave_up'], 1)
+
+    def test_gives_up_after_budget(self):
+        from .retry import RetriesExhausted
+        from .retry import RetryPolicy
+        times = iter([0.0, 1.0, 2.0, 3.0])
+        def _func(attempt):
+            raise _Conflict()
+        try:
+            self._callFUT(_func, RetryPolicy(max_attempts=10, budget=0.5),
+                          clock=lambda: next(times))
+        except RetriesExhausted as e:
+            self.assertEqual(e.attempts, 1)
+            self.assertTrue(isinstance(e.last_error, _Conflict))
+        else:
+            self.fail('RetriesExhausted not raised')
+
+
+class _Conflict(Exception):
+    pass
+
+
+class _Unavailable(Exception):
+    pass
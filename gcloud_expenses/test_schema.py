@@ -0,0 +1,107 @@
+import unittest
+
+
+class Test_parse_rows(unittest.TestCase):
+
+    _HEADER = ['Date', 'Vendor', 'Type', 'Quantity', 'Price', 'Memo']
+
+    def _callFUT(self, rows, *args):
+        from .schema import parse_rows
+        return parse_rows(rows, *args)
+
+    def test_typed_values(self):
+        import datetime
+        import decimal
+        rows = [self._HEADER,
+                ['2014-08-26', 'United Airlines', 'Travel', '1', '425.00',
+                 'Airfare'],
+                ['2014-08-27', 'Yellow Cab', 'Travel', '2.0', '$1,032.5',
+                 ''],
+                ]
+        first, second = self._callFUT(rows)
+        self.assertEqual(first['Date'], datetime.date(2014, 8, 26))
+        self.assertEqual(first['Quantity'], 1)
+        self.assertEqual(first['Price'], decimal.Decimal('425.00'))
+        self.assertEqual(first['Vendor'], 'United Airlines')
+        self.assertEqual(second['Quantity'], 2)
+        self.assertEqual(second['Price'], decimal.Decimal('1032.50'))
+        self.assertEqual(second['Memo'], '')
+
+    def test_defaults_and_extra_columns(self):
+        rows = [['Date', 'Vendor', 'Price', 'Project'],
+                ['2014-08-26', 'Marriott', '99', 'ACME'],
+                ['', '', '', ''],
+                ]
+        item, = self._callFUT(rows)
+        self.assertEqual(item['Quantity'], 1)
+        self.assertEqual(item['Type'], '')
+        self.assertEqual(item['Project'], 'ACME')
+
+    def test_all_errors_with_line_numbers(self):
+        from .schema import InvalidRows
+        rows = [self._HEADER,
+                ['2014-08-26', 'Hertz', 'Travel', '1', '10', ''],
+                ['08/27/2014', '', 'Travel', '1.5', 'abc', ''],
+                ]
+        try:
+            self._callFUT(rows)
+        except InvalidRows as e:
+            self.assertEqual([x[:2] for x in e.errors],
+                             [(3, 'Date'), (3, 'Vendor'), (3, 'Quantity'),
+                              (3, 'Price')])
+            self.assertTrue(str(e).startswith('Line 3: Date: '))
+        else:
+            self.fail('InvalidRows not raised')
+
+    def test_missing_columns(self):
+        from .schema import InvalidRows
+        self.assertRaises(InvalidRows, self._callFUT, [['Date', 'Memo']])
+        self.assertRaises(InvalidRows, self._callFUT, [])
+
+
+class Test_parse_csv(unittest.TestCase):
+
+    def test_it(self):
+        from io import StringIO
+        from .schema import parse_csv
+        f = StringIO(u'"Date","Vendor","Price"\n'
+                     u'"2014-08-26","Hertz, Inc.",10\n')
+        item, = parse_csv(f)
+        self.assertEqual(item['Vendor'], 'Hertz, Inc.')
+
+
+class Test_to_datastore(unittest.TestCase):
+
+    def _callFUT(self, value):
+        from .schema import to_datastore
+        return to_datastore(value)
+
+    def test_it(self):
+        import datetime
+        import decimal
+        self.assertEqual(self._callFUT(decimal.Decimal('1.25')), 1.25)
+        self.assertEqual(self._callFUT(datetime.date(2014, 8, 26)),
+                         datetime.datetime(2014, 8, 26))
+        now = datetime.datetime.utcnow()
+        self.assertTrue(self._callFUT(now) is now)
+        self.assertEqual(self._callFUT('text'), 'text')
+
+
+class Test_from_datastore(unittest.TestCase):
+
+    def _callFUT(self, item):
+        from .schema import from_datastore
+        return from_datastore(item)
+
+    def test_typed(self):
+        import datetime
+        import decimal
+        info = self._callFUT({'Date': datetime.datetime(2014, 8, 26),
+                              'Price': 0.1, 'Quantity': 3})
+        self.assertEqual(info, {'Date': '2014-08-26',
+                                'Price': decimal.Decimal('0.10'),
+                                'Quantity': 3})
+
+    def test_legacy_strings(self):
+        item = {'Date': '2014-08-26', 'Price': '425.00'}
+        self.assertEqual(self._callFUT(item), item)
@@ -0,0 +1,64 @@
+import unittest
+
+
+class Test_tokenize(unittest.TestCase):
+
+    def _callFUT(self, text):
+        from .search import tokenize
+        return tokenize(text)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT(u'Marriott, SFO -- Marriott a 2x'),
+                         [u'marriott', u'sfo', u'2x'])
+        self.assertEqual(self._callFUT(None), [])
+        self.assertEqual(self._callFUT(''), [])
+
+
+class Test_build_postings(unittest.TestCase):
+
+    def _callFUT(self, rows):
+        from .search import build_postings
+        return build_postings(rows)
+
+    def test_it(self):
+        rows = [{'Vendor': 'Marriott', 'Memo': 'Hotel, SFO'},
+                {'Vendor': 'Yellow Cab', 'Memo': 'Taxi to Marriott'},
+                {'Vendor': 'Yellow Cab'},
+                ]
+        postings = self._callFUT(rows)
+        self.assertEqual(postings['marriott'],
+                         {'vendor_items': [1], 'memo_items': [2]})
+        self.assertEqual(postings['cab'], {'vendor_items': [2, 3]})
+        self.assertEqual(postings['sfo'], {'memo_items': [1]})
+
+
+class HitsTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .search import Hits
+        return Hits
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_ranking(self):
+        hits = self._makeOne()
+        hits.add('sally', 'r1', {'term': 'marriott',
+                                 'vendor_items': [1], 'memo_items': [2]})
+        hits.add('fred', 'r2', {'term': 'marriott', 'memo_items': [4, 5]})
+        hits.add('fred', 'r2', {'term': 'sfo', 'memo_items': [5]})
+        self.assertEqual(hits.items(), [
+            ('fred', 'r2', 5, 2, 2),
+            ('sally', 'r1', 1, 1, 2),
+            ('fred', 'r2', 4, 1, 1),
+            ('sally', 'r1', 2, 1, 1),
+            ])
+        self.assertEqual(hits.reports(), [
+            ('fred', 'r2', 2, 2, 2),
+            ('sally', 'r1', 1, 2, 2),
+            ])
+
+    def test_empty(self):
+        hits = self._makeOne()
+        self.assertEqual(hits.items(), [])
+        self.assertEqual(hits.reports(), [])
@@ -0,0 +1,411 @@
+import unittest
+
+
+class _TraceIsolation(object):
+
+    def setUp(self):
+        from .tracing import activate
+        from .tracing import activate_globally
+        activate(None)
+        activate_globally(None)
+
+    tearDown = setUp
+
+
+class TraceTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .tracing import Trace
+        return Trace
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_record_and_summary(self):
+        trace = self._makeOne()
+        trace.record('datastore.get', 0.5)
+        trace.record('datastore.get', 0.25)
+        trace.record('render', 0.125)
+        self.assertEqual(trace.summary(), {
+            'datastore.get': {'count': 2, 'seconds': 0.75},
+            'render': {'count': 1, 'seconds': 0.125},
+            })
+
+    def test_count(self):
+        trace = self._makeOne()
+        trace.count('rows')
+        trace.count('rows', 4)
+        self.assertEqual(trace.counters, {'rows': 5})
+
+    def test_elapsed(self):
+        now = [100.0]
+        trace = self._makeOne(clock=lambda: now[0])
+        now[0] += 2.5
+        self.assertEqual(trace.elapsed, 2.5)
+
+
+class Test_traced(_TraceIsolation, unittest.TestCase):
+
+    def test_wo_active_trace(self):
+        from .tracing import traced
+        with traced('datastore.get'):
+            pass
+
+    def test_w_active_trace(self):
+        from .tracing import Trace
+        from .tracing import activate
+        from .tracing import traced
+        trace = Trace()
+        activate(trace)
+        with traced('datastore.get'):
+            pass
+        with traced('datastore.get'):
+            pass
+        self.assertEqual(trace.summary()['datastore.get']['count'], 2)
+
+    def test_w_global_trace(self):
+        import threading
+        from .tracing import Trace
+        from .tracing import activate_globally
+        from .tracing import traced
+        trace = Trace()
+        activate_globally(trace)
+        def _other():
+            with traced('storage.upload'):
+                pass
+        thread = threading.Thread(target=_other)
+        thread.start()
+        thread.join()
+        self.assertEqual(trace.summary()['storage.upload']['count'], 1)
+
+    def test_records_on_error(self):
+        from .tracing import Trace
+        from .tracing import activate
+        from .tracing import traced
+        trace = Trace()
+        activate(trace)
+        def _fail():
+            with traced('datastore.put'):
+                raise ValueError()
+        self.assertRaises(ValueError, _fail)
+        self.assertEqual(trace.summary()['datastore.put']['count'], 1)
+
+
+class Test_traced_function(_TraceIsolation, unittest.TestCase):
+
+    def test_function(self):
+        from .tracing import Trace
+        from .tracing import activate
+        from .tracing import traced_function
+        trace = Trace()
+        activate(trace)
+        @traced_function('storage.upload')
+        def upload(x):
+            return x * 2
+        self.assertEqual(upload(3), 6)
+        self.assertEqual(upload.__name__, 'upload')
+        self.assertEqual(trace.summary()['storage.upload']['count'], 1)
+
+    def test_generator_counted_once_when_exhausted(self):
+        from .tracing import Trace
+        from .tracing import activate
+        from .tracing import traced_function
+        trace = Trace()
+        activate(trace)
+        @traced_function('storage.list')
+        def listing():
+            yield 'a'
+            yield 'b'
+        found = listing()
+        self.assertFalse('storage.list' in trace.summary())
+        self.assertEqual(list(found), ['a', 'b'])
+        self.assertEqual(trace.summary()['storage.list']['count'], 1)
+
+
+class TracedNamespaceTests(_TraceIsolation, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .tracing import TracedNamespace
+        return TracedNamespace
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_traced_and_passthrough(self):
+        from .tracing import Trace
+        from .tracing import activate
+        class _Module(object):
+            def get(self, keys):
+                return ['found']
+            def set_defaults(self):
+                return 'defaults'
+        module = _Module()
+        proxy = self._makeOne(module, {'get': 'datastore.get'})
+        trace = Trace()
+        activate(trace)
+        self.assertEqual(proxy.get(['key']), ['found'])
+        self.assertEqual(proxy.set_defaults(), 'defaults')
+        self.assertEqual(list(trace.summary()), ['datastore.get'])
+
+    def test_looks_up_function_per_call(self):
+        class _Module(object):
+            def get(self, keys):
+                return ['before']
+        module = _Module()
+        proxy = self._makeOne(module, {'get': 'datastore.get'})
+        module.get = lambda keys: ['after']
+        self.assertEqual(proxy.get([]), ['after'])
+
+
+class Test_traced_query_class(_TraceIsolation, unittest.TestCase):
+
+    def _callFUT(self, query_class):
+        from .tracing import traced_query_class
+        return traced_query_class(query_class)
+
+    def test_fetch_traced(self):
+        from .tracing import Trace
+        from .tracing import activate
+        class Query(object):
+            def __init__(self, kind):
+                self.kind = kind
+            def fetch(self, limit=None):
+                return iter([1, 2, 3][:limit])
+        klass = self._callFUT(Query)
+        self.assertEqual(klass.__name__, 'Query')
+        trace = Trace()
+        activate(trace)
+        self.assertEqual(list(klass('Employee').fetch(2)), [1, 2])
+        self.assertEqual(trace.summary()['datastore.query']['count'], 1)
+
+
+class Test_traced_renderer_factory(_TraceIsolation, unittest.TestCase):
+
+    def _callFUT(self, factory):
+        from .tracing import traced_renderer_factory
+        return traced_renderer_factory(factory)
+
+    def test_render_traced_attributes_kept(self):
+        from .tracing import Trace
+        from .tracing import activate
+        class _Renderer(object):
+            def __init__(self, info):
+                self.info = info
+            def __call__(self, value, system):
+                return '<p>%s</p>' % value
+            def implementation(self):
+                return 'template'
+        renderer = self._callFUT(_Renderer)('main.pt')
+        trace = Trace()
+        activate(trace)
+        self.assertEqual(renderer('OK', {}), '<p>OK</p>')
+        self.assertEqual(trace.summary()['render']['count'], 1)
+        # E.g. 'request.main_template', used as a macro.
+        self.assertEqual(renderer.implementation(), 'template')
+        self.assertEqual(renderer.info, 'main.pt')
+
+
+class Test_server_timing(unittest.TestCase):
+
+    def _callFUT(self, trace):
+        from .tracing import server_timing
+        return server_timing(trace)
+
+    def test_it(self):
+        from .tracing import Trace
+        now = [0.0]
+        trace = Trace(clock=lambda: now[0])
+        trace.record('datastore.get', 0.0125)
+        trace.record('datastore.get', 0.0125)
+        now[0] = 0.5
+        self.assertEqual(self._callFUT(trace),
+                         'datastore-get;dur=25.0;desc="2 calls", '
+                         'total;dur=500.0')
+
+
+class Test_tracing_tween_factory(_TraceIsolation, unittest.TestCase):
+
+    def _callFUT(self, handler, settings=None):
+        from .tracing import tracing_tween_factory
+        class _Registry(object):
+            pass
+        registry = _Registry()
+        registry.settings = settings or {}
+        return tracing_tween_factory(handler, registry)
+
+    def _makeRequest(self):
+        from pyramid.testing import DummyRequest
+        return DummyRequest(path='/employees/')
+
+    def _handler(self, request):
+        from pyramid.response import Response
+        from .tracing import traced
+        with traced('datastore.query'):
+            pass
+        return Response('OK')
+
+    def test_adds_header_and_deactivates(self):
+        from .tracing import current
+        tween = self._callFUT(self._handler)
+        response = tween(self._makeRequest())
+        self.assertTrue(response.headers['Server-Timing'].startswith(
+            'datastore-query;dur='))
+        self.assertTrue(current() is None)
+
+    def test_header_disabled(self):
+        tween = self._callFUT(self._handler,
+                              {'gcloud_expenses.server_timing': 'false'})
+        response = tween(self._makeRequest())
+        self.assertFalse('Server-Timing' in response.headers)
+
+    def test_logs_structured_line(self):
+        import json
+        import logging
+        from .tracing import logger
+        records = []
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = _Handler()
+        logger.addHandler(handler)
+        old_level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            tween = self._callFUT(self._handler)
+            tween(self._makeRequest())
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+        logged = json.loads(records[0].getMessage())
+        self.assertEqual(logged['path'], '/employees/')
+        self.assertEqual(logged['status'], 200)
+        self.assertEqual(logged['calls']['datastore.query']['count'], 1)
+
+    def test_streamed_body_traced_until_closed(self):
+        import json
+        import logging
+        from pyramid.response import Response
+        from .tracing import current
+        from .tracing import logger
+        from .tracing import traced
+        active = []
+        def _body():
+            for i in range(2):
+                active.append(current() is not None)
+                with traced('datastore.query'):
+                    pass
+                yield b'row'
+        def _handler(request):
+            return Response(app_iter=_body())
+        records = []
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = _Handler()
+        logger.addHandler(handler)
+        old_level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            tween = self._callFUT(_handler)
+            response = tween(self._makeRequest())
+            self.assertEqual(records, [])
+            self.assertEqual(list(response.app_iter), [b'row', b'row'])
+            self.assertTrue(current() is None)
+            response.app_iter.close()
+            response.app_iter.close()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+        self.assertEqual(active, [True, True])
+        self.assertEqual(len(records), 1)
+        logged = json.loads(records[0].getMessage())
+        self.assertEqual(logged['calls']['datastore.query']['count'], 2)
+
+    def _logged(self, tween, request):
+        # Call the tween;  return ``(records logged, exception raised)``.
+        import json
+        import logging
+        from .tracing import logger
+        records = []
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = _Handler()
+        logger.addHandler(handler)
+        old_level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            tween(request)
+        except Exception as e:
+            raised = e
+        else:
+            raised = None
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+        return [json.loads(x.getMessage()) for x in records
+                if x.levelno == logging.INFO], raised
+
+    def test_logs_failed_request(self):
+        from .tracing import current
+        from .tracing import traced
+        def _handler(request):
+            with traced('datastore.get'):
+                pass
+            raise RuntimeError('boom')
+        logged, raised = self._logged(self._callFUT(_handler),
+                                      self._makeRequest())
+        self.assertTrue(isinstance(raised, RuntimeError))
+        self.assertTrue(current() is None)
+        (logged,) = logged
+        self.assertEqual(logged['status'], 500)
+        self.assertEqual(logged['error'], 'RuntimeError')
+        self.assertEqual(logged['calls']['datastore.get']['count'], 1)
+
+    def test_logs_http_exception(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        def _handler(request):
+            raise HTTPNotFound()
+        logged, raised = self._logged(self._callFUT(_handler),
+                                      self._makeRequest())
+        self.assertTrue(isinstance(raised, HTTPNotFound))
+        self.assertTrue('Server-Timing' in raised.headers)
+        self.assertEqual([(x['status'], x['error']) for x in logged],
+                         [(404, 'HTTPNotFound')])
+
+    def test_failed_slow_request_profiled(self):
+        import os
+        import shutil
+        import tempfile
+        def _handler(request):
+            raise RuntimeError('boom')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tween = self._callFUT(_handler, {
+                'gcloud_expenses.slow_request_threshold': '0.000001',
+                'gcloud_expenses.profile_sample_rate': '1',
+                'gcloud_expenses.profile_dir': tmpdir,
+                })
+            self.assertRaises(RuntimeError, tween, self._makeRequest())
+            found = os.listdir(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(found), 1)
+
+    def test_slow_request_profiled(self):
+        import os
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tween = self._callFUT(self._handler, {
+                'gcloud_expenses.slow_request_threshold': '0.000001',
+                'gcloud_expenses.profile_sample_rate': '1',
+                'gcloud_expenses.profile_dir': tmpdir,
+                })
+            tween(self._makeRequest())
+            found = os.listdir(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(found), 1)
+        self.assertTrue(found[0].endswith('.prof'))
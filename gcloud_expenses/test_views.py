@@ -16,3 +16,265 @@ class ViewTests(unittest.TestCase):
         request = testing.DummyRequest()
         info = home_page(request)
         self.assertEqual(info, {})
+
+
+class Test_show_review_queue(unittest.TestCase):
+
+    def setUp(self):
+        from . import views
+        self._saved = views.next_reports_to_review
+        self.limits = []
+        def _next_reports_to_review(limit, connection=None):
+            self.limits.append(limit)
+            return iter([])
+        views.next_reports_to_review = _next_reports_to_review
+
+    def tearDown(self):
+        from . import views
+        views.next_reports_to_review = self._saved
+
+    def _callFUT(self, **params):
+        from pyramid import testing
+        from .views import show_review_queue
+        request = testing.DummyRequest(params=params)
+        request.datastore_connection = None
+        return show_review_queue(request)
+
+    def test_limit_clamped(self):
+        from .views import MAX_REVIEW_QUEUE_LIMIT
+        from .views import REVIEW_QUEUE_LIMIT
+        self.assertEqual(self._callFUT(), {'reports': []})
+        self._callFUT(limit='10')
+        self._callFUT(limit='1000000')
+        self._callFUT(limit='-5')
+        self._callFUT(limit='abc')
+        self.assertEqual(self.limits, [REVIEW_QUEUE_LIMIT, 10,
+                                       MAX_REVIEW_QUEUE_LIMIT, 0,
+                                       REVIEW_QUEUE_LIMIT])
+
+
+class Test_conditional_response(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid import testing
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        from pyramid import testing
+        testing.tearDown()
+
+    def _callFUT(self, request, etag='abc', last_modified=None,
+                 cache_control='private, no-cache'):
+        from .views import conditional_response
+        return conditional_response(request, etag, last_modified,
+                                    cache_control)
+
+    def _makeRequest(self, **headers):
+        from pyramid.request import Request
+        request = Request.blank('/', headers=headers)
+        request.registry = self.config.registry
+        return request
+
+    def _makeWhen(self):
+        import datetime
+        return datetime.datetime(2014, 9, 4, 17, 32, 10, 123456)
+
+    def test_no_validators_in_request(self):
+        request = self._makeRequest()
+        self.assertTrue(self._callFUT(request, last_modified=self._makeWhen())
+                        is None)
+        response = request.response
+        self.assertEqual(response.etag, 'abc')
+        self.assertEqual(response.headers['Cache-Control'],
+                         'private, no-cache')
+        self.assertEqual(response.headers['Last-Modified'],
+                         'Thu, 04 Sep 2014 17:32:10 GMT')
+
+    def test_if_none_match_hit(self):
+        request = self._makeRequest(**{'If-None-Match': '"abc"'})
+        response = self._callFUT(request)
+        self.assertTrue(response is request.response)
+        self.assertEqual(response.status_int, 304)
+
+    def test_if_none_match_miss_ignores_if_modified_since(self):
+        request = self._makeRequest(**{
+            'If-None-Match': '"def"',
+            'If-Modified-Since': 'Thu, 04 Sep 2014 17:32:10 GMT',
+            })
+        self.assertTrue(self._callFUT(request, last_modified=self._makeWhen())
+                        is None)
+
+    def test_if_modified_since_not_modified(self):
+        request = self._makeRequest(**{
+            'If-Modified-Since': 'Thu, 04 Sep 2014 17:32:10 GMT'})
+        response = self._callFUT(request, last_modified=self._makeWhen())
+        self.assertEqual(response.status_int, 304)
+
+    def test_if_modified_since_modified(self):
+        request = self._makeRequest(**{
+            'If-Modified-Since': 'Thu, 04 Sep 2014 17:32:09 GMT'})
+        self.assertTrue(self._callFUT(request, last_modified=self._makeWhen())
+                        is None)
+
+
+class Test_compute_etag(unittest.TestCase):
+
+    def _callFUT(self, *parts):
+        from .views import compute_etag
+        return compute_etag(*parts)
+
+    def test_stable_and_distinct(self):
+        self.assertEqual(self._callFUT('a', 1), self._callFUT('a', 1))
+        self.assertNotEqual(self._callFUT('a', 1), self._callFUT('a', 2))
+
+    def test_includes_page_version(self):
+        from . import views
+        before = self._callFUT('a', 1)
+        saved, views.page_version = views.page_version, 'deployed'
+        try:
+            self.assertNotEqual(self._callFUT('a', 1), before)
+        finally:
+            views.page_version = saved
+
+
+class Test_source_version(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _callFUT(self, paths):
+        from .views import source_version
+        return source_version(paths)
+
+    def _write(self, name, text):
+        import os
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_changes_with_contents(self):
+        path = self._write('main.pt', '<html/>')
+        first = self._callFUT([self.tmpdir])
+        self.assertEqual(self._callFUT([self.tmpdir]), first)
+        self._write('main.pt', '<html></html>')
+        self.assertNotEqual(self._callFUT([self.tmpdir]), first)
+        self.assertNotEqual(self._callFUT([path]), first)
+
+    def test_default(self):
+        from .views import page_version
+        from .views import source_version
+        self.assertEqual(source_version(), page_version)
+
+
+class Test_render_fragment(unittest.TestCase):
+
+    def setUp(self):
+        from .views import fragments
+        fragments.clear()
+
+    def tearDown(self):
+        from .views import fragments
+        fragments.clear()
+
+    def _callFUT(self, *args):
+        from .views import render_fragment
+        return render_fragment(*args)
+
+    def test_renders_once_per_key(self):
+        calls = []
+        def _factory():
+            calls.append(1)
+            return '<table></table>'
+        first = self._callFUT(('report-items', 'sally', 1), _factory)
+        second = self._callFUT(('report-items', 'sally', 1), _factory)
+        self.assertEqual(first, second)
+        self.assertEqual(len(calls), 1)
+        self._callFUT(('report-items', 'sally', 2), _factory)
+        self.assertEqual(len(calls), 2)
+
+
+class Test_stream_report_page(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid import testing
+        from .views import fragments
+        self.config = testing.setUp()
+        self.config.include('pyramid_chameleon')
+        self.config.include('gcloud_expenses.views')
+        self.config.include('gcloud_expenses.assets')
+        fragments.clear()
+
+    def tearDown(self):
+        from pyramid import testing
+        from .views import fragments
+        fragments.clear()
+        testing.tearDown()
+
+    def _callFUT(self, *args):
+        from .views import stream_report_page
+        return stream_report_page(*args)
+
+    def _makeRequest(self):
+        from pyramid.request import Request
+        from pyramid.request import apply_request_extensions
+        self.config.commit()
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        apply_request_extensions(request)
+        return request
+
+    def _makeReport(self):
+        return {'employee_id': 'sally',
+                'report_id': 'expenses-20140901',
+                'created': '2014-09-04',
+                'updated': '2014-09-04',
+                'status': 'pending',
+               }
+
+    def _makeItems(self, count):
+        for i in range(count):
+            yield {'Date': '2014-08-26',
+                   'Vendor': 'Vendor #%d' % i,
+                   'Type': 'Travel',
+                   'Quantity': '1',
+                   'Price': '32.00',
+                   'Memo': '<memo>',
+                  }
+
+    def test_streams_rows_in_chunks(self):
+        from . import views
+        from .views import fragments
+        request = self._makeRequest()
+        views.stream_chunk_size, saved = 2, views.stream_chunk_size
+        try:
+            response = self._callFUT(request, self._makeReport(),
+                                     self._makeItems(5), 'key')
+            chunks = list(response.app_iter)
+        finally:
+            views.stream_chunk_size = saved
+        self.assertEqual(len(chunks), 5)  # head, 3 x rows, tail
+        body = b''.join(chunks).decode('utf-8')
+        self.assertTrue(body.index('sally') < body.index('Vendor #0'))
+        self.assertTrue(body.index('Vendor #4') < body.index('</html>'))
+        self.assertTrue('&lt;memo&gt;' in body)
+        self.assertFalse('<!-- report' in body)
+        self.assertTrue('Vendor #4' in fragments.get('key'))
+
+    def test_large_table_not_cached(self):
+        from .views import fragments
+        request = self._makeRequest()
+        fragments.max_size = 1000
+        try:
+            response = self._callFUT(request, self._makeReport(),
+                                     self._makeItems(100), 'key')
+            list(response.app_iter)
+        finally:
+            from .views import FRAGMENT_CACHE_SIZE
+            fragments.max_size = FRAGMENT_CACHE_SIZE
+        self.assertTrue(fragments.get('key') is None)
@@ -0,0 +1,365 @@
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_global = []
+
+
+class Trace(object):
+    """Count and time backend calls, by category.
+
+    Categories are dotted names, e.g. ``datastore.get`` or ``render``.
+    """
+    def __init__(self, clock=time.time):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self.started = clock()
+        self.calls = {}  # category -> [count, seconds]
+        self.counters = {}  # name -> amount, e.g. rows or bytes processed
+
+    def record(self, category, seconds, count=1):
+        with self._lock:
+            found = self.calls.setdefault(category, [0, 0.0])
+            found[0] += count
+            found[1] += seconds
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @property
+    def elapsed(self):
+        return self._clock() - self.started
+
+    def summary(self):
+        """Return a mapping category -> {'count': ..., 'seconds': ...}.
+        """
+        with self._lock:
+            return dict([(category, {'count': count, 'seconds': seconds})
+                         for category, (count, seconds)
+                         in self.calls.items()])
+
+
+def current():
+    """Return the trace active for this thread (or process), if any.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None and _global:
+        trace = _global[-1]
+    return trace
+
+
+def count(name, amount=1):
+    """Add ``amount`` to counter ``name`` of the active trace, if any.
+    """
+    trace = current()
+    if trace is not None:
+        trace.count(name, amount)
+
+
+def activate(trace):
+    """Make ``trace`` the active trace for the calling thread.
+
+    Pass None to deactivate.
+    """
+    _local.trace = trace
+
+
+def activate_globally(trace):
+    """Make ``trace`` active for all threads without their own trace.
+
+    Pass None to deactivate.
+    """
+    del _global[:]
+    if trace is not None:
+        _global.append(trace)
+
+
+class traced(object):
+    """Context manager:  record the time spent in a block under ``category``.
+    """
+    def __init__(self, category):
+        self.category = category
+
+    def __enter__(self):
+        self.trace = current()
+        if self.trace is not None:
+            self.started = time.time()
+        return self
+
+    def __exit__(self, etype, err, tb):
+        if self.trace is not None:
+            self.trace.record(self.category, time.time() - self.started)
+
+
+def traced_iter(category, iterable):
+    """Yield from ``iterable``, recording the time spent fetching each item.
+
+    Counts one call per iteration, not per item.
+    """
+    trace = current()
+    if trace is None:
+        for x in iterable:
+            yield x
+        return
+    iterator = iter(iterable)
+    seconds = 0.0
+    try:
+        while True:
+            started = time.time()
+            try:
+                x = next(iterator)
+            except StopIteration:
+                seconds += time.time() - started
+                break
+            seconds += time.time() - started
+            yield x
+    finally:
+        trace.record(category, seconds)
+
+
+def traced_function(category):
+    """Decorator:  record calls to the decorated function under ``category``.
+
+    Generator functions are timed while being iterated.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kw):
+                return traced_iter(category, func(*args, **kw))
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kw):
+                with traced(category):
+                    return func(*args, **kw)
+        return wrapper
+    return decorator
+
+
+class TracedNamespace(object):
+    """Proxy a module, tracing calls to selected functions.
+
+    ``functions`` maps attribute names to trace categories;  other
+    attributes are passed through unchanged.
+    """
+    def __init__(self, module, functions):
+        self._module = module
+        for name, category in functions.items():
+            setattr(self, name, self._traced(name, category))
+
+    def _traced(self, name, category):
+        # Look the function up per call, so that patching the module works.
+        def wrapper(*args, **kw):
+            with traced(category):
+                return getattr(self._module, name)(*args, **kw)
+        wrapper.__name__ = name
+        return wrapper
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def traced_query_class(query_class, category='datastore.query'):
+    """Return a subclass of ``query_class`` whose ``fetch`` is traced.
+    """
+    class TracedQuery(query_class):
+        def fetch(self, *args, **kw):
+            return traced_iter(category,
+                               super(TracedQuery, self).fetch(*args, **kw))
+    TracedQuery.__name__ = query_class.__name__
+    return TracedQuery
+
+
+class _TracedRenderer(object):
+    """Wrap a renderer, tracing render time.
+
+    Other attributes are passed through, e.g. the ``implementation()`` of a
+    template used as a macro.
+    """
+    def __init__(self, renderer, category):
+        self._renderer = renderer
+        self._category = category
+
+    def __call__(self, value, system):
+        with traced(self._category):
+            return self._renderer(value, system)
+
+    def __getattr__(self, name):
+        return getattr(self._renderer, name)
+
+
+def traced_renderer_factory(factory, category='render'):
+    """Wrap a Pyramid renderer factory, tracing render time.
+    """
+    def _factory(info):
+        return _TracedRenderer(factory(info), category)
+    return _factory
+
+
+def server_timing(trace):
+    """Format a trace as a ``Server-Timing`` header value.
+    """
+    metrics = []
+    for category, info in sorted(trace.summary().items()):
+        metrics.append('%s;dur=%.1f;desc="%d calls"'
+                       % (category.replace('.', '-'),
+                          info['seconds'] * 1000, info['count']))
+    metrics.append('total;dur=%.1f' % (trace.elapsed * 1000))
+    return ', '.join(metrics)
+
+
+def _asbool(value):
+    return str(value).strip().lower() in ('true', 'yes', 'on', '1')
+
+
+class _TracedIterator(object):
+    """Wrap a streamed response body, tracing the work done to produce it.
+
+    ``trace`` (and ``profiler``, if any) is active while each chunk is
+    produced;  ``finish`` is called once the body is closed.
+    """
+    def __init__(self, app_iter, trace, profiler, finish):
+        self._app_iter = app_iter
+        self._trace = trace
+        self._profiler = profiler
+        self._finish = finish
+        self._closed = False
+
+    def __iter__(self):
+        iterator = iter(self._app_iter)
+        while True:
+            activate(self._trace)
+            if self._profiler is not None:
+                self._profiler.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                if self._profiler is not None:
+                    self._profiler.disable()
+                activate(None)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self._app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._finish()
+
+
+def tracing_tween_factory(handler, registry):
+    """Pyramid tween:  trace backend calls made while handling each request.
+
+    Adds a ``Server-Timing`` header, logs a JSON line per request to the
+    ``gcloud_expenses.tracing`` logger, and, for a sample of requests, runs
+    the handler under :mod:`cProfile`, keeping the profile if the request
+    proves slow.  Settings:
+
+    - ``gcloud_expenses.server_timing`` (default true)
+
+    - ``gcloud_expenses.slow_request_threshold``, in seconds (default 1.0)
+
+    - ``gcloud_expenses.profile_sample_rate``, between 0 and 1 (default 0)
+
+    - ``gcloud_expenses.profile_dir`` (default: the current directory)
+
+    A streamed response body is produced after the tween returns:  its
+    calls are traced too, and the request logged once the server closes the
+    body, but the ``Server-Timing`` header (sent first) leaves them out.
+
+    A request whose handler raises is logged (and profiled) too, with the
+    status of the HTTP exception raised, or else 500, and the exception's
+    class name as ``error``.
+    """
+    settings = registry.settings or {}
+    add_header = _asbool(settings.get('gcloud_expenses.server_timing', True))
+    threshold = float(settings.get('gcloud_expenses.slow_request_threshold',
+                                   1.0))
+    sample_rate = float(settings.get('gcloud_expenses.profile_sample_rate',
+                                     0.0))
+    profile_dir = settings.get('gcloud_expenses.profile_dir', '.')
+
+    def tracing_tween(request):
+        trace = Trace()
+        activate(trace)
+        profiler = None
+        if sample_rate and random.random() < sample_rate:
+            profiler = cProfile.Profile()
+        response = None
+        try:
+            if profiler is not None:
+                response = profiler.runcall(handler, request)
+            else:
+                response = handler(request)
+        finally:
+            activate(None)
+            if response is None:
+                # The handler raised:  an HTTP exception is itself the
+                # response, anything else becomes a 500.
+                error = sys.exc_info()[1]
+                status = getattr(error, 'status_int', None)
+                if status is None:
+                    status = 500
+                elif add_header:
+                    error.headers['Server-Timing'] = server_timing(trace)
+                _finish(request, status, trace, profiler, error)
+        if add_header:
+            response.headers['Server-Timing'] = server_timing(trace)
+        if isinstance(response.app_iter, (list, tuple)):
+            _finish(request, response.status_int, trace, profiler)
+        else:
+            response.app_iter = _TracedIterator(
+                response.app_iter, trace, profiler,
+                lambda: _finish(request, response.status_int, trace,
+                                profiler))
+        return response
+
+    def _finish(request, status, trace, profiler, error=None):
+        elapsed = trace.elapsed
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'seconds': round(elapsed, 6),
+            'calls': trace.summary(),
+            }
+        if error is not None:
+            record['error'] = type(error).__name__
+        logger.info(json.dumps(record, sort_keys=True))
+        if threshold and elapsed >= threshold:
+            logger.warning('Slow request: %s %s (%.3fs)',
+                           request.method, request.path, elapsed)
+            if profiler is not None:
+                filename = os.path.join(
+                    profile_dir, 'request-%d-%d.prof'
+                    % (int(trace.started * 1000), os.getpid()))
+                profiler.dump_stats(filename)
+                logger.warning('Saved profile: %s', filename)
+
+    return tracing_tween
+
+
+def includeme(config):
+    # Include 'pyramid_chameleon' from here, so that our '.pt' renderer
+    # overrides its own.
+    from pyramid_chameleon.zpt import renderer_factory
+    config.include('pyramid_chameleon')
+    config.add_renderer('.pt', traced_renderer_factory(renderer_factory))
+    config.add_tween('gcloud_expenses.tracing.tracing_tween_factory')
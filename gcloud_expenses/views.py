@@ -1,9 +1,53 @@
+import calendar
+import hashlib
+import os
+
 from pyramid.renderers import get_renderer
+from pyramid.renderers import render
 from pyramid.view import view_config
 
 from . import get_employee_info
 from . import get_report_info
 from . import list_employees
+from . import list_report_items
+from . import next_reports_to_review
+from . import search_expenses
+from .cache import SizedLRUCache
+
+REVIEW_QUEUE_LIMIT = 25
+MAX_REVIEW_QUEUE_LIMIT = 200
+SEARCH_PAGE_SIZE = 20
+
+# Paid / rejected reports change only if force-deleted (and perhaps
+# re-created under the same ID):  let browsers, proxies and CDNs keep them
+# for a few minutes, then revalidate them with their ETag.
+FINALIZED_STATUSES = ('paid', 'rejected')
+FINALIZED_CACHE_CONTROL = 'public, max-age=300, must-revalidate'
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+# Pages are rendered from these, besides the data:  a change to any of them
+# (e.g. a deployment) changes every page's ETag.
+_HERE = os.path.dirname(os.path.abspath(__file__))
+PAGE_SOURCES = (
+    os.path.join(_HERE, 'templates'),
+    os.path.join(_HERE, 'static'),
+    os.path.join(_HERE, 'views.py'),
+    )
+
+# Rendered HTML fragments, keyed by the data they were rendered from, so
+# that stale entries are never hit, merely evicted.  Sizes are in characters.
+FRAGMENT_CACHE_SIZE = 64 * 1024 * 1024
+fragments = SizedLRUCache(FRAGMENT_CACHE_SIZE)
+
+# Report pages are streamed, this many item rows at a time, unless their
+# item table is already cached.  Zero disables streaming.
+STREAM_CHUNK_SIZE = 500
+stream_chunk_size = STREAM_CHUNK_SIZE
+
+# Placeholders (HTML comments, which escaped data cannot produce) used to
+# split rendered templates around the streamed rows.
+_ITEMS_MARKER = '<!-- report items -->'
+_ROWS_MARKER = '<!-- report rows -->'
 
 def get_main_template(request):
     main_template = get_renderer('templates/main.pt')
@@ -17,7 +61,182 @@ def home_page(request):
 
 @view_config(route_name='employees', renderer='templates/employees.pt')
 def show_employees(request):
-    return {'employees': list_employees()}
+    return {'employees': list_employees(
+        connection=request.datastore_connection)}
+
+
+@view_config(route_name='review', renderer='templates/review.pt')
+def show_review_queue(request):
+    try:
+        limit = int(request.params.get('limit', REVIEW_QUEUE_LIMIT))
+    except ValueError:
+        limit = REVIEW_QUEUE_LIMIT
+    limit = max(0, min(limit, MAX_REVIEW_QUEUE_LIMIT))
+    return {'reports': list(next_reports_to_review(
+        limit, connection=request.datastore_connection))}
+
+
+@view_config(route_name='search', renderer='templates/search.pt')
+def show_search(request):
+    q = request.params.get('q', '').strip()
+    try:
+        offset = max(0, int(request.params.get('offset', 0)))
+    except ValueError:
+        offset = 0
+    info = {'q': q, 'results': None, 'first': 0, 'last': 0,
+            'prev_url': None, 'next_url': None}
+    if not q:
+        return info
+    results = info['results'] = search_expenses(
+        q, SEARCH_PAGE_SIZE, offset, connection=request.datastore_connection)
+    shown = len(results['items'])
+    info['first'] = offset + 1 if shown else 0
+    info['last'] = offset + shown
+    if offset > 0:
+        info['prev_url'] = request.route_url(
+            'search', _query={'q': q,
+                              'offset': max(0, offset - SEARCH_PAGE_SIZE)})
+    if offset + SEARCH_PAGE_SIZE < results['total_items']:
+        info['next_url'] = request.route_url(
+            'search', _query={'q': q, 'offset': offset + SEARCH_PAGE_SIZE})
+    return info
+
+
+def source_version(paths=PAGE_SOURCES):
+    """Return a digest of the files under ``paths`` (files or directories).
+    """
+    digest = hashlib.md5()
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(dirpath, name)
+                     for dirpath, dirnames, filenames in os.walk(path)
+                     for name in filenames]
+        else:
+            files = [path]
+        for name in sorted(files):
+            digest.update(os.path.relpath(name, _HERE).encode('utf-8'))
+            with open(name, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+page_version = source_version()
+
+
+def compute_etag(*parts):
+    """Return a strong entity tag for a page derived from ``parts``.
+
+    The tag includes :data:`page_version`, so that pages cached before a
+    change to the templates, static files or views are not reused.
+    """
+    digest = hashlib.md5()
+    digest.update(page_version.encode('ascii'))
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _timestamp(when):
+    if when.tzinfo is not None:
+        return calendar.timegm(when.utctimetuple())
+    return calendar.timegm(when.timetuple())
+
+
+def conditional_response(request, etag, last_modified, cache_control):
+    """Set validators on ``request.response``.
+
+    Return the response, with a 304 status, if the client's cached copy is
+    still current (so the view can skip rendering), else None.
+    """
+    response = request.response
+    response.etag = etag
+    response.headers['Cache-Control'] = cache_control
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if request.if_none_match:
+        # If-None-Match wins over If-Modified-Since (RFC 7232, section 6).
+        fresh = etag in request.if_none_match
+    elif (request.if_modified_since is not None and
+            last_modified is not None):
+        fresh = (_timestamp(last_modified) <=
+                 _timestamp(request.if_modified_since))
+    else:
+        fresh = False
+    if fresh:
+        response.status_int = 304
+        return response
+
+
+def render_fragment(key, factory):
+    """Return the HTML returned by ``factory()``, cached under ``key``.
+
+    ``factory`` is called only on a cache miss.
+    """
+    html = fragments.get(key)
+    if html is None:
+        html = factory()
+        fragments.set(key, html)
+    return html
+
+
+def render_report_items(request, items):
+    rows_html = render('templates/report_rows.pt', {'items': items},
+                       request=request)
+    return render('templates/report_items.pt', {'rows_html': rows_html},
+                  request=request)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_report_page(request, report, items, cache_key):
+    """Return a response which streams the report page.
+
+    The page up to the item rows is sent at once;  rows are then rendered
+    from the ``items`` iterable ``stream_chunk_size`` at a time, so that
+    memory use does not grow with the size of the report.  The item table
+    is added to the fragment cache only if it proves small enough.
+    """
+    page = render('templates/report.pt',
+                  {'report': report, 'items_html': _ITEMS_MARKER},
+                  request=request)
+    page_head, page_tail = page.split(_ITEMS_MARKER)
+    table = render('templates/report_items.pt', {'rows_html': _ROWS_MARKER},
+                   request=request)
+    table_head, table_tail = table.split(_ROWS_MARKER)
+    cache_limit = fragments.max_size // 8
+
+    def _app_iter():
+        yield (page_head + table_head).encode('utf-8')
+        parts = [table_head]
+        size = len(table_head) + len(table_tail)
+        for chunk in _chunks(items, stream_chunk_size):
+            rows = render('templates/report_rows.pt', {'items': chunk},
+                          request=request)
+            if parts is not None:
+                size += len(rows)
+                if size > cache_limit:
+                    parts = None
+                else:
+                    parts.append(rows)
+            yield rows.encode('utf-8')
+        if parts is not None:
+            parts.append(table_tail)
+            fragments.set(cache_key, ''.join(parts))
+        yield (table_tail + page_tail).encode('utf-8')
+
+    response = request.response
+    response.content_type = 'text/html'
+    response.charset = 'utf-8'
+    response.app_iter = _app_iter()
+    return response
 
 
 def fixup_report(report):
@@ -30,19 +249,65 @@ def fixup_report(report):
 @view_config(route_name='employee', renderer='templates/employee.pt')
 def show_employee(request):
     employee_id = request.matchdict['employee_id']
-    info = get_employee_info(employee_id)
-    info['reports'] = [fixup_report(report) for report in info['reports']]
+    info = get_employee_info(employee_id,
+                             connection=request.datastore_connection)
+    stamps = [report['last_modified'] for report in info['reports']]
+    if info['last_modified'] is not None:
+        stamps.append(info['last_modified'])
+    etag = compute_etag(employee_id, info['name'], info['last_modified'],
+                        [(report['report_id'], report['last_modified'],
+                          report['status']) for report in info['reports']])
+    not_modified = conditional_response(
+        request, etag, stamps and max(stamps) or None,
+        REVALIDATE_CACHE_CONTROL)
+    if not_modified is not None:
+        return not_modified
+    info['reports_html'] = render_fragment(
+        ('employee-reports', etag),
+        lambda: render('templates/employee_reports.pt',
+                       {'employee_id': employee_id,
+                        'reports': [fixup_report(report)
+                                    for report in info['reports']]},
+                       request=request))
     return info
 
 @view_config(route_name='report', renderer='templates/report.pt')
 def show_report(request):
     employee_id = request.matchdict['employee_id']
     report_id = request.matchdict['report_id']
-    return {'report':
-            fixup_report(get_report_info(employee_id, report_id))}
+    report = get_report_info(employee_id, report_id, items=False,
+                             connection=request.datastore_connection)
+    if report['status'] in FINALIZED_STATUSES:
+        cache_control = FINALIZED_CACHE_CONTROL
+    else:
+        cache_control = REVALIDATE_CACHE_CONTROL
+    etag = compute_etag(employee_id, report_id, report['last_modified'],
+                        report['status'])
+    not_modified = conditional_response(
+        request, etag, report['last_modified'], cache_control)
+    if not_modified is not None:
+        return not_modified
+    cache_key = ('report-items', employee_id, report_id,
+                 report['last_modified'])
+    items_html = fragments.get(cache_key)
+    if items_html is None:
+        items = list_report_items(
+            employee_id, report_id, connection=request.datastore_connection)
+        if stream_chunk_size:
+            return stream_report_page(request, fixup_report(report), items,
+                                      cache_key)
+        items_html = render_report_items(request, items)
+        fragments.set(cache_key, items_html)
+    return {'report': fixup_report(report), 'items_html': items_html}
 
 
 def includeme(config):
+    global stream_chunk_size
+    settings = config.get_settings()
+    fragments.max_size = int(settings.get(
+        'gcloud_expenses.fragment_cache_size', FRAGMENT_CACHE_SIZE))
+    stream_chunk_size = int(settings.get(
+        'gcloud_expenses.stream_chunk_size', STREAM_CHUNK_SIZE))
     config.add_request_method(callable=get_main_template,
                               name='main_template',
                               property=True,
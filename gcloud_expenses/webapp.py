@@ -1,34 +1,99 @@
 from pyramid.config import Configurator
 
 from . import initialize_gcloud
-from . import _get_bucket
+from . import new_client
+from . import reinitialize_gcloud
 from .pool import ResourcePool
 
+# Clients (a datastore connection and the receipts bucket, sharing one
+# keep-alive HTTP session), checked out by one request at a time.
 datasets = ResourcePool()
-buckets = ResourcePool()
 
-def _get_create_bucket(self):
-    bucket = buckets.check_out()
-    if bucket is None:
-        bucket = _get_bucket()
-        buckets.add(bucket, checked_out=True)
+
+class _ClosingIterator(object):
+    """Wrap a response body, calling ``callback`` once it is closed.
+    """
+    def __init__(self, app_iter, callback):
+        self._app_iter = app_iter
+        self._callback = callback
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self._app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._callback()
+
+
+def _get_create_client(self):
+    client = datasets.check_out()
+    if client is None:
+        client = new_client()
+        datasets.add(client, checked_out=True)
+    streaming = []
+    def _hold(self, response):
+        # A streamed body reads from the datastore after the request is
+        # finished:  return the client once the server closes the body.
+        if not isinstance(response.app_iter, (list, tuple)):
+            streaming.append(True)
+            response.app_iter = _ClosingIterator(
+                response.app_iter, lambda: datasets.check_in(client))
     def _return(self):
-        buckets.check_in(bucket)
+        if not streaming:
+            datasets.check_in(client)
+    self.add_response_callback(_hold)
     self.add_finished_callback(_return)
-    return bucket
+    return client
+
+def _get_bucket(self):
+    return self.client.bucket
+
+def _get_datastore_connection(self):
+    return self.client.connection
+
+def after_fork():
+    """Re-create per-process resources in a newly forked worker process.
+
+    Clients pooled before the fork would share their HTTP sessions (and
+    sockets) with the parent.
+    """
+    global datasets
+    datasets = ResourcePool(datasets.size, datasets.timeout)
+    reinitialize_gcloud()
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     initialize_gcloud()
     config = Configurator(settings=settings)
-    config.add_request_method(_get_create_bucket, 'bucket', reify=True)
-    config.include('pyramid_chameleon')
+    config.add_request_method(_get_create_client, 'client', reify=True)
+    config.add_request_method(_get_bucket, 'bucket', reify=True)
+    config.add_request_method(_get_datastore_connection,
+                              'datastore_connection', reify=True)
+    config.include('.tracing')
     config.include('.views')
+    config.include('.assets')
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
     config.add_route('employees', '/employees/')
+    config.add_route('review', '/review/')
+    config.add_route('search', '/search')
     config.add_route('employee', '/employees/{employee_id}')
     config.add_route('report', '/employees/{employee_id}/{report_id}')
+    config.add_route('api_employees', '/api/employees')
+    config.add_route('api_employees_ndjson', '/api/employees.ndjson')
+    config.add_route('api_reports_ndjson', '/api/reports.ndjson')
+    config.add_route('api_search', '/api/search')
+    config.add_route('api_employee', '/api/employees/{employee_id}')
+    config.add_route('api_report', '/api/employees/{employee_id}/{report_id}')
+    config.add_route('api_report_items_ndjson',
+                     '/api/employees/{employee_id}/{report_id}/items.ndjson')
     config.scan()
     return config.make_wsgi_app()
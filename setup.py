@@ -16,13 +16,23 @@ setup(
             'pyramid',
             'pyramid_chameleon',
             'waitress',
-        ]
+        ],
+        'assets': [
+            'brotli',
+        ],
+        'receipts': [
+            'Pillow',
+        ],
     },
     entry_points={
         'console_scripts': [
             'submit_expenses = gcloud_expenses.scripts.submit_expenses:main',
             'review_expenses = gcloud_expenses.scripts.review_expenses:main',
             'expense_receipts = gcloud_expenses.scripts.expense_receipts:main',
+            'build_static_assets = gcloud_expenses.assets:main',
+            'benchmark_startup = gcloud_expenses.scripts.benchmark_startup:main',
+            'serve_expenses = gcloud_expenses.scripts.prefork:main',
+            'load_test_expenses = gcloud_expenses.scripts.load_test:main',
         ],
         'paste.app_factory': [
             'main = gcloud_expenses.webapp:main',